@@ -0,0 +1,40 @@
+"""Benchmarks of the heroku2elk ingest pipeline.
+
+Run a benchmark with ``python -m benchmarks.<name>``.
+"""
+import json
+import random
+
+
+WORDS = ('lorem ipsum dolor sit amet consecteteur adipiscing elit quis ad '
+         'arcu mi et vel taciti facilisi odio ut').split()
+
+
+def heroku_lines(count, seed=0, app='DummyAppName'):
+    'generate reproducible heroku syslog lines'
+    rand = random.Random(seed)
+    return ['<40>1 2017-06-21T17:02:55+00:00 host %s web.%d - %s.' % (
+                app, rand.randint(1, 9),
+                ' '.join(rand.choice(WORDS)
+                         for _ in range(rand.randint(3, 30))))
+            for _ in range(count)]
+
+
+def envelope(log, type_='heroku', parser_ver='v1', env='production',
+             app='DummyAppName'):
+    'the JSON envelope published by HerokuHandler'
+    return json.dumps(dict(type=type_, parser_ver=parser_ver, env=env,
+                           app=app, message=log,
+                           http_content_length=len(log)))
+
+
+def percentile(values, percent):
+    'nearest-rank percentile of a list of values'
+    values = sorted(values)
+    rank = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[rank]
+
+
+def report(**results):
+    'print the results of a benchmark run as a JSON line'
+    print(json.dumps(results, sort_keys=True))
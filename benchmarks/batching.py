@@ -0,0 +1,73 @@
+"""Compare per-line and batched (NDJSON) AMQP publishing.
+
+The messages are published to an in-process simulated broker which counts
+the messages and the bytes of the AMQP frames it receives, or to the broker
+of the configuration with --amqp.
+
+    python -m benchmarks.batching [--lines N] [--apps N] [--amqp]
+"""
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from functools import partial
+from time import perf_counter
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from benchmarks import heroku_lines, envelope, report
+from benchmarks.broker import simulated_broker
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from heroku2elk.lib.batch import BatchPublisher
+
+
+@gen.coroutine
+def run(conf, items, batched, broker):
+    publish = partial(AMQPConnectionSingleton().publish, conf)
+    yield AMQPConnectionSingleton().get_channel(conf)
+    if batched:
+        publish = BatchPublisher(conf, publish).add
+    if broker is not None:
+        broker.messages = broker.bytes = 0
+
+    start = perf_counter()
+    yield [publish(routing_key, body) for routing_key, body in items]
+    elapsed = perf_counter() - start
+
+    result = dict(mode='batched' if batched else 'per-line',
+                  lines=len(items), seconds=round(elapsed, 4),
+                  lines_per_sec=round(len(items) / elapsed))
+    if broker is not None:
+        result.update(messages=broker.messages, broker_bytes=broker.bytes,
+                      messages_per_sec=round(broker.messages / elapsed))
+    return result
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--apps', type=int, default=10)
+    parser.add_argument('--amqp', action='store_true',
+                        help='publish to the broker of the configuration')
+    args = parser.parse_args()
+
+    conf = MainConfig()
+    items = []
+    for n, log in enumerate(heroku_lines(args.lines)):
+        app = 'app%d' % (n % args.apps)
+        items.append(('heroku.v1.production.%s' % app,
+                      envelope(log, app=app)))
+
+    with ExitStack() as stack:
+        broker = None
+        if not args.amqp:
+            broker = stack.enter_context(simulated_broker())
+        ioloop = IOLoop.current()
+        for batched in (False, True):
+            report(**ioloop.run_sync(partial(run, conf, items, batched,
+                                             broker)))
+        AMQPConnectionSingleton().close_channel()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""In-process simulated RabbitMQ broker.
+
+It replaces pika.TornadoConnection for heroku2elk.lib.amqp, counts the
+messages and the bytes of the AMQP frames it receives, and confirms the
+deliveries with a multiple ack every ack_interval seconds, as RabbitMQ
+does under load.
+"""
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from pika import frame, spec
+
+
+class SimulatedChannel:
+
+    def __init__(self, broker, ioloop, channel_number):
+        self.broker = broker
+        self.ioloop = ioloop
+        self.channel_number = channel_number
+        self.is_open = True
+        self.delivery_tag = 0
+        self.on_confirmation = None
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def exchange_declare(self, callback, exchange, exchange_type):
+        self.ioloop.add_callback(callback, None)
+
+    def queue_declare(self, callback, queue, durable, exclusive,
+                      auto_delete):
+        self.ioloop.add_callback(callback, None)
+
+    def confirm_delivery(self, callback):
+        self.on_confirmation = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        if isinstance(body, str):
+            body = body.encode()
+        self.broker.messages += 1
+        if self.broker.count_bytes:
+            self.broker.bytes += sum(len(f.marshal()) for f in (
+                frame.Method(self.channel_number, spec.Basic.Publish(
+                    exchange=exchange, routing_key=routing_key,
+                    mandatory=mandatory)),
+                frame.Header(self.channel_number, len(body), properties),
+                frame.Body(self.channel_number, body)))
+        self.delivery_tag += 1
+        if self.delivery_tag == 1 or self.broker.ack_interval == 0:
+            self.ioloop.call_later(self.broker.ack_interval, self.ack)
+
+    def ack(self):
+        if self.on_confirmation is None or not self.is_open:
+            return
+        self.on_confirmation(frame.Method(
+            self.channel_number,
+            spec.Basic.Ack(delivery_tag=self.delivery_tag, multiple=True)))
+        if self.broker.ack_interval:
+            self.ioloop.call_later(self.broker.ack_interval, self.ack)
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        self.is_open = False
+
+
+class SimulatedBroker:
+
+    def __init__(self, ack_interval=0.001, count_bytes=True):
+        self.ack_interval = ack_interval
+        # marshalling the frames costs more than publishing them
+        self.count_bytes = count_bytes
+        self.messages = 0
+        self.bytes = 0
+
+    def connection(self, parameters, on_open_callback,
+                   on_open_error_callback, on_close_callback, custom_ioloop):
+        return SimulatedConnection(self, custom_ioloop, on_open_callback,
+                                   on_close_callback)
+
+
+class SimulatedConnection:
+
+    def __init__(self, broker, ioloop, on_open_callback, on_close_callback):
+        self.broker = broker
+        self.ioloop = ioloop
+        self.on_close_callback = on_close_callback
+        self.channels = []
+        self.is_open = True
+        ioloop.add_callback(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        channel = SimulatedChannel(self.broker, self.ioloop,
+                                   len(self.channels) + 1)
+        self.channels.append(channel)
+        self.ioloop.add_callback(on_open_callback, channel)
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        self.is_open = False
+        for channel in self.channels:
+            channel.is_open = False
+        self.ioloop.add_callback(self.on_close_callback, self, reply_code,
+                                 reply_text)
+
+
+@contextmanager
+def simulated_broker(ack_interval=0.001, count_bytes=True):
+    broker = SimulatedBroker(ack_interval, count_bytes)
+    with patch('heroku2elk.lib.amqp.pika.TornadoConnection',
+               broker.connection):
+        yield broker
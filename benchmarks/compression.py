@@ -0,0 +1,76 @@
+"""Measure the compression ratio and CPU cost of the encodings.
+
+The drain bodies of the fakelog corpora are decompressed as gzip and
+deflate request bodies, and their envelopes are compressed as batched
+(NDJSON) messages with PUBLISH_COMPRESSION zlib and gzip at several
+levels. The costs are CPU milliseconds per MB of uncompressed data.
+
+    python -m benchmarks.compression [--lines N] [--batch N]
+"""
+from argparse import ArgumentParser
+from functools import partial
+import gzip
+from time import process_time
+import zlib
+
+from benchmarks import envelope, report
+from heroku2elk.lib.compression import Compressor, Decompressor
+from scripts.fakelog import CORPORA, drain_bodies, fake_logs
+
+
+REQUEST_ENCODINGS = {'gzip': gzip.compress, 'deflate': zlib.compress}
+
+
+def ms_per_mb(function, items, repeat, size):
+    'the CPU milliseconds taken by function on items per MB of size'
+    start = process_time()
+    for _ in range(repeat):
+        for item in items:
+            function(item)
+    return round((process_time() - start) * 1000 / repeat / size * 2**20, 2)
+
+
+def decompress_body(encoding, body):
+    decompressor = Decompressor(encoding, 2**26)
+    decompressor.decompress(body)
+    decompressor.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=100,
+                        help='lines per drain body and per batched message')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for corpus in CORPORA:
+        bodies = drain_bodies(args.lines // args.batch, args.batch, corpus)
+        size = sum(len(body) for body in bodies)
+        for encoding, compress in REQUEST_ENCODINGS.items():
+            compressed = [compress(body, 6) for body in bodies]
+            report(bench='request', corpus=corpus, encoding=encoding,
+                   bytes=size,
+                   ratio=round(size / sum(map(len, compressed)), 2),
+                   decompress_ms_per_mb=ms_per_mb(
+                       partial(decompress_body, encoding), compressed,
+                       args.repeat, size))
+
+        lines = [envelope(log.msg) for log in fake_logs(args.lines, corpus)]
+        messages = [('\n'.join(lines[i:i + args.batch]) + '\n').encode()
+                    for i in range(0, len(lines), args.batch)]
+        size = sum(len(message) for message in messages)
+        for encoding in ('zlib', 'gzip'):
+            for level in (1, 6, 9):
+                compressor = Compressor(encoding, level)
+                compressed = sum(len(compressor.compress(message))
+                                 for message in messages)
+                report(bench='publish', corpus=corpus, encoding=encoding,
+                       level=level, bytes=size,
+                       ratio=round(size / compressed, 2),
+                       compress_ms_per_mb=ms_per_mb(
+                           compressor.compress, messages, args.repeat, size))
+
+
+if __name__ == '__main__':
+    main()
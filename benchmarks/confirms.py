@@ -0,0 +1,73 @@
+"""Latency added by waiting for the publisher confirms of a drain request.
+
+Each request publishes its lines and waits for all of them, as the drain
+handlers do, with and without AMQP_WAIT_CONFIRMS. The simulated broker
+acks every --ack-interval seconds, use --amqp for the configured broker.
+
+    python -m benchmarks.confirms [--requests N] [--lines N] [--amqp]
+"""
+from argparse import ArgumentParser
+from contextlib import ExitStack
+from functools import partial
+from time import perf_counter
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from benchmarks import heroku_lines, envelope, percentile, report
+from benchmarks.broker import simulated_broker
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton
+
+
+@gen.coroutine
+def run(conf, bodies, requests, concurrency):
+    publish = partial(AMQPConnectionSingleton().publish, conf)
+    yield AMQPConnectionSingleton().get_channel(conf)
+    latencies = []
+
+    @gen.coroutine
+    def client(count):
+        for _ in range(count):
+            start = perf_counter()
+            yield [publish('heroku.v1.production.app', body)
+                   for body in bodies]
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    yield [client(requests // concurrency) for _ in range(concurrency)]
+    elapsed = perf_counter() - start
+
+    lines = len(latencies) * len(bodies)
+    return dict(wait_confirms=conf.amqp_wait_confirms,
+                requests=len(latencies), lines=lines,
+                lines_per_sec=round(lines / elapsed),
+                p50_ms=round(percentile(latencies, 50) * 1000, 3),
+                p99_ms=round(percentile(latencies, 99) * 1000, 3))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--lines', type=int, default=20,
+                        help='log lines per request')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--ack-interval', type=float, default=0.001)
+    parser.add_argument('--amqp', action='store_true',
+                        help='publish to the broker of the configuration')
+    args = parser.parse_args()
+
+    bodies = [envelope(log) for log in heroku_lines(args.lines)]
+    with ExitStack() as stack:
+        if not args.amqp:
+            stack.enter_context(simulated_broker(args.ack_interval))
+        for wait in (False, True):
+            conf = MainConfig()
+            conf.amqp_wait_confirms = wait
+            report(**IOLoop.current().run_sync(partial(
+                run, conf, bodies, args.requests, args.concurrency)))
+            AMQPConnectionSingleton().close_channel()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Compare the encoders of the heroku envelopes.
+
+Every encoder serializes the same fakelog-like lines, its output is
+checked against json.dumps of the envelope dict.
+
+    python -m benchmarks.envelope [--lines N] [--unicode RATIO]
+"""
+from argparse import ArgumentParser
+import random
+from time import perf_counter
+
+from benchmarks import heroku_lines, envelope, report
+from heroku2elk.lib.envelope import BACKENDS, DictEncoder, TemplateEncoder, \
+    get_quote
+from heroku2elk.lib.routes import heroku_route
+
+
+def encoders():
+    yield 'dict', 'json', DictEncoder()
+    for name in BACKENDS:
+        quote = get_quote(name)
+        if name == 'json' or quote is not get_quote('json'):
+            yield 'template', name, TemplateEncoder(quote)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--unicode', type=float, default=0.1,
+                        help='ratio of lines with non ASCII characters')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    logs = [log + ' caf\xe9 — \U0001f600' if rand.random() < args.unicode
+            else log for log in heroku_lines(args.lines)]
+    route = heroku_route('/heroku/v1/production/DummyAppName')
+    expected = [envelope(log) for log in logs]
+
+    for mode, backend, encoder in encoders():
+        encode = encoder.encode
+        best = None
+        for _ in range(args.repeat):
+            start = perf_counter()
+            payloads = [encode(route, log) for log in logs]
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        report(mode=mode, backend=backend, lines=len(logs),
+               identical=payloads == expected,
+               lines_per_sec=round(len(logs) / best),
+               ns_per_line=round(best / len(logs) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Throughput and latency of the heroku drain handlers.
+
+Drain requests are posted over HTTP keep-alive connections to the
+application served in-process, which publishes to the simulated broker.
+
+    python -m benchmarks.handlers [--requests N] [--lines N] [--loop uvloop]
+"""
+from argparse import ArgumentParser
+import asyncio
+from contextlib import ExitStack
+from functools import partial
+from time import perf_counter
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from benchmarks import heroku_lines, percentile, report
+from benchmarks.broker import simulated_broker
+from heroku2elk import main as h2l
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from heroku2elk.lib.handlers import HerokuHandler
+
+
+def drain_body(lines):
+    return b''.join(b'%d %s' % (len(line), line)
+                    for line in (log.encode() for log in lines))
+
+
+@gen.coroutine
+def run(conf, body, lines, requests, concurrency):
+    app = h2l.make_app(conf)
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    yield AMQPConnectionSingleton().get_channel(conf)
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    url = 'http://127.0.0.1:%d/heroku/v1/production/app' % port
+    latencies = []
+
+    @gen.coroutine
+    def worker(count):
+        for _ in range(count):
+            start = perf_counter()
+            yield client.fetch(url, method='POST', body=body)
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    yield [worker(requests // concurrency) for _ in range(concurrency)]
+    elapsed = perf_counter() - start
+
+    client.close()
+    server.stop()
+    h2l.close_app(app)
+    return dict(wait_confirms=conf.amqp_wait_confirms,
+                batched=conf.amqp_batch_activated, requests=len(latencies),
+                lines_per_sec=round(len(latencies) * lines / elapsed),
+                p50_ms=round(percentile(latencies, 50) * 1000, 3),
+                p99_ms=round(percentile(latencies, 99) * 1000, 3))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--lines', type=int, default=50,
+                        help='log lines per request')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--loop', choices=['asyncio', 'uvloop'],
+                        default='asyncio')
+    args = parser.parse_args()
+
+    if args.loop == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    body = drain_body(heroku_lines(args.lines))
+    with ExitStack() as stack:
+        stack.enter_context(simulated_broker(count_bytes=False))
+        for wait, batch in ((False, False), (True, False), (False, True)):
+            conf = MainConfig()
+            conf.handlers = dict(heroku=dict(v1=[HerokuHandler]))
+            conf.amqp_wait_confirms = wait
+            conf.amqp_batch_activated = batch
+            result = IOLoop.current().run_sync(partial(
+                run, conf, body, args.lines, args.requests,
+                args.concurrency))
+            report(loop=args.loop, **result)
+            AMQPConnectionSingleton().close_channel()
+
+
+if __name__ == '__main__':
+    main()
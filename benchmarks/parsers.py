@@ -0,0 +1,73 @@
+"""Compare the octet counting parsers on pathological drain bodies.
+
+    python -m benchmarks.parsers [--repeat N]
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+from benchmarks import heroku_lines, report
+from heroku2elk.lib.syslog import FrameParser, decode_line
+
+
+def legacy_split(body):
+    'the str based loop MultiLineHandler used, counting characters'
+    logs, msg = [], body.decode().strip()
+    while msg:
+        size, msg = msg.split(maxsplit=1)
+        size = int(size)
+        log, msg = msg[:size], msg[size:].strip()
+        logs.append(log)
+    return logs
+
+
+def split(body):
+    return [decode_line(frame) for frame in FrameParser().split(body)]
+
+
+def stream(body, chunk_size=16384):
+    parser, frames = FrameParser(), []
+    for i in range(0, len(body), chunk_size):
+        frames.extend(parser.feed(body[i:i + chunk_size]))
+    frames.extend(parser.close())
+    return [decode_line(frame) for frame in frames]
+
+
+def frame(line):
+    line = line.encode()
+    return b'%d %s' % (len(line), line)
+
+
+def bodies():
+    yield 'tiny_frames', b''.join(frame('x') for _ in range(30000))
+    yield 'multibyte', b''.join(frame(line.replace('e', 'é').replace(
+        'o', '中') + ' \U0001f600') for line in heroku_lines(2000))
+    yield 'heroku_1mb', b''.join(frame(line)
+                                 for line in heroku_lines(6000))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, body in bodies():
+        expected = split(body)
+        for parse in (legacy_split, split, stream):
+            best = None
+            for _ in range(args.repeat):
+                start = perf_counter()
+                try:
+                    logs = parse(body)
+                except ValueError:
+                    # the legacy loop loses track of multibyte frames
+                    logs = None
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            report(body=name, bytes=len(body), parser=parse.__name__,
+                   lines=len(expected), correct=logs == expected,
+                   ms=round(best * 1000, 3),
+                   lines_per_sec=round(len(expected) / best))
+
+
+if __name__ == '__main__':
+    main()
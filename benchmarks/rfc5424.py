@@ -0,0 +1,84 @@
+"""Compare the RFC 5424 header parser with the equivalent regex.
+
+The regex is the grok pattern of docs/logstash.conf as parse_header reads
+it, their results are checked to be identical.
+
+    python -m benchmarks.rfc5424 [--lines N]
+"""
+from argparse import ArgumentParser
+from functools import partial
+import re
+from time import perf_counter
+
+from benchmarks import heroku_lines, report
+from heroku2elk.lib.envelope import FieldsEncoder, TemplateEncoder
+from heroku2elk.lib.rfc5424 import FIELDS, parse_header
+from heroku2elk.lib.routes import heroku_route
+
+
+HEADER = re.compile(
+    r'<(?P<syslog5424_pri>[0-9]{1,3})>(?P<syslog5424_ver>[0-9]+) +'
+    r'(?:-|(?P<timestamp>[^ ]+)) +(?:-|(?P<heroku_drain_id>[^ ]+)) +'
+    r'(?:-|(?P<heroku_source>[^ ]+)) +(?:-|(?P<heroku_dyno>[^ ]+)) +'
+    r'(?:-|(?P<syslog5424_msgid>[^ ]+)) +'
+    r'(?:(?P<syslog5424_sd>\[.*?\]) +|- +|)(?P<message>.*)', re.S)
+NAMES = FIELDS + ('syslog5424_sd',)
+
+
+def regex_header(line):
+    match = HEADER.match(line)
+    if match is None:
+        return None
+    groups = match.groupdict()
+    return ([(name, groups[name]) for name in NAMES
+             if groups[name] is not None], groups['message'])
+
+
+def corpus(count):
+    lines = heroku_lines(count)
+    # a few lines heroku does not send
+    lines[::7] = ['<13>1 - h app - ID7 [a x="]"] msg %d' % i
+                  for i in range(len(lines[::7]))]
+    lines[::11] = ['no header %d' % i for i in range(len(lines[::11]))]
+    return lines
+
+
+def best_of(repeat, fn, lines):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        results = [fn(line) for line in lines]
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    lines = corpus(args.lines)
+    expected = [regex_header(line) for line in lines]
+    for fn in (regex_header, parse_header):
+        best, results = best_of(args.repeat, fn, lines)
+        report(parser=fn.__name__, lines=len(lines),
+               identical=results == expected,
+               lines_per_sec=round(len(lines) / best),
+               ns_per_line=round(best / len(lines) * 1e9))
+
+    # the cost of the parsing in the envelope encoding
+    encoders = [('template', TemplateEncoder()),
+                ('header', FieldsEncoder(TemplateEncoder()))]
+    for name, encoder in encoders:
+        route = heroku_route('/heroku/v1/production/DummyAppName',
+                             encoder.parser_ver_suffix)
+        best, _ = best_of(args.repeat, partial(encoder.encode, route), lines)
+        report(encoder=name, lines=len(lines),
+               lines_per_sec=round(len(lines) / best),
+               ns_per_line=round(best / len(lines) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Reproducible benchmark suite of the ingest pipeline.
+
+Three layers run on the corpora of scripts.fakelog:
+micro: Splitter.split, the envelope encoding and the plugin chain;
+handler: HerokuHandler driven by a tornado AsyncHTTPTestCase, publishing
+to the simulated broker;
+http: the application served by a forked process, loaded over keep-alive
+connections.
+
+Every result is a JSON line with lines_per_sec, p50_ms and p99_ms per
+request and the peak memory: peak_kb of the python allocations, or
+peak_rss_kb of the server process for the http layer.
+
+    python -m benchmarks.suite [--layer L] [--corpus C] [--output FILE]
+        [--output-backend amqp|null]
+    python -m benchmarks.suite --compare BASELINE [CURRENT] [--threshold %]
+
+Compare flags the results worse than the baseline by more than threshold
+percent and exits with status 1 if any.
+"""
+from argparse import ArgumentParser
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+from time import perf_counter
+import tracemalloc
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port
+
+from benchmarks import percentile, report
+from benchmarks.broker import simulated_broker
+from heroku2elk import main as h2l
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.envelope import make_encoder
+from heroku2elk.lib.plugins import LineFilter, PluginChain
+from heroku2elk.lib.routes import heroku_route
+from heroku2elk.lib.syslog import Splitter
+from scripts.fakelog import CORPORA, drain_bodies
+
+
+LAYERS = ('micro', 'handler', 'http')
+URI = '/heroku/v1/production/DummyAppName'
+# metrics compared, True when higher is better
+METRICS = {'lines_per_sec': True, 'p50_ms': False, 'p99_ms': False,
+           'peak_kb': False, 'peak_rss_kb': False}
+
+
+def summary(latencies, lines, elapsed):
+    return dict(requests=len(latencies),
+                lines_per_sec=round(lines / elapsed),
+                p50_ms=round(percentile(latencies, 50) * 1000, 3),
+                p99_ms=round(percentile(latencies, 99) * 1000, 3))
+
+
+def measure(fn, items, lines, repeat):
+    """ time fn over every item, repeat times, then once more tracing the
+    python allocations
+    """
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            start = perf_counter()
+            fn(item)
+            latencies.append(perf_counter() - start)
+    result = summary(latencies, lines * repeat, sum(latencies))
+    tracemalloc.start()
+    for item in items:
+        fn(item)
+    result['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    return result
+
+
+def micro(conf, bodies, repeat):
+    splitter = Splitter(conf, LineFilter(conf))
+    encoder = make_encoder(conf)
+    route = heroku_route(URI, encoder.parser_ver_suffix)
+    chain = PluginChain.compile(conf, 'heroku', 'v1')
+    logs = [splitter.split(body) for body in bodies]
+    payloads = [[encoder.encode(route, log) for log in lines]
+                for lines in logs]
+    lines = sum(map(len, logs))
+
+    yield 'split', measure(splitter.split, bodies, lines, repeat)
+    yield 'encode', measure(
+        lambda lines: [encoder.encode(route, log) for log in lines],
+        logs, lines, repeat)
+    yield 'plugins', measure(chain, payloads, lines, repeat)
+
+
+class HandlerBench(AsyncHTTPTestCase):
+    'post the drain requests in the IOLoop of a tornado test case'
+
+    def __init__(self, conf):
+        super().__init__()
+        self.conf = conf
+
+    def runTest(self):
+        pass
+
+    def get_app(self):
+        self.app = h2l.make_app(self.conf)
+        return self.app
+
+    def tearDown(self):
+        h2l.close_app(self.app)
+        super().tearDown()
+
+    async def post(self, bodies):
+        latencies = []
+        for body in bodies:
+            start = perf_counter()
+            await self.http_client.fetch(self.get_url(URI), method='POST',
+                                         body=body)
+            latencies.append(perf_counter() - start)
+        return latencies
+
+    def run_bench(self, bodies, lines, repeat):
+        latencies = []
+        for _ in range(repeat):
+            latencies.extend(self.io_loop.run_sync(
+                lambda: self.post(bodies), timeout=600))
+        result = summary(latencies, lines * repeat, sum(latencies))
+        tracemalloc.start()
+        self.io_loop.run_sync(lambda: self.post(bodies), timeout=600)
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+        return result
+
+
+def handler(conf, bodies, repeat):
+    lines = sum(body.count(b' <40>1 ') for body in bodies)
+    bench = HandlerBench(conf)
+    with simulated_broker(count_bytes=False):
+        bench.setUp()
+        try:
+            yield 'heroku', bench.run_bench(bodies, lines, repeat)
+        finally:
+            bench.tearDown()
+
+
+def serve(conf, sock, conn):
+    'serve the application on sock, until SIGTERM, in a forked process'
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    with simulated_broker(count_bytes=False):
+        app = h2l.make_app(conf)
+        server = HTTPServer(app)
+        server.add_sockets([sock])
+        ioloop = IOLoop.current()
+        ioloop.asyncio_loop.add_signal_handler(signal.SIGTERM, ioloop.stop)
+        ioloop.add_callback(conn.send, 'ready')
+        ioloop.start()
+        server.stop()
+        h2l.close_app(app)
+    conn.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+async def load(url, bodies, repeat, concurrency):
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    todo = [body for _ in range(repeat) for body in bodies]
+    latencies = []
+
+    async def worker():
+        while todo:
+            body = todo.pop()
+            start = perf_counter()
+            await client.fetch(url, method='POST', body=body)
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = perf_counter() - start
+    client.close()
+    return latencies, elapsed
+
+
+def http(conf, bodies, repeat, concurrency):
+    lines = sum(body.count(b' <40>1 ') for body in bodies)
+    sock, port = bind_unused_port()
+    context = multiprocessing.get_context('fork')
+    conn, child_conn = context.Pipe()
+    server = context.Process(target=serve, args=(conf, sock, child_conn))
+    server.start()
+    sock.close()
+    try:
+        conn.recv()
+        url = 'http://127.0.0.1:%d%s' % (port, URI)
+        latencies, elapsed = asyncio.run(
+            load(url, bodies, repeat, concurrency))
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+    result = summary(latencies, lines * repeat, elapsed)
+    result['concurrency'] = concurrency
+    result['peak_rss_kb'] = conn.recv()
+    server.join()
+    return [('heroku', result)]
+
+
+def run(args):
+    results = []
+    for corpus in args.corpus or CORPORA:
+        bodies = drain_bodies(args.requests, args.lines, corpus, args.seed)
+        for layer in args.layer or LAYERS:
+            conf = MainConfig()
+            conf.output = args.output_backend
+            if layer == 'micro':
+                benches = micro(conf, bodies, args.repeat)
+            elif layer == 'handler':
+                benches = handler(conf, bodies, args.repeat)
+            else:
+                benches = http(conf, bodies, args.repeat, args.concurrency)
+            for bench, result in benches:
+                result.update(layer=layer, bench=bench, corpus=corpus,
+                              output=args.output_backend,
+                              bytes=sum(map(len, bodies)))
+                report(**result)
+                results.append(result)
+    return results
+
+
+def key(result):
+    return (result['layer'], result['bench'], result['corpus'],
+            result.get('output', 'amqp'))
+
+
+def load_results(path):
+    with open(path) as results:
+        return [json.loads(line) for line in results if line.strip()]
+
+
+def compare(baseline, current, threshold):
+    'report the changes from baseline, return True if any regressed'
+    baseline = {key(result): result for result in baseline}
+    regressed = False
+    for result in current:
+        base = baseline.get(key(result))
+        if base is None:
+            continue
+        changes, regressions = {}, []
+        for metric, higher_is_better in METRICS.items():
+            if not base.get(metric) or metric not in result:
+                continue
+            change = (result[metric] - base[metric]) / base[metric] * 100
+            changes[metric + '_change'] = round(change, 1)
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(metric)
+        regressed = regressed or bool(regressions)
+        report(layer=result['layer'], bench=result['bench'],
+               corpus=result['corpus'], output=result.get('output', 'amqp'),
+               regressions=regressions, **changes)
+    return regressed
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--layer', action='append', choices=LAYERS)
+    parser.add_argument('--corpus', action='append', choices=CORPORA)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=50,
+                        help='log lines per request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-backend', default='amqp',
+                        choices=['amqp', 'null'],
+                        help='amqp publishes to the simulated broker, '
+                             'null measures the pipeline alone')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='baseline results, and the current ones '
+                             'instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='regression threshold in percent')
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) > 1:
+        current = load_results(args.compare[1])
+    else:
+        current = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.writelines(json.dumps(result, sort_keys=True) + '\n'
+                              for result in current)
+    if args.compare and compare(load_results(args.compare[0]), current,
+                                args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,25 @@ def _get_mod(name, default_mod):
         return getattr(import_module(mods), obj)
 
 
+def _convert_output_conf(def_):
+    'the output of each api given as 4th field of HANDLERS entries'
+    res = {}
+    for d in def_.split(','):
+        name, *rest = d.split(':')
+        if len(rest) > 2:
+            res[rest[0]] = rest[2]
+    return res
+
+
+def _convert_rate_limits(def_):
+    'the (rate, burst) of each app:rate[:burst] entry, burst is rate if unset'
+    res = {}
+    for d in filter(None, def_.split(',')):
+        app, rate, *burst = d.strip().split(':')
+        res[app] = (float(rate), float(burst[0] if burst else rate))
+    return res
+
+
 def _convert_bare_conf_to_dict(def_, default_mod):
 
     res = defaultdict(lambda: defaultdict(list))
@@ -79,12 +98,26 @@ class MainConfig:
         self.tornado_multiprocessing_activated = get(
                      'TORNADO_MULTIPROCESSING_ACTIVATED', 'true') == 'true'
         self.tornado_debug = get('TORNADO_DEBUG', 'false') == 'true'
+        # worker processes (0: one per core), supervised and restarted
+        # after a jittered exponential backoff when they crash
+        self.workers = int(get('WORKERS', '0'))
+        self.worker_restart_min_delay = float(get(
+                                        'WORKER_RESTART_MIN_DELAY', '0.5'))
+        self.worker_restart_max_delay = float(get(
+                                        'WORKER_RESTART_MAX_DELAY', '30'))
+        # each worker binds its own socket and the kernel balances the
+        # connections, instead of workers sharing the supervisor's socket
+        self.reuse_port = get('REUSE_PORT', 'false') == 'true'
+        # asyncio event loop of tornado: 'asyncio' or 'uvloop' when installed
+        self.event_loop = get('EVENT_LOOP', 'asyncio')
         self.environments = get('ENVIRONMENTS', 'main').split(',')
-        self.handlers = _convert_bare_conf_to_dict(
-                             get('HANDLERS', 'HerokuHandler:heroku:v1,'
-                                 'HealthCheckHandler:api:healthcheck,'
-                                 'HealthCheckHandler:api:heartbeat'),
-                             'heroku2elk.lib.handlers')
+        handlers = get('HANDLERS', 'HerokuHandler:heroku:v1,'
+                       'HealthCheckHandler:api:healthcheck,'
+                       'HealthCheckHandler:api:heartbeat')
+        self.handlers = _convert_bare_conf_to_dict(handlers,
+                                                   'heroku2elk.lib.handlers')
+        # name:api:ver:output entries publish the api to another output
+        self.handler_outputs = _convert_output_conf(handlers)
         self.plugins = _convert_bare_conf_to_dict(
                          get('PLUGINS', 'truncate,obfuscate_token:heroku:v1'),
                          'heroku2elk.lib.plugins')
@@ -92,12 +125,94 @@ class MainConfig:
         self.metrics_host = get('METRICS_HOST', 'localhost')
         self.metrics_port = int(get('METRICS_PORT', '8125'))
         self.metrics_prefix = get('METRICS_PREFIX', 'heroku2logstash')
+        # metrics are aggregated and sent every METRICS_FLUSH_INTERVAL ms,
+        # in UDP packets of at most METRICS_PACKET_SIZE bytes
+        self.metrics_flush_interval = float(get('METRICS_FLUSH_INTERVAL',
+                                                '1000'))
+        self.metrics_packet_size = int(get('METRICS_PACKET_SIZE', '1432'))
+
+        # lines per second of the heroku drains of an app and of an env,
+        # 0 for unlimited, over which lines are dropped or 'sample'd
+        self.rate_limit_activated = get('RATE_LIMIT_ACTIVATION',
+                                        'false') == 'true'
+        self.rate_limit_app_rate = float(get('RATE_LIMIT_APP_RATE', '1000'))
+        self.rate_limit_app_burst = float(get('RATE_LIMIT_APP_BURST', '5000'))
+        self.rate_limit_env_rate = float(get('RATE_LIMIT_ENV_RATE', '0'))
+        self.rate_limit_env_burst = float(get('RATE_LIMIT_ENV_BURST', '0'))
+        # app:rate[:burst] entries replacing the app limits
+        self.rate_limit_overrides = _convert_rate_limits(
+                                        get('RATE_LIMIT_OVERRIDES', ''))
+        self.rate_limit_mode = get('RATE_LIMIT_MODE', 'drop')
+        # fraction of the lines over the limits kept, in ]0, 1]
+        self.rate_limit_sample_rate = float(get('RATE_LIMIT_SAMPLE_RATE',
+                                                '0.1'))
+        if not 0 < self.rate_limit_sample_rate <= 1:
+            raise ValueError('RATE_LIMIT_SAMPLE_RATE must be in ]0, 1]: %s'
+                             % self.rate_limit_sample_rate)
+        self.rate_limit_idle_seconds = float(get('RATE_LIMIT_IDLE_SECONDS',
+                                                 '300'))
+        # gzip and deflate request bodies are decompressed up to this size,
+        # -1 for no limit
+        self.decompress_max_bytes = int(get('DECOMPRESS_MAX_BYTES',
+                                            str(2**26)))
+        # streaming handlers cap the size of a frame instead of the body
+        self.max_frame_size = int(get('MAX_FRAME_SIZE', str(2**20)))
+        self.max_body_size = int(get('STREAM_MAX_BODY_SIZE', str(2**40)))
 
         self.truncate_activated = get('TRUNCATE_ACTIVATION', 'true') == 'true'
         self.truncate_max_msg_length = int(get(
                                         'TRUNCATE_MAX_MSG_LENGTH', '1000'))
         self.stack_pattern = get('TRUNCATE_EXCEPT_STACK_PATTERN', 'stack')
         self.token_pattern = get('REPLACE_TOKEN_PATTERN', '(token":")(.*?)(")')
+        # where log lines are truncated and obfuscated: 'splitter' filters
+        # each raw line once, 'plugins' leaves it to the plugin chain
+        self.filter_stage = get('FILTER_STAGE', 'splitter')
+        # request URIs whose parsed route is kept
+        self.route_cache_size = int(get('ROUTE_CACHE_SIZE', '1024'))
+        # HerokuHandler splits, filters and encodes the payloads of at least
+        # OFFLOAD_MIN_BYTES in a pool of OFFLOAD_WORKERS processes
+        self.offload_activated = get('OFFLOAD_ACTIVATION', 'false') == 'true'
+        self.offload_min_bytes = int(get('OFFLOAD_MIN_BYTES', str(2**20)))
+        self.offload_workers = int(get('OFFLOAD_WORKERS', '1'))
+        # 'template' splices each message into the serialized static fields
+        # of the envelope, 'dict' serializes the whole envelope; with the
+        # JSON_BACKEND module ('auto', 'json', 'orjson' or 'ujson')
+        self.envelope_encoder = get('ENVELOPE_ENCODER', 'template')
+        self.json_backend = get('JSON_BACKEND', 'auto')
+        # parse the RFC 5424 header of the heroku lines into envelope fields
+        # and publish them with a '-rfc5424' suffixed parser version, so
+        # that logstash does not grok them
+        self.rfc5424_activated = get('RFC5424_ACTIVATION', 'false') == 'true'
+        # keys of the JSON messages published as app_<key> envelope fields,
+        # with a '-json' suffixed parser version (logstash used msg, level,
+        # hostname, pid, driverId, userId and requestId)
+        self.json_fields = [key for key in get('JSON_FIELDS', '').split(',')
+                            if key]
+
+        # where the envelopes are published: 'amqp', 'null' (discarded, to
+        # benchmark) or 'file' (appended to OUTPUT_FILE_PATH, buffered)
+        self.output = get('OUTPUT', 'amqp')
+        self.output_file_path = get('OUTPUT_FILE_PATH', 'output.ndjson')
+        self.output_file_buffer_bytes = int(get('OUTPUT_FILE_BUFFER_BYTES',
+                                                str(2**20)))
+        self.output_file_flush_interval = float(get(
+                                        'OUTPUT_FILE_FLUSH_INTERVAL', '1'))
+        # 'logstash' writes json lines to the tcp inputs of LOGSTASH_HOSTS
+        # (host:port,...) over LOGSTASH_POOL_SIZE connections each, in
+        # writes of up to LOGSTASH_MAX_WRITE_BYTES; 503 is replied once
+        # LOGSTASH_MAX_BUFFER_BYTES wait for a connection
+        self.logstash_hosts = get('LOGSTASH_HOSTS', 'localhost:5000')
+        self.logstash_pool_size = int(get('LOGSTASH_POOL_SIZE', '2'))
+        self.logstash_max_write_bytes = int(get('LOGSTASH_MAX_WRITE_BYTES',
+                                                str(2**18)))
+        self.logstash_max_buffer_bytes = int(get('LOGSTASH_MAX_BUFFER_BYTES',
+                                                 str(2**25)))
+        self.logstash_connect_timeout = float(get('LOGSTASH_CONNECT_TIMEOUT',
+                                                  '5'))
+        self.logstash_reconnect_min_delay = float(get(
+                                        'LOGSTASH_RECONNECT_MIN_DELAY', '0.5'))
+        self.logstash_reconnect_max_delay = float(get(
+                                        'LOGSTASH_RECONNECT_MAX_DELAY', '30'))
 
         self.amqp_activated = get('AMQP_ACTIVATION', 'true') == 'true'
         self.exchange = get('AMQP_MAIN_EXCHANGE', 'logs')
@@ -105,6 +220,48 @@ class MainConfig:
         self.port = int(get('AMQP_PORT', 5672))
         self.user = get('AMQP_USER', 'guest')
         self.password = get('AMQP_PASSWORD', 'guest')
+        # channels with publisher confirms opened on each connection
+        self.amqp_channel_pool_size = int(get('AMQP_CHANNEL_POOL_SIZE', '1'))
+        # reply to the drains once the broker confirmed every line
+        self.amqp_wait_confirms = get('AMQP_WAIT_CONFIRMS', 'false') == 'true'
+        self.amqp_confirm_timeout = float(get('AMQP_CONFIRM_TIMEOUT', '5'))
+        # unconfirmed messages kept per worker before replying 503 (-1: no
+        # limit), the drains are asked to retry after RETRY_AFTER seconds
+        self.amqp_outbound_max_messages = int(get(
+                                    'AMQP_OUTBOUND_MAX_MESSAGES', '100000'))
+        self.amqp_outbound_max_bytes = int(get('AMQP_OUTBOUND_MAX_BYTES',
+                                               str(2**27)))
+        self.retry_after = int(get('RETRY_AFTER', '5'))
+        # spool the messages on disk while the broker is unreachable, and
+        # replay them at SPOOL_REPLAY_RATE messages/s once reconnected
+        self.spool_activated = get('SPOOL_ACTIVATION', 'false') == 'true'
+        self.spool_dir = get('SPOOL_DIR', 'spool')
+        self.spool_max_bytes = int(get('SPOOL_MAX_BYTES', str(2**30)))
+        self.spool_segment_bytes = int(get('SPOOL_SEGMENT_BYTES', str(2**24)))
+        self.spool_fsync_interval = float(get('SPOOL_FSYNC_INTERVAL', '1'))
+        if self.spool_fsync_interval <= 0:
+            raise ValueError('SPOOL_FSYNC_INTERVAL must be positive: %s'
+                             % self.spool_fsync_interval)
+        self.spool_replay_rate = float(get('SPOOL_REPLAY_RATE', '5000'))
+        # compress the messages of at least PUBLISH_COMPRESSION_MIN_BYTES
+        # with 'zlib' or 'gzip' (their AMQP content_encoding), '' for none
+        self.publish_compression = get('PUBLISH_COMPRESSION', '')
+        self.publish_compression_level = int(get(
+                                        'PUBLISH_COMPRESSION_LEVEL', '1'))
+        self.publish_compression_min_bytes = int(get(
+                                    'PUBLISH_COMPRESSION_MIN_BYTES', '1024'))
+        # publish the heroku envelopes in newline delimited batches
+        self.amqp_batch_activated = get('AMQP_BATCH_ACTIVATION',
+                                        'false') == 'true'
+        self.amqp_batch_max_lines = int(get('AMQP_BATCH_MAX_LINES', '500'))
+        self.amqp_batch_max_bytes = int(get('AMQP_BATCH_MAX_BYTES',
+                                            str(2**18)))
+        self.amqp_batch_linger_ms = float(get('AMQP_BATCH_LINGER_MS', '5'))
+        # jittered exponential backoff between reconnection attempts (s)
+        self.amqp_reconnect_min_delay = float(get(
+                                        'AMQP_RECONNECT_MIN_DELAY', '0.5'))
+        self.amqp_reconnect_max_delay = float(get(
+                                        'AMQP_RECONNECT_MAX_DELAY', '30'))
 
     def close(self):
         logging.shutdown()
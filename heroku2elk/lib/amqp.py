@@ -1,44 +1,441 @@
-from tornado import gen
+from asyncio import ensure_future
+from collections import OrderedDict, deque
+from functools import partial
+from os import getpid, path
+from random import uniform
+from time import perf_counter
+
 from tornado.concurrent import Future
 import logging
 import pika
-from tornado.ioloop import IOLoop
-from statsd import StatsClient
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from heroku2elk.lib.compression import Compressor
+from heroku2elk.lib.metrics import get_metrics
+from heroku2elk.lib.spool import Spool, SpoolFull, SpoolReplayer
+from heroku2elk.lib.supervisor import worker_id
+
+
+class DeliveryError(Exception):
+    'the broker did not confirm the delivery of a message'
+
+
+class NackError(DeliveryError):
+    'the broker rejected a message'
+
+
+class BufferFull(DeliveryError):
+    'too many messages are waiting to be confirmed by the broker'
+
+
+class OutboundBuffer:
+    """ Account for the messages of a worker which are not confirmed by the
+    broker yet: waiting for a channel, in pika's output buffer or in flight.
+    Publishing fails with BufferFull past max_messages or max_bytes (-1 for
+    no limit) instead of letting the memory grow while the broker is slow.
+    """
+
+    def __init__(self, max_messages=-1, max_bytes=-1):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.bytes = 0
+        # the deepest the buffer has been since the last report
+        self.high_water = 0
+
+    def reserve(self, size):
+        if -1 < self.max_messages <= self.messages or \
+                -1 < self.max_bytes < self.bytes + size:
+            raise BufferFull('outbound buffer full: %d messages, %d bytes'
+                             % (self.messages, self.bytes))
+        self.messages += 1
+        self.bytes += size
+        if self.messages > self.high_water:
+            self.high_water = self.messages
+
+    def release(self, messages, size):
+        self.messages -= messages
+        self.bytes -= size
+
+    def reset_high_water(self):
+        high_water, self.high_water = self.high_water, self.messages
+        return high_water
+
+
+class PooledChannel:
+    """ A channel of the AMQP connection pool with delivery confirmations
+    enabled: it keeps its own delivery tags to know how many messages are
+    published and not confirmed yet (in flight).
+    """
+
+    def __init__(self, index, channel, buffer=None):
+        self.index = index
+        self.channel = channel
+        # released as the messages are confirmed
+        self.buffer = buffer if buffer is not None else OutboundBuffer()
+        self.delivery_tag = 0
+        # delivery tags waiting for a confirmation, in publishing order,
+        # mapped to the (size, confirmation future) of the message, the
+        # future is only created when the confirmation is awaited
+        self.unconfirmed = OrderedDict()
+        # (deadline, delivery tag) of the awaited confirmations, a single
+        # timeout expires them as they are in publishing order too
+        self.deadlines = deque()
+        self._expire_timeout = None
+
+    @property
+    def in_flight(self):
+        return len(self.unconfirmed)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        """ Publish a message already reserved in the buffer, return its
+        delivery tag.
+        """
+        self.channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                                   body=body, properties=properties,
+                                   mandatory=mandatory)
+        self.delivery_tag += 1
+        self.unconfirmed[self.delivery_tag] = (len(body), None)
+        return self.delivery_tag
+
+    def wait_confirm(self, delivery_tag, timeout):
+        """ Return a future resolved when the broker confirms the delivery,
+        failed with DeliveryError if not confirmed after timeout seconds.
+        """
+        future = Future()
+        size, _ = self.unconfirmed[delivery_tag]
+        self.unconfirmed[delivery_tag] = (size, future)
+        ioloop = IOLoop.current()
+        self.deadlines.append((ioloop.time() + timeout, delivery_tag))
+        if self._expire_timeout is None:
+            self._expire_timeout = ioloop.call_at(self.deadlines[0][0],
+                                                  self.expire)
+        return future
+
+    def expire(self):
+        'fail the confirmations awaited for too long'
+        ioloop = IOLoop.current()
+        now, deadlines = ioloop.time(), self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            delivery_tag = deadlines.popleft()[1]
+            size, future = self.unconfirmed.pop(delivery_tag, (0, None))
+            if future is not None:
+                # may still be confirmed, but the broker is too slow to
+                # count it in the buffer any longer
+                self.buffer.release(1, size)
+                future.set_exception(DeliveryError(
+                    'delivery %d not confirmed in time' % delivery_tag))
+        self._expire_timeout = None
+        self.prune_deadlines()
+        if deadlines:
+            self._expire_timeout = ioloop.call_at(deadlines[0][0],
+                                                  self.expire)
+
+    def prune_deadlines(self):
+        deadlines, unconfirmed = self.deadlines, self.unconfirmed
+        while deadlines and deadlines[0][1] not in unconfirmed:
+            deadlines.popleft()
+
+    def confirm(self, delivery_tag, multiple=False, ack=True):
+        """ Resolve the futures of the confirmed delivery tags, every tag up
+        to delivery_tag when multiple is set. Return the number of confirmed
+        messages.
+        """
+        unconfirmed = self.unconfirmed
+        if multiple:
+            messages = []
+            while unconfirmed and next(iter(unconfirmed)) <= delivery_tag:
+                messages.append(unconfirmed.popitem(last=False)[1])
+        elif delivery_tag in unconfirmed:
+            messages = [unconfirmed.pop(delivery_tag)]
+        else:
+            return 0
+        self.buffer.release(len(messages),
+                            sum(size for size, _ in messages))
+        for _, future in messages:
+            if future is None:
+                continue
+            if ack:
+                future.set_result(True)
+            else:
+                future.set_exception(NackError(
+                    'delivery %d rejected by the broker' % delivery_tag))
+        self.prune_deadlines()
+        return len(messages)
+
+    def fail(self, error):
+        'fail the messages waiting for a confirmation'
+        unconfirmed, self.unconfirmed = self.unconfirmed, OrderedDict()
+        self.deadlines.clear()
+        if self._expire_timeout is not None:
+            IOLoop.current().remove_timeout(self._expire_timeout)
+            self._expire_timeout = None
+        self.buffer.release(len(unconfirmed),
+                            sum(size for size, _ in unconfirmed.values()))
+        for _, future in unconfirmed.values():
+            if future is not None:
+                future.set_exception(DeliveryError(error))
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
 
 
 class AMQPConnectionSingleton:
+    """ Give access to the AMQP connection of the current process, the
+    connection is opened on first use and kept open (reconnected if needed)
+    until close_channel is called.
+    """
 
     __instance = None
 
-    @gen.coroutine
     def get_channel(self, conf, ioloop=None):
-        if ioloop is None:
-            ioloop = IOLoop.current()
+        return self.get_connection(conf, ioloop).get_channel()
+
+    def publish(self, conf, routing_key, body, properties=None):
+        """ Publish a message, or spool it while the broker is unreachable
+        when the spool is activated. Fail with BufferFull at once when the
+        outbound buffer (or the spool) is full.
+        :return: a future resolved once the message is published, or
+        confirmed by the broker with AMQP_WAIT_CONFIRMS
+        """
+        ins = self.get_connection(conf)
+        if not ins.spooling(routing_key):
+            return ins.publish(routing_key, body, properties,
+                               confirm=conf.amqp_wait_confirms)
+        future = Future()
+        try:
+            ins.spool_message(routing_key, body, properties)
+        except BufferFull as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+        return future
+
+    def get_connection(self, conf, ioloop=None):
         ins = AMQPConnectionSingleton.__instance
-        if ins is None:
-            conn = AMQPConnectionSingleton.AMQPConnection(conf)
-            ins = yield conn.create_amqp_client(ioloop)
+        # a forked process must not share its parent's connection
+        if ins is None or ins.pid != getpid():
+            if ioloop is None:
+                ioloop = IOLoop.current()
+            ins = AMQPConnectionSingleton.AMQPConnection(conf)
+            ins.create_amqp_client(ioloop)
+            AMQPConnectionSingleton.__instance = ins
         return ins
 
     def close_channel(self):
-        if AMQPConnectionSingleton.__instance:
-            AMQPConnectionSingleton.__instance.close()
+        ins = AMQPConnectionSingleton.__instance
+        if ins is not None and ins.pid == getpid():
+            ins.close()
         AMQPConnectionSingleton.__instance = None
 
     class AMQPConnection:
+
+        # connection states
+        CLOSED = 'closed'
+        CONNECTING = 'connecting'
+        OPEN = 'open'
+        WAITING = 'waiting'  # for the next reconnection attempt
+        CLOSING = 'closing'
+
         def __init__(self, conf):
             self._connection = None
             self._channel = None
+            # the channel pool, None for a channel being (re)opened
+            self._channels = []
+            self._next_channel = 0
+            self._ioloop = None
+            self._reconnect_timeout = None
             self.config = conf
-            self.future_channel = Future()
+            self.pid = getpid()
+            self.state = self.CLOSED
+            self.closing = False
+            # consecutive failed connection attempts
+            self.attempts = 0
+            # created on demand, shared by the waiters
+            self.future_channel = None
+            self.buffer = OutboundBuffer(conf.amqp_outbound_max_messages,
+                                         conf.amqp_outbound_max_bytes)
             self.logger = logging.getLogger("tornado.application")
-            self.statsdClient = StatsClient(
-                self.config.metrics_host,
-                self.config.metrics_port,
-                prefix=self.config.metrics_prefix)
+            self.statsdClient = get_metrics(conf)
+            self.compressor = None
+            if conf.publish_compression:
+                self.compressor = Compressor(
+                    conf.publish_compression, conf.publish_compression_level,
+                    conf.publish_compression_min_bytes)
+                # properties of the compressed messages per content type
+                self.compressed_properties = {}
+            self.spool = self.replayer = None
+            if conf.spool_activated:
+                # a directory per worker, kept across restarts
+                self.spool = Spool(path.join(conf.spool_dir, 'worker-%d'
+                                             % (worker_id() or 0)),
+                                   conf.spool_max_bytes,
+                                   conf.spool_segment_bytes,
+                                   conf.spool_fsync_interval)
+                self.replayer = SpoolReplayer(self.spool, self,
+                                              conf.spool_replay_rate)
+                self.spool_flusher = PeriodicCallback(
+                    self.spool.flush, conf.spool_fsync_interval * 1000)
+                self.spool_flusher.start()
+
+        def publish(self, routing_key, body, properties=None, confirm=False,
+                    channel=None):
+            """ Publish a message on the given channel, or on one of the
+            pool: at once when a channel is open, else once one is.
+            :return: a future resolved once the message is published, or
+            confirmed by the broker if confirm is set
+            """
+            if self.compressor is not None and \
+                    len(body) >= self.compressor.min_bytes:
+                body, properties = self.compress(body, properties)
+            try:
+                self.reserve(len(body))
+            except BufferFull as e:
+                future = Future()
+                future.set_exception(e)
+                return future
+            if channel is None and self.state == self.OPEN:
+                channel = self.select_channel()
+            if channel is None:
+                return ensure_future(self.publish_later(
+                    routing_key, body, properties, confirm))
+            return self.send(channel, routing_key, body, properties, confirm)
+
+        async def publish_later(self, routing_key, body, properties,
+                                confirm):
+            try:
+                channel = await self.get_channel()
+            except Exception:
+                # the message never reached a channel
+                self.buffer.release(1, len(body))
+                raise
+            await self.send(channel, routing_key, body, properties, confirm)
+
+        def send(self, channel, routing_key, body, properties, confirm):
+            'basic_publish a message reserved in the outbound buffer'
+            future = Future()
+            try:
+                if properties is None:
+                    properties = self.properties()
+                delivery_tag = channel.basic_publish(
+                    exchange=self.config.exchange, routing_key=routing_key,
+                    body=body, properties=properties, mandatory=True)
+            except Exception as e:
+                # the message never reached a channel
+                self.buffer.release(1, len(body))
+                future.set_exception(e)
+                return future
+            if confirm:
+                # the message is safe once the broker has confirmed it
+                return channel.wait_confirm(delivery_tag,
+                                            self.config.amqp_confirm_timeout)
+            future.set_result(None)
+            return future
+
+        @staticmethod
+        def properties(content_type=None, content_encoding=None):
+            return pika.BasicProperties(
+                # make message persistent
+                delivery_mode=1,
+                content_type=content_type,
+                content_encoding=content_encoding)
+
+        def compress(self, body, properties):
+            """ compress a message, spooled messages are compressed when
+            they are replayed
+            :return: its compressed body and properties
+            """
+            if isinstance(body, str):
+                body = body.encode()
+            start = perf_counter()
+            compressed = self.compressor.compress(body)
+            statsd = self.statsdClient
+            statsd.incr('amqp.compression.bytes_in', count=len(body))
+            statsd.incr('amqp.compression.bytes_out', count=len(compressed))
+            statsd.incr('amqp.compression.us',
+                        count=int((perf_counter() - start) * 1e6))
+            content_type = properties and properties.content_type
+            encoded = self.compressed_properties.get(content_type)
+            if encoded is None:
+                encoded = self.compressed_properties[content_type] = \
+                    self.properties(content_type, self.compressor.encoding)
+            return compressed, encoded
+
+        def spooling(self, routing_key):
+            """ Whether the messages of a routing key go to the spool: while
+            the connection is not open, and until the spooled messages of
+            the key are replayed, to keep the order of each app.
+            """
+            return self.spool is not None and (
+                self.state != self.OPEN or
+                routing_key in self.spool.pending_keys)
+
+        def spool_message(self, routing_key, body, properties=None):
+            try:
+                self.spool.append(routing_key, body,
+                                  properties and properties.content_type)
+            except SpoolFull as e:
+                self.statsdClient.incr('spool.full', count=1)
+                raise BufferFull(str(e)) from e
+            self.statsdClient.incr('spool.written', count=1)
+            self.statsdClient.gauge('spool.bytes', self.spool.size)
+
+        def get_channel(self):
+            """ Return a future of the channel, waiters share the same
+            future while the connection is (re)established.
+            """
+            if self.state == self.OPEN:
+                channel = self.select_channel()
+                if channel is not None:
+                    future = Future()
+                    future.set_result(channel)
+                    return future
+            if self.future_channel is None:
+                self.future_channel = Future()
+            return self.future_channel
+
+        def reserve(self, size):
+            'count a message in the outbound buffer, or raise BufferFull'
+            try:
+                self.buffer.reserve(size)
+            except BufferFull:
+                self.statsdClient.incr('amqp.outbound.full', count=1)
+                # confirmations, which report it too, may have stopped
+                self.report_buffer()
+                raise
+
+        def report_buffer(self):
+            buffer = self.buffer
+            self.statsdClient.gauge('amqp.outbound.messages', buffer.messages)
+            self.statsdClient.gauge('amqp.outbound.bytes', buffer.bytes)
+            self.statsdClient.gauge('amqp.outbound.high_water',
+                                    buffer.reset_high_water())
+
+        def select_channel(self):
+            """ Return the open channel of the pool with the fewest messages
+            in flight, ties are broken round-robin.
+            """
+            channels, best = self._channels, None
+            count = len(channels)
+            for i in range(count):
+                pooled = channels[(self._next_channel + i) % count]
+                if pooled is not None and (best is None or
+                                           pooled.in_flight < best.in_flight):
+                    best = pooled
+            if count:
+                self._next_channel = (self._next_channel + 1) % count
+            return best
+
+        def in_flight(self):
+            'messages published and not confirmed yet, per channel index'
+            return {pooled.index: pooled.in_flight
+                    for pooled in self._channels if pooled is not None}
 
-        @gen.coroutine
         def on_exchange_declareok(self, unused_frame):
+            self._ioloop.spawn_callback(self.declare_queues)
+
+        async def declare_queues(self):
             from heroku2elk.lib.handlers import GenericAMQPHandler
             # Declare the queues
             for api, _ in self.config.handlers.items():
@@ -47,12 +444,26 @@ class AMQPConnectionSingleton:
                                    issubclass(h, GenericAMQPHandler),
                                    hdls)):
                         for env in self.config.environments:
-                            yield self.declare_queue("%s_%s_queue"
+                            await self.declare_queue("%s_%s_queue"
                                                      % (api, env))
-            self.logger.info("Exchange is declared:{} host:{} port:{}"
+            self.logger.info("Exchange is declared:{} host:{} port:{}"
                              .format(self.config.exchange,
                                      self.config.host, self.config.port))
-            self.future_channel.set_result(self._channel)
+            self.set_state(self.OPEN)
+            self.attempts = 0
+            self.resolve_waiters()
+            for index in range(1, len(self._channels)):
+                self.open_channel(index)
+            if self.replayer is not None:
+                self.replayer.start()
+
+        def resolve_waiters(self):
+            future = self.future_channel
+            if future is not None and not future.done():
+                channel = self.select_channel()
+                if channel is not None:
+                    self.future_channel = None
+                    future.set_result(channel)
 
         def declare_queue(self, name):
             future_result = Future()
@@ -66,20 +477,47 @@ class AMQPConnectionSingleton:
                                         auto_delete=False)
             return future_result
 
-        def on_connection_close(self, connection):
-            self.logger.error("AMQP is disconnected from exchange:{} "
-                              "host:{} port:{} connexion:{}".format(
+        def on_connection_close(self, connection, reply_code=None,
+                                reply_text=None):
+            self.logger.error("AMQP is disconnected from exchange:{} "
+                              "host:{} port:{} connexion:{} reason:{} {}"
+                              .format(self.config.exchange,
+                                      self.config.host, self.config.port,
+                                      connection, reply_code, reply_text))
+            self.fail_channels("AMQP connection closed")
+            self._connection = None
+            self._channel = None
+            if self.closing:
+                self.set_state(self.CLOSED)
+                self.fail_waiters("AMQP connection closed")
+            else:
+                self.schedule_reconnect("connection lost: {} {}".format(
+                    reply_code, reply_text))
+
+        def on_connection_error(self, connection, error):
+            self.logger.error("AMQP connection failed exchange:{} host:{} "
+                              "port:{} error:{}".format(
                                   self.config.exchange,
-                                  self.config.host, self.config.port,
-                                  connection))
+                                  self.config.host, self.config.port, error))
             self._connection = None
             self._channel = None
+            self._channels = []
+            if self.closing:
+                self.set_state(self.CLOSED)
+                self.fail_waiters("AMQP connection closed")
+            else:
+                self.schedule_reconnect(error)
 
         def on_connection_open(self, connection):
             self._connection = connection
+            if self.closing:
+                connection.close()
+                return
+            pool_size = max(1, self.config.amqp_channel_pool_size)
+            self._channels = [None] * pool_size
             connection.channel(on_open_callback=self.on_channel_open)
 
-            self.logger.info("AMQP is connected exchange:{} host:{} "
+            self.logger.info("AMQP is connected exchange:{} host:{} "
                              "port:{} connexion:{}".format(
                                  self.config.exchange,
                                  self.config.host, self.config.port,
@@ -90,20 +528,109 @@ class AMQPConnectionSingleton:
             channel.exchange_declare(self.on_exchange_declareok,
                                      exchange=self.config.exchange,
                                      exchange_type='topic')
+            self.add_channel(0, channel)
+
+        def open_channel(self, index):
+            self._connection.channel(
+                on_open_callback=partial(self.on_pool_channel_open, index))
+
+        def on_pool_channel_open(self, index, channel):
+            if self._connection is None or index >= len(self._channels):
+                # opened by a connection which is now closed
+                return
+            self.add_channel(index, channel)
+            if self.state == self.OPEN:
+                self.resolve_waiters()
+
+        def add_channel(self, index, channel):
             self.logger.info("channel open {}".format(channel))
+            pooled = PooledChannel(index, channel, self.buffer)
+            self._channels[index] = pooled
+            channel.add_on_close_callback(partial(self.on_channel_close,
+                                                  pooled))
             # Enabled delivery confirmations
-            self._channel.confirm_delivery(self.on_delivery_confirmation)
+            channel.confirm_delivery(partial(self.on_delivery_confirmation,
+                                             pooled=pooled))
 
-        def on_delivery_confirmation(self, method_frame):
+        def on_channel_close(self, pooled, channel, reply_code, reply_text):
+            if self._channels[pooled.index:pooled.index + 1] != [pooled]:
+                # the whole pool is gone with the connection
+                return
+            self.logger.error("AMQP channel {} closed, reason:{} {}, {} "
+                              "messages were not confirmed".format(
+                                  channel, reply_code, reply_text,
+                                  pooled.in_flight))
+            self.statsdClient.incr('amqp.channel_closed', count=1)
+            self._channels[pooled.index] = None
+            pooled.fail("AMQP channel closed: {} {}".format(reply_code,
+                                                            reply_text))
+            # replace it transparently
+            if not self.closing and self._connection is not None and \
+                    self._connection.is_open:
+                self.open_channel(pooled.index)
+
+        def fail_channels(self, error):
+            channels, self._channels = self._channels, []
+            for pooled in channels:
+                if pooled is not None:
+                    pooled.fail(error)
+
+        def on_delivery_confirmation(self, method_frame, pooled=None):
             confirmation_type = method_frame.method.NAME.split('.')[1].lower()
+            count = 1
+            if pooled is not None:
+                count = pooled.confirm(method_frame.method.delivery_tag,
+                                       method_frame.method.multiple,
+                                       confirmation_type == 'ack')
+                self.statsdClient.gauge('amqp.channel_%d.in_flight'
+                                        % pooled.index, pooled.in_flight)
+                self.report_buffer()
             if confirmation_type == 'ack':
-                self.statsdClient.incr('amqp.output_delivered', count=1)
+                self.statsdClient.incr('amqp.output_delivered', count=count)
             elif confirmation_type == 'nack':
                 self.logger.error("delivery_confirmation failed {}".format(
                     method_frame))
-                self.statsdClient.incr('amqp.output_failure', count=1)
+                self.statsdClient.incr('amqp.output_failure', count=count)
+
+        def set_state(self, state):
+            self.state = state
+            self.statsdClient.gauge('amqp.connected',
+                                    int(state == self.OPEN))
+
+        def fail_waiters(self, error):
+            """ Fail the pending channel future so that the waiters do not
+            hang, the next ones get a fresh future.
+            """
+            future, self.future_channel = self.future_channel, None
+            if future is not None and not future.done():
+                future.set_exception(
+                    pika.exceptions.AMQPConnectionError(error))
+
+        def schedule_reconnect(self, error):
+            """ Retry to connect after a jittered exponential backoff:
+            a random delay up to min(max_delay, min_delay * 2 ** attempts).
+            """
+            self.fail_waiters(error)
+            delay = uniform(0, min(self.config.amqp_reconnect_max_delay,
+                                   self.config.amqp_reconnect_min_delay *
+                                   2 ** self.attempts))
+            self.attempts += 1
+            self.set_state(self.WAITING)
+            self.statsdClient.incr('amqp.reconnect', count=1)
+            self.logger.warning("AMQP reconnection attempt {} in {:.3f}s"
+                                .format(self.attempts, delay))
+            self._reconnect_timeout = self._ioloop.call_later(delay,
+                                                              self.connect)
 
         def create_amqp_client(self, ioloop):
+            self._ioloop = ioloop
+            self.closing = False
+            self.connect()
+            return self.get_channel()
+
+        def connect(self):
+            self._reconnect_timeout = None
+            self.set_state(self.CONNECTING)
             self.logger.info("AMQP connecting to: exchange:{} host:{} "
                              "port: {}".format(
                                  self.config.exchange,
@@ -116,7 +643,21 @@ class AMQPConnectionSingleton:
                                           port=self.config.port,
                                           credentials=credentials),
                 self.on_connection_open,
+                on_open_error_callback=self.on_connection_error,
                 on_close_callback=self.on_connection_close,
-                custom_ioloop=ioloop)
+                custom_ioloop=self._ioloop)
 
-            return self.future_channel
+        def close(self):
+            self.closing = True
+            if self.spool is not None:
+                self.spool_flusher.stop()
+                self.spool.sync()
+            if self._reconnect_timeout is not None:
+                self._ioloop.remove_timeout(self._reconnect_timeout)
+                self._reconnect_timeout = None
+            if self._connection is not None and self._connection.is_open:
+                self.set_state(self.CLOSING)
+                self._connection.close()
+            else:
+                self.set_state(self.CLOSED)
+                self.fail_waiters("AMQP connection closed")
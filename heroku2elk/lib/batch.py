@@ -0,0 +1,66 @@
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop
+
+
+class Batch:
+
+    def __init__(self, timeout):
+        self.lines = []
+        self.size = 0
+        self.timeout = timeout
+        self.future = Future()
+
+
+class BatchPublisher:
+    """ Collect the serialized envelopes per routing key and publish them as
+    a single newline delimited message (read it with the json_lines codec).
+
+    A batch is published as soon as it reaches max_lines lines or max_bytes
+    bytes, or when its linger delay expires.
+    """
+
+    def __init__(self, conf, publish):
+        """
+        :param publish: coroutine function publishing (routing_key, body)
+        """
+        self.publish = publish
+        self.max_lines = conf.amqp_batch_max_lines
+        self.max_bytes = conf.amqp_batch_max_bytes
+        self.linger = conf.amqp_batch_linger_ms / 1000
+        self.batches = {}
+
+    def add(self, routing_key, envelope):
+        """ Add an envelope to the batch of its routing key.
+        :return: a future resolved once the batch is published
+        """
+        if isinstance(envelope, str):
+            envelope = envelope.encode()
+        batch = self.batches.get(routing_key)
+        if batch is not None and \
+                batch.size + len(envelope) + 1 > self.max_bytes:
+            self.flush(routing_key)
+            batch = None
+        if batch is None:
+            batch = self.batches[routing_key] = Batch(
+                IOLoop.current().call_later(self.linger, self.flush,
+                                            routing_key))
+        batch.lines.append(envelope)
+        batch.size += len(envelope) + 1
+        future = batch.future
+        if len(batch.lines) >= self.max_lines or batch.size >= self.max_bytes:
+            self.flush(routing_key)
+        return future
+
+    def flush(self, routing_key):
+        'publish the pending batch of a routing key'
+        batch = self.batches.pop(routing_key, None)
+        if batch is None:
+            return
+        IOLoop.current().remove_timeout(batch.timeout)
+        batch.lines.append(b'')
+        chain_future(self.publish(routing_key, b'\n'.join(batch.lines)),
+                     batch.future)
+
+    def flush_all(self):
+        for routing_key in list(self.batches):
+            self.flush(routing_key)
@@ -0,0 +1,95 @@
+""" Compression of the request bodies received and of the messages
+published.
+"""
+import gzip
+import zlib
+
+
+# zlib wbits of the Content-Encoding of the requests, 'deflate' is the zlib
+# format as HTTP names it
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'x-gzip': 16 + zlib.MAX_WBITS,
+         'deflate': zlib.MAX_WBITS}
+
+
+class DecompressionError(ValueError):
+    'invalid compressed request body'
+
+
+class UnsupportedEncoding(DecompressionError):
+    'Content-Encoding which is neither gzip nor deflate'
+
+
+class BodyTooLarge(DecompressionError):
+    'request body larger than the cap once decompressed'
+
+
+class Decompressor:
+    """ Decompress a gzip or deflate request body chunk by chunk, failing
+    with BodyTooLarge as soon as it exceeds max_size bytes: the output of
+    zlib is bounded, a zip bomb is never inflated in memory. A negative
+    max_size is unbounded.
+    """
+
+    def __init__(self, encoding, max_size):
+        if encoding not in WBITS:
+            raise UnsupportedEncoding('unsupported Content-Encoding: %s'
+                                      % encoding)
+        self.decompressor = zlib.decompressobj(WBITS[encoding])
+        self.max_size = max_size
+        # compressed and decompressed bytes so far
+        self.compressed = 0
+        self.size = 0
+
+    def decompress(self, chunk):
+        self.compressed += len(chunk)
+        decompressor = self.decompressor
+        data = []
+        try:
+            while chunk and not decompressor.eof:
+                # 0 is no limit for zlib
+                out = decompressor.decompress(
+                    chunk, self.max_size - self.size + 1
+                    if self.max_size >= 0 else 0)
+                self.size += len(out)
+                if self.size > self.max_size >= 0:
+                    raise BodyTooLarge('body larger than %d bytes once '
+                                       'decompressed' % self.max_size)
+                data.append(out)
+                chunk = decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise DecompressionError(str(e)) from e
+        return b''.join(data)
+
+    def close(self):
+        'check that the whole compressed body was received'
+        if not self.decompressor.eof:
+            raise DecompressionError('truncated compressed body')
+
+
+class Compressor:
+    """ Compress the messages of at least min_bytes with zlib or gzip, the
+    name of the encoding is their AMQP content_encoding.
+    """
+
+    def __init__(self, encoding, level=1, min_bytes=1024):
+        if encoding not in ('zlib', 'gzip'):
+            raise ValueError('unknown compression: %s, expected zlib or gzip'
+                             % encoding)
+        self.encoding = encoding
+        self.level = level
+        self.min_bytes = min_bytes
+
+    def compress(self, body):
+        if self.encoding == 'gzip':
+            # no timestamp: the same body is always compressed the same way
+            return gzip.compress(body, self.level, mtime=0)
+        return zlib.compress(body, self.level)
+
+
+def decompress(body, encoding):
+    'the content of a message published with a content_encoding'
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'zlib':
+        return zlib.decompress(body)
+    return body
@@ -0,0 +1,177 @@
+import json
+from json.encoder import encode_basestring_ascii
+import logging
+
+from heroku2elk.lib.rfc5424 import parse_header
+
+
+# strings whose quoting a JSON backend must get exactly as json.dumps does
+PROBES = (''.join(map(chr, range(128))),
+          'caf\xe9 中文 \U0001f600  \ud800',
+          '{"token":"abc/def"} \\ "quoted"')
+
+
+def json_quote(s):
+    'the JSON string of s, as json.dumps(s) serializes it'
+    return encode_basestring_ascii(s)
+
+
+def orjson_quote():
+    import orjson
+    dumps = orjson.dumps
+
+    def quote(s):
+        # orjson neither escapes non ASCII characters nor DEL
+        if s.isascii() and '\x7f' not in s:
+            return dumps(s).decode('ascii')
+        return encode_basestring_ascii(s)
+
+    return quote
+
+
+def ujson_quote():
+    import ujson
+    dumps = ujson.dumps
+
+    def quote(s):
+        return dumps(s, ensure_ascii=True, escape_forward_slashes=False)
+
+    return quote
+
+
+BACKENDS = dict(json=lambda: json_quote, orjson=orjson_quote,
+                ujson=ujson_quote)
+
+
+def get_quote(backend='auto'):
+    """ Return the string quoting function of a JSON backend, 'auto' picks
+    the fastest one installed. A backend which is missing or does not
+    quote like json.dumps falls back to json.
+    """
+    names = ['orjson', 'ujson'] if backend == 'auto' else [backend]
+    for name in names:
+        try:
+            quote = BACKENDS[name]()
+        except (ImportError, KeyError):
+            continue
+        try:
+            if all(quote(s) == json.dumps(s) for s in PROBES):
+                return quote
+        except Exception:
+            pass
+        logging.getLogger("tornado.application").warning(
+            "JSON backend {} does not quote like json, not used".format(name))
+    return json_quote
+
+
+class TemplateEncoder:
+    """ Splice the quoted message into the serialized static fields of the
+    route: only the message is encoded for each line.
+    """
+
+    # appended to the parser version of the routes
+    parser_ver_suffix = ''
+
+    def __init__(self, quote=json_quote):
+        self.quote = quote
+
+    def encode(self, route, log):
+        return '%s%s, "http_content_length": %d}' % (
+            route.prefix, self.quote(log), len(log))
+
+    def encode_parsed(self, route, log, fields, message):
+        'envelope of a log whose fields were extracted'
+        quote = self.quote
+        return '%s%s, "http_content_length": %d%s}' % (
+            route.prefix, quote(message), len(log),
+            ''.join([', "%s": %s' % (name, quote(value))
+                     for name, value in fields]))
+
+
+class DictEncoder:
+    """ json.dumps of the whole envelope, the reference of the other
+    encoders
+    """
+
+    parser_ver_suffix = ''
+
+    def encode(self, route, log):
+        payload = dict(route.fields)
+        payload['message'] = log
+        payload['http_content_length'] = len(log)
+        return json.dumps(payload)
+
+    def encode_parsed(self, route, log, fields, message):
+        payload = dict(route.fields)
+        payload['message'] = message
+        payload['http_content_length'] = len(log)
+        payload.update(fields)
+        return json.dumps(payload)
+
+
+def json_fields(message, keys):
+    """ The values of the keys of a JSON object message, as the app_<key>
+    string fields the mutate filters of logstash added: false and null are
+    left out, the other values are serialized.
+    """
+    # only the messages looking like an object are parsed
+    if message.lstrip()[:1] != '{' or message.rstrip()[-1:] != '}':
+        return []
+    try:
+        obj = json.loads(message)
+    except (ValueError, RecursionError):
+        # deeply nested messages exceed the recursion limit of the parser
+        return []
+    fields = []
+    for key in keys:
+        value = obj.get(key)
+        if value is None or value is False:
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        fields.append(('app_' + key, value))
+    return fields
+
+
+class FieldsEncoder:
+    """ Lift fields out of the lines into their envelopes: the RFC 5424
+    header, then the json_keys of the JSON object messages. The lines
+    without such fields are encoded as is.
+    """
+
+    def __init__(self, encoder, header=True, json_keys=()):
+        self.encoder = encoder
+        self.header = header
+        self.json_keys = tuple(json_keys)
+        # logstash skips grok and the json filter on these routes
+        self.parser_ver_suffix = ('-rfc5424' if header else '') + \
+            ('-json' if json_keys else '')
+
+    def encode(self, route, log):
+        parsed = parse_header(log)
+        if parsed is None:
+            fields, message = [], log
+        else:
+            fields, message = parsed
+            if not self.header:
+                # the header is only skipped to reach the JSON message
+                fields = []
+        if self.json_keys:
+            fields += json_fields(message, self.json_keys)
+        if not fields:
+            return self.encoder.encode(route, log)
+        if not self.header:
+            message = log
+        return self.encoder.encode_parsed(route, log, fields, message)
+
+
+def make_encoder(conf):
+    'the heroku envelope encoder of the configuration'
+    if conf.envelope_encoder == 'dict':
+        encoder = DictEncoder()
+    else:
+        encoder = TemplateEncoder(get_quote(conf.json_backend))
+    if conf.rfc5424_activated or conf.json_fields:
+        return FieldsEncoder(encoder, conf.rfc5424_activated,
+                             conf.json_fields)
+    return encoder
@@ -1,13 +1,35 @@
+from functools import partial
 import logging
-import json
+from time import perf_counter
 
-from tornado import httpclient, gen
-from tornado.web import RequestHandler
-from statsd import StatsClient
-from pika import BasicProperties
+from tornado import httpclient
+from tornado.concurrent import Future
+from tornado.web import RequestHandler, stream_request_body
+from pika.exceptions import AMQPError
 
-from heroku2elk.lib.syslog import Splitter
-from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from heroku2elk.lib.syslog import Splitter, FrameParser, FrameTooLarge, \
+    decode_line
+from heroku2elk.lib.amqp import DeliveryError
+from heroku2elk.lib.compression import BodyTooLarge, DecompressionError, \
+    Decompressor, UnsupportedEncoding
+from heroku2elk.lib.metrics import get_metrics
+from heroku2elk.lib.routes import amqp_route, heroku_route
+
+
+def error_status(e):
+    """
+    HTTP status replied for an exception raised while forwarding logs:
+    503 when the logs could not be delivered, so that Heroku retries them
+    """
+    if isinstance(e, (DeliveryError, AMQPError)):
+        return 503
+    if isinstance(e, UnsupportedEncoding):
+        return 415
+    if isinstance(e, BodyTooLarge):
+        return 413
+    if isinstance(e, DecompressionError):
+        return 400
+    return 500
 
 
 class HealthCheckHandler(RequestHandler):
@@ -15,10 +37,8 @@ class HealthCheckHandler(RequestHandler):
     """
 
     def initialize(self, api, ver, conf):
-        self.statsd_client = StatsClient(conf.metrics_host, conf.metrics_port,
-                                         prefix=conf.metrics_prefix)
+        self.statsd_client = get_metrics(conf)
 
-    @gen.coroutine
     def get(self):
         """ A simple healthCheck handler
             reply 200 to every GET called
@@ -34,6 +54,9 @@ class HealthCheckHandler(RequestHandler):
 class GenericAPIHandler(RequestHandler):
     '''Generic Handler with support for API versionned urls'''
 
+    # handlers filtering each log line before wrapping it into an envelope
+    filters_lines = False
+
     def initialize(self, api, ver, conf):
         """
         handler initialisation
@@ -41,22 +64,55 @@ class GenericAPIHandler(RequestHandler):
         self.conf = conf
         self.api = api
         self.version = ver
-        self.plugins = []
-        if api in conf.plugins:
-            if '*' in conf.plugins[api]:
-                self.plugins.extend(conf.plugins[api]['*'])
-            if ver in conf.plugins[api]:
-                self.plugins.extend(conf.plugins[api][ver])
-        if '*' in conf.plugins:
-            if '*' in conf.plugins['*']:
-                self.plugins.extend(conf.plugins['*']['*'])
+        # compiled by make_app
+        self.plugins = self.application.plugin_chains[
+            api, ver, self.filters_lines]
         self.logger = logging.getLogger("tornado.application")
-        self.statsd_client = StatsClient(conf.metrics_host, conf.metrics_port,
-                                         prefix=conf.metrics_prefix)
+        self.statsd_client = get_metrics(conf)
         self.http_client = httpclient.AsyncHTTPClient()
 
-    @gen.coroutine
-    def post(self):
+    def prepare(self):
+        """
+        decompress a gzip or deflate encoded body
+        """
+        self.decompressor = None
+        encoding = self.request.headers.get('Content-Encoding', 'identity')
+        try:
+            if encoding != 'identity':
+                self.decompressor = Decompressor(
+                    encoding.strip().lower(), self.conf.decompress_max_bytes)
+            self.decompress_body()
+        except DecompressionError as e:
+            self.on_decompression_error(e)
+
+    def decompress_body(self):
+        'replace the received body by its decompressed content'
+        decompressor = self.decompressor
+        if decompressor is None:
+            return
+        start = perf_counter()
+        body = decompressor.decompress(self.request.body)
+        decompressor.close()
+        self.request.body = body
+        self.report_decompression(perf_counter() - start)
+
+    def report_decompression(self, elapsed):
+        decompressor = self.decompressor
+        self.statsd_client.incr('input.compressed', count=1)
+        self.statsd_client.incr('input.compressed_bytes',
+                                count=decompressor.compressed)
+        self.statsd_client.incr('input.decompressed_bytes',
+                                count=decompressor.size)
+        self.statsd_client.timing('input.decompress', elapsed * 1000)
+
+    def on_decompression_error(self, e):
+        self.logger.error("Exception occured: %s, while decompressing: %s"
+                          % (e, self.request.uri))
+        self.statsd_client.incr('input.decompression_error', count=1)
+        self.set_status(error_status(e))
+        self.finish()
+
+    async def post(self):
         """
         HTTP Post handler
         :return: HTTPStatus 200
@@ -64,43 +120,73 @@ class GenericAPIHandler(RequestHandler):
         self.statsd_client.incr('input.mobile', count=1)
         try:
             payload = self.request.body
-            self.process_log(payload)
-        except:
-            self.set_status(500)
+            await self.process_log(payload)
+        except Exception as e:
+            self.reply(error_status(e))
         else:
-            self.set_status(200)
-
-    @gen.coroutine
-    def process_log(self, payload):
+            self.reply(200)
 
-        for trans in self.plugins:
-            payload = trans(payload, self.conf)
+    def reply(self, status):
+        """
+        set the reply status, a 503 asks the client to retry later rather
+        than us buffering the logs
+        """
+        self.set_status(status)
+        if status == 503:
+            self.set_header('Retry-After', str(self.conf.retry_after))
 
-        return payload
+    async def process_log(self, payload):
+        """
+        run the plugin chain on a payload
+        :return: the payload, None if a plugin dropped it
+        """
+        for payload in self.plugins([payload]):
+            return payload
 
     @classmethod
     def get_url(class_, api, ver):
         return "/%s/%s/.*" % (api, ver)
 
 
-class GenericAMQPHandler(GenericAPIHandler):
-    """ The Mobile HTTP handler class
+class GenericOutputHandler(GenericAPIHandler):
+    """ The Mobile HTTP handler class, publishing to the output of the
+    application whatever its transport
     """
 
-    @gen.coroutine
-    def post(self):
+    # handlers publishing single line JSON envelopes, which can be batched
+    batchable = False
+    # handlers whose lines are limited per app and environment
+    rate_limited = False
+    # gives the route of a request URI
+    parse_route = staticmethod(amqp_route)
+
+    def prepare(self):
+        super().prepare()
+        if self._finished:
+            self.route = None
+            return
+        routes = self.application.routes
+        try:
+            self.route = routes.get(self.request.uri, self.parse_route)
+        except Exception as e:
+            self.logger.error("Exception occured: %s, while routing: %s"
+                              % (e, self.request.uri))
+            self.route = None
+            self.set_status(500)
+            self.finish()
+            return
+        self.routing_key = self.route.routing_key
+        app = self.application
+        self.output = app.api_outputs.get(self.api, app.output)
+        self.statsd_client.gauge('route_cache.hit_ratio', routes.hit_ratio)
+
+    async def post(self):
         """
         HTTP Post handler
         :return: HTTPStatus 200
         """
         self.statsd_client.incr('input.mobile', count=1)
-        try:
-            self.routing_key = self.request.uri.replace('/', '.')[1:]
-            super().post()
-        except:
-            self.set_status(500)
-        else:
-            self.set_status(200)
+        await super().post()
 
     @property
     def routing_key(self):
@@ -110,78 +196,129 @@ class GenericAMQPHandler(GenericAPIHandler):
     def routing_key(self, v):
         self.__rk = v
 
-    @gen.coroutine
-    def process_log(self, payload):
+    async def process_log(self, payload):
 
-        payload = yield super().process_log(payload)
-        try:
-            channel = yield AMQPConnectionSingleton().get_channel(self.conf)
-            self.statsd_client.incr('amqp.output', count=1)
-
-            channel.basic_publish(exchange='logs',
-                                  routing_key=self.routing_key,
-                                  body=payload,
-                                  properties=BasicProperties(
-                                      # make message persistent
-                                      delivery_mode=1,
-                                      ),
-                                  mandatory=True
-                                  )
-            return payload
+        payload = await super().process_log(payload)
+        if payload is not None:
+            await self.publish([payload])[0]
+        return payload
 
+    def process_logs(self, payloads):
+        """
+        run the plugin chain once on the payloads of a request
+        :return: the futures of their publication
+        """
+        try:
+            payloads = self.plugins(payloads)
         except Exception as e:
-            self.statsd_client.incr('amqp.output_exception', count=1)
-            self.logger.error("Error while pushing message to AMQP, exception:"
+            future = Future()
+            future.set_exception(e)
+            return [future]
+        return self.publish(payloads)
+
+    def publish(self, payloads):
+        """
+        publish the payloads of a request, in batches or all at once to the
+        output of the api (batches go to the OUTPUT one)
+        :return: the futures of their publication
+        """
+        limiter = self.application.rate_limiter
+        if limiter is not None and self.rate_limited and payloads:
+            payloads = limiter.limit(self.route, payloads)
+        if not payloads:
+            return []
+        self.statsd_client.incr('amqp.output', count=len(payloads))
+        batcher = self.application.batcher
+        routing_key = self.routing_key
+        if batcher is not None and self.batchable and \
+                self.output is self.application.output:
+            futures = [(batcher.add(routing_key, payload), payload, 1)
+                       for payload in payloads]
+        else:
+            futures = [(self.output.publish(
+                [(routing_key, payload) for payload in payloads]),
+                payloads[0] if len(payloads) == 1 else
+                '%d messages' % len(payloads), len(payloads))]
+        for future, payload, count in futures:
+            if future.done():
+                self.on_published(payload, count, future)
+            else:
+                future.add_done_callback(
+                    partial(self.on_published, payload, count))
+        return [future for future, _, _ in futures]
+
+    def on_published(self, payload, count, future):
+        """ count and log a failed publication
+        :param count: the number of messages published by the future
+        """
+        e = future.exception()
+        if e is not None:
+            self.statsd_client.incr('amqp.output_exception', count=count)
+            self.logger.error("Error while publishing message, exception:"
                               " {} msg: {}, uri: {}"
                               .format(e, payload, self.request.uri))
-            raise
 
 
-class MultiLineHandler(GenericAMQPHandler):
+# the name HANDLERS configurations used when AMQP was the only output
+GenericAMQPHandler = GenericOutputHandler
+
+
+class MultiLineHandler(GenericOutputHandler):
 
-    @gen.coroutine
-    def post(self):
+    async def post(self):
         """
         """
         self.statsd_client.incr('input.multiline', count=1)
         try:
-
-            logs, msg = [], self.request.body.decode().strip()
-            while msg:
-                size, msg = msg.split(maxsplit=1)
-                size = int(size)
-                log, msg = msg[:size], msg[size:].strip()
-                logs.append(log)
-
+            # frame lengths count octets, only the frames are decoded
+            logs = [self.decode_frame(frame)
+                    for frame in FrameParser().split(self.request.body)]
         except Exception as e:
             self.logger.error("Exception occured: %s, while proceeding: %s"
                               % (e, self.request.body))
             self.set_status(500)
             return
 
-        raised = False
-        for log in logs:
+        status = 200
+        for future in self.forward_all(logs):
             try:
-                yield self.process_log(log)
-            except:
-                raised = True
+                await future
+            except Exception as e:
+                status = max(status, error_status(e))
 
-        if raised:
-            self.set_status(500)
-        else:
-            self.set_status(200)
+        self.reply(status)
+
+    def forward_all(self, logs):
+        """
+        publish the log lines of a request
+        :return: the futures of their publication
+        """
+        return self.process_logs(logs)
+
+    def decode_frame(self, frame):
+        """
+        decode a frame extracted from the body
+        """
+        return decode_line(frame)
 
 
-class HerokuHandler(GenericAMQPHandler):
+class HerokuHandler(GenericOutputHandler):
     """ The Heroku HTTP drain handler class
     """
 
+    filters_lines = True
+    batchable = True
+    rate_limited = True
+
+    def parse_route(self, uri):
+        return heroku_route(uri, self.application.encoder.parser_ver_suffix)
+
     def initialize(self, api, ver, conf):
         """
         handler initialisation
         """
         super().initialize(api, ver, conf)
-        self.splitter = Splitter(conf)
+        self.splitter = Splitter(conf, self.application.line_filter)
 
     def set_default_headers(self):
         """
@@ -191,8 +328,7 @@ class HerokuHandler(GenericAMQPHandler):
         """
         self.set_header('Content-Length', '0')
 
-    @gen.coroutine
-    def post(self):
+    async def post(self):
         """
         HTTP Post handler
         1. Split the input payload into an array of bytes
@@ -201,10 +337,15 @@ class HerokuHandler(GenericAMQPHandler):
         :return: HTTPStatus 200
         """
         self.statsd_client.incr('input.heroku', count=1)
+        body = self.request.body
+        offloader = self.application.offloader
         # 1. split
         try:
             self.statsd_client.incr('truncate', count=1)
-            logs = self.splitter.split(self.request.body)
+            if offloader is not None and len(body) >= offloader.min_bytes:
+                futures = await self.offload(body)
+            else:
+                futures = self.forward_all(self.splitter.split(body))
         except Exception as e:
             self.logger.error("Exception occured: %s, while proceeding: %s"
                               % (e, self.request.body))
@@ -212,32 +353,55 @@ class HerokuHandler(GenericAMQPHandler):
             return
 
         # 2. forward
-        raised = False
-        for log in logs:
-            payload = dict()
-            path = self.request.uri.split('/')[1:]
-            payload['type'] = path[0]
-            payload['parser_ver'] = path[1]
-            payload['env'] = path[2]
-            payload['app'] = path[3]
-            payload['message'] = log
-            payload['http_content_length'] = len(log)
-            self.routing_key = "%(type)s.%(parser_ver)s.%(env)s.%(app)s" \
-                               % payload
-            payload = json.dumps(payload)
+        status = 200
+        for future in futures:
             try:
-                yield self.process_log(payload)
-            except:
-                raised = True
+                await future
+            except Exception as e:
+                status = max(status, error_status(e))
 
-        if raised:
-            self.set_status(500)
-        else:
-            self.set_status(200)
+        self.reply(status)
+
+    def forward_all(self, logs):
+        """
+        wrap the log lines of a request into their JSON envelopes and
+        publish them
+        :return: the futures of their publication
+        """
+        encode, route = self.application.encoder.encode, self.route
+        return self.process_logs([encode(route, log) for log in logs])
+
+    async def offload(self, body):
+        """
+        split, filter and encode a big payload in the process pool, the
+        IOLoop keeps serving the other connections meanwhile
+        :return: the futures of the publication of its lines
+        """
+        payloads, cpu_time = await self.application.offloader.split(
+            body, self.route, (self.api, self.version, self.filters_lines))
+        self.statsd_client.incr('offload.batches', count=1)
+        self.statsd_client.incr('offload.bytes', count=len(body))
+        # the time the IOLoop would have been blocked
+        self.statsd_client.timing('offload.loop_time_saved',
+                                  cpu_time * 1000)
+        return self.publish(payloads)
+
+    def decode_frame(self, frame):
+        """
+        decode a frame extracted from the body
+        """
+        return self.splitter.decode(frame)
 
 
 class HerokuHandler2(MultiLineHandler):
 
+    filters_lines = True
+    batchable = True
+    rate_limited = True
+
+    def parse_route(self, uri):
+        return heroku_route(uri, self.application.encoder.parser_ver_suffix)
+
     def set_default_headers(self):
         """
         specify the output headers to have an empty payload, as described here:
@@ -246,18 +410,103 @@ class HerokuHandler2(MultiLineHandler):
         """
         self.set_header('Content-Length', '0')
 
-    @gen.coroutine
-    def process_log(self, log):
-
-        payload = dict()
-        path = self.request.uri.split('/')[1:]
-        payload['type'] = path[0]
-        payload['parser_ver'] = path[1]
-        payload['env'] = path[2]
-        payload['app'] = path[3]
-        payload['message'] = log
-        payload['http_content_length'] = len(log)
-        self.routing_key = "%(type)s.%(parser_ver)s.%(env)s.%(app)s" % payload
-        payload = json.dumps(payload)
-
-        yield super().process_log(payload)
+    def forward_all(self, logs):
+        """
+        wrap the log lines of a request into their JSON envelopes and
+        publish them
+        :return: the futures of their publication
+        """
+        if self.conf.filter_stage == 'splitter':
+            logs = map(self.application.line_filter, logs)
+        encode, route = self.application.encoder.encode, self.route
+        return self.process_logs([encode(route, log) for log in logs])
+
+
+class StreamingDrainMixin:
+    """ Parse the drain payload while it is received instead of waiting
+    for the whole body: frames are published as soon as they are complete,
+    the size of a frame is capped instead of the size of the body.
+    """
+
+    def decompress_body(self):
+        'the chunks are decompressed as they are received'
+
+    def prepare(self):
+        super().prepare()
+        if self.route is None:
+            return
+        # the memory is bounded by the frame size cap, not the body size
+        self.request.connection.set_max_body_size(self.conf.max_body_size)
+        self.parser = FrameParser(self.conf.max_frame_size)
+        self.stream_status = 200
+        self.decompression_time = 0
+        # publications in progress, awaited before replying
+        self.pending = []
+
+    def data_received(self, chunk):
+        if self.stream_status != 200:
+            return
+        try:
+            if self.decompressor is not None:
+                self.decompression_time -= perf_counter()
+                chunk = self.decompressor.decompress(chunk)
+                self.decompression_time += perf_counter()
+            self.forward_frames(self.parser.feed(chunk))
+        except Exception as e:
+            self.on_parse_error(e)
+
+    async def post(self):
+        """
+        HTTP Post handler: forward the last frame, and reply once every
+        frame is published
+        :return: HTTPStatus 200
+        """
+        self.statsd_client.incr('input.stream', count=1)
+        if self.stream_status == 200:
+            try:
+                if self.decompressor is not None:
+                    self.decompressor.close()
+                    self.report_decompression(self.decompression_time)
+                self.forward_frames(self.parser.close())
+            except Exception as e:
+                self.on_parse_error(e)
+
+        for future in self.pending:
+            try:
+                await future
+            except Exception as e:
+                if self.stream_status in (200, 500):
+                    self.stream_status = max(self.stream_status,
+                                             error_status(e))
+        self.reply(self.stream_status)
+
+    def forward_frames(self, frames):
+        if frames:
+            self.pending.extend(self.forward_all(
+                [self.decode_frame(frame) for frame in frames]))
+
+    def on_parse_error(self, e):
+        """ the status replied once a chunk failed to be decompressed,
+        parsed or forwarded, the rest of the body is ignored
+        """
+        self.logger.error("Exception occured: %s, while proceeding: %s"
+                          % (e, self.request.uri))
+        if isinstance(e, FrameTooLarge):
+            self.statsd_client.incr('input.frame_too_large', count=1)
+            self.stream_status = 413
+            return
+        if isinstance(e, DecompressionError):
+            self.statsd_client.incr('input.decompression_error', count=1)
+        self.stream_status = error_status(e)
+
+
+@stream_request_body
+class HerokuStreamHandler(StreamingDrainMixin, HerokuHandler):
+    """ Streaming variant of HerokuHandler
+    """
+
+
+@stream_request_body
+class HerokuStreamHandler2(StreamingDrainMixin, HerokuHandler2):
+    """ Streaming variant of HerokuHandler2
+    """
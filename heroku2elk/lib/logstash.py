@@ -0,0 +1,218 @@
+from collections import deque
+from functools import partial
+import logging
+from random import uniform
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from heroku2elk.lib.amqp import BufferFull, DeliveryError
+from heroku2elk.lib.metrics import get_metrics
+
+
+def parse_endpoints(hosts):
+    'the (host, port) of comma separated host:port endpoints'
+    endpoints = []
+    for endpoint in hosts.split(','):
+        host, _, port = endpoint.strip().rpartition(':')
+        endpoints.append((host, int(port)))
+    return endpoints
+
+
+class LogstashConnection:
+    """ A persistent connection to a logstash tcp input.
+
+    The data sent is coalesced into writes of up to max_write_bytes, with
+    one write in flight at a time: while the socket does not drain, the
+    data waits in a buffer of at most max_buffer_bytes, then send fails
+    with BufferFull. Once the connection fails, the pending data fails
+    with DeliveryError and the connection is opened again after a
+    jittered exponential backoff.
+    """
+
+    # connection states
+    CLOSED = 'closed'
+    CONNECTING = 'connecting'
+    OPEN = 'open'
+    WAITING = 'waiting'  # for the next reconnection attempt
+    CLOSING = 'closing'
+
+    def __init__(self, host, port, conf):
+        self.host = host
+        self.port = port
+        self.max_write_bytes = conf.logstash_max_write_bytes
+        self.max_buffer_bytes = conf.logstash_max_buffer_bytes
+        self.connect_timeout = conf.logstash_connect_timeout
+        self.min_delay = conf.logstash_reconnect_min_delay
+        self.max_delay = conf.logstash_reconnect_max_delay
+        self.state = self.CLOSED
+        self.stream = None
+        # (data, future) not written yet
+        self.chunks = deque()
+        self.buffered = 0
+        self.writing = False
+        # consecutive failed connection attempts
+        self.attempts = 0
+        self._reconnect_timeout = None
+        self.logger = logging.getLogger("tornado.application")
+        self.statsd_client = get_metrics(conf)
+
+    def send(self, data):
+        """ send data, after the data sent before
+        :return: a future resolved once it is written to the socket
+        """
+        future = Future()
+        if self.state in (self.WAITING, self.CLOSING):
+            future.set_exception(DeliveryError(
+                'logstash %s:%d is unreachable' % (self.host, self.port)))
+            return future
+        if self.buffered + len(data) > self.max_buffer_bytes:
+            self.statsd_client.incr('logstash.buffer_full', count=1)
+            future.set_exception(BufferFull(
+                'logstash %s:%d buffer is full' % (self.host, self.port)))
+            return future
+        self.chunks.append((data, future))
+        self.buffered += len(data)
+        if self.state == self.CLOSED:
+            self.connect()
+        elif self.state == self.OPEN and not self.writing:
+            # the data sent during this IOLoop iteration is written at once
+            self.writing = True
+            IOLoop.current().add_callback(self.flush)
+        return future
+
+    def connect(self):
+        self.state = self.CONNECTING
+        IOLoop.current().spawn_callback(self.open)
+
+    async def open(self):
+        try:
+            stream = await TCPClient().connect(
+                self.host, self.port, timeout=self.connect_timeout)
+        except Exception as e:
+            self.on_failure(e)
+            return
+        if self.state != self.CONNECTING:
+            stream.close()
+            return
+        self.logger.info("Logstash is connected %s:%d"
+                         % (self.host, self.port))
+        stream.set_nodelay(True)
+        self.stream = stream
+        self.state = self.OPEN
+        self.attempts = 0
+        # logstash sends nothing: the read ends when the connection closes
+        IOLoop.current().add_future(stream.read_until_close(),
+                                    partial(self.on_stream_close, stream))
+        if self.chunks and not self.writing:
+            self.writing = True
+            await self.flush()
+
+    async def flush(self):
+        'write the pending data, one write of max_write_bytes at a time'
+        stream = self.stream
+        try:
+            while self.chunks and stream is self.stream:
+                data, futures = [], []
+                size = 0
+                while self.chunks and (not data or size + len(
+                        self.chunks[0][0]) <= self.max_write_bytes):
+                    chunk, future = self.chunks.popleft()
+                    data.append(chunk)
+                    futures.append(future)
+                    size += len(chunk)
+                self.buffered -= size
+                try:
+                    await stream.write(b''.join(data))
+                except Exception as e:
+                    self.fail(futures, e)
+                    if stream is self.stream:
+                        self.on_failure(e)
+                    return
+                self.statsd_client.incr('logstash.writes', count=1)
+                self.statsd_client.incr('logstash.bytes', count=size)
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            self.writing = False
+
+    def on_stream_close(self, stream, future):
+        e = future.exception() or StreamClosedError()
+        if stream is self.stream and self.state == self.OPEN:
+            self.on_failure(e)
+
+    def fail(self, futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(DeliveryError(
+                    'logstash %s:%d: %s' % (self.host, self.port, error)))
+
+    def on_failure(self, error):
+        'fail the pending data and reconnect after a backoff'
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.fail([future for _, future in self.chunks], error)
+        self.chunks.clear()
+        self.buffered = 0
+        if self.state == self.CLOSING:
+            return
+        delay = uniform(0, min(self.max_delay,
+                               self.min_delay * 2 ** self.attempts))
+        self.attempts += 1
+        self.state = self.WAITING
+        self.statsd_client.incr('logstash.reconnect', count=1)
+        self.logger.warning("Logstash %s:%d failed: %s, reconnecting in "
+                            "%.3fs" % (self.host, self.port, error, delay))
+        self._reconnect_timeout = IOLoop.current().call_later(
+            delay, self.connect)
+
+    def close(self):
+        self.state = self.CLOSING
+        if self._reconnect_timeout is not None:
+            IOLoop.current().remove_timeout(self._reconnect_timeout)
+            self._reconnect_timeout = None
+        self.on_failure(StreamClosedError())
+
+
+class LogstashPool:
+    """ LOGSTASH_POOL_SIZE connections to each of the LOGSTASH_HOSTS
+    endpoints, used in turn by the requests; the connections waiting to
+    reconnect are skipped.
+    """
+
+    def __init__(self, conf):
+        self.connections = [
+            LogstashConnection(host, port, conf)
+            for host, port in parse_endpoints(conf.logstash_hosts)
+            for _ in range(conf.logstash_pool_size)]
+        self.next = 0
+
+    def start(self):
+        """ open the connections
+        :return: a future resolved at once, they connect in the background
+        """
+        for connection in self.connections:
+            if connection.state == connection.CLOSED:
+                connection.connect()
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def send(self, data):
+        count = len(self.connections)
+        for i in range(count):
+            connection = self.connections[(self.next + i) % count]
+            if connection.state != connection.WAITING:
+                self.next = (self.next + i + 1) % count
+                return connection.send(data)
+        future = Future()
+        future.set_exception(DeliveryError('no logstash is reachable'))
+        return future
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
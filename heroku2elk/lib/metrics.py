@@ -0,0 +1,144 @@
+from os import getpid
+import socket
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+class MetricsRegistry:
+    """ Aggregate the metrics of the process in memory and send them to
+    statsd every flush_interval ms, packed into UDP packets of at most
+    packet_size bytes.
+
+    It has the methods of statsd.StatsClient used by heroku2elk: counters
+    are summed, the last value of a gauge wins and every timing is kept.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=None,
+                 flush_interval=1000, packet_size=1432):
+        self.host = host
+        self.port = port
+        self.prefix = prefix + '.' if prefix else ''
+        self.flush_interval = flush_interval
+        self.packet_size = packet_size
+        self.pid = getpid()
+        self.counters = {}
+        # stat: [value, delta], delta gauges are relative to statsd's value
+        self.gauges = {}
+        self.timers = {}
+        self._socket = self._address = None
+        self._callback = self._ioloop = None
+
+    def incr(self, stat, count=1, rate=1):
+        self.counters[stat] = self.counters.get(stat, 0) + count
+
+    def decr(self, stat, count=1, rate=1):
+        self.incr(stat, -count, rate)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        gauge = self.gauges.get(stat)
+        if delta and gauge is not None:
+            gauge[0] += value
+        else:
+            self.gauges[stat] = [value, delta]
+
+    def timing(self, stat, delta, rate=1):
+        'record a duration in ms (or a timedelta)'
+        if hasattr(delta, 'total_seconds'):
+            delta = delta.total_seconds() * 1000
+        self.timers.setdefault(stat, []).append(delta)
+
+    def lines(self):
+        'statsd lines of the aggregated metrics, reset them'
+        counters, self.counters = self.counters, {}
+        gauges, self.gauges = self.gauges, {}
+        timers, self.timers = self.timers, {}
+        prefix = self.prefix
+        for stat, count in counters.items():
+            if count:
+                yield '%s%s:%s|c' % (prefix, stat, count)
+        for stat, (value, delta) in gauges.items():
+            if delta:
+                yield '%s%s:%+g|g' % (prefix, stat, value)
+            else:
+                if value < 0:
+                    # a signed value would be taken as a delta
+                    yield '%s%s:0|g' % (prefix, stat)
+                yield '%s%s:%g|g' % (prefix, stat, value)
+        for stat, values in timers.items():
+            for value in values:
+                yield '%s%s:%0.3f|ms' % (prefix, stat, value)
+
+    def packets(self):
+        packet, size = [], 0
+        for line in self.lines():
+            line = line.encode()
+            if packet and size + len(line) > self.packet_size:
+                yield b'\n'.join(packet)
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            yield b'\n'.join(packet)
+
+    def flush(self):
+        for packet in self.packets():
+            try:
+                self.socket().sendto(packet, self._address)
+            except (OSError, socket.error):
+                # statsd is best effort, never fail because of it
+                pass
+
+    def socket(self):
+        if self._socket is None:
+            family, _, _, _, address = socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_DGRAM)[0]
+            self._socket = socket.socket(family, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            self._address = address
+        return self._socket
+
+    def start(self):
+        'flush periodically on the current IOLoop'
+        ioloop = IOLoop.current()
+        if self._callback is not None and self._ioloop is ioloop:
+            return
+        if self._callback is not None:
+            self._callback.stop()
+        self._ioloop = ioloop
+        self._callback = PeriodicCallback(self.flush, self.flush_interval)
+        self._callback.start()
+
+    def close(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = self._ioloop = None
+        self.flush()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+_registry = None
+
+
+def get_metrics(conf):
+    """ Return the metrics registry of the current process, created from
+    conf on first use and flushed on the current IOLoop
+    """
+    global _registry
+    # a forked process must not share its parent's registry
+    if _registry is None or _registry.pid != getpid():
+        _registry = MetricsRegistry(conf.metrics_host, conf.metrics_port,
+                                    conf.metrics_prefix,
+                                    conf.metrics_flush_interval,
+                                    conf.metrics_packet_size)
+    _registry.start()
+    return _registry
+
+
+def close_metrics():
+    'flush the pending metrics and stop the registry'
+    global _registry
+    if _registry is not None and _registry.pid == getpid():
+        _registry.close()
+    _registry = None
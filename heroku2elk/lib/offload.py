@@ -0,0 +1,90 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+from time import process_time
+
+from tornado.ioloop import IOLoop
+
+from heroku2elk.lib.metrics import get_metrics
+from heroku2elk.lib.syslog import Splitter
+
+
+# splitter, encoder and plugin chains of the application, in a pool process
+_worker = None
+
+
+def _init_worker(splitter, encoder, plugin_chains):
+    global _worker
+    _worker = splitter, encoder, plugin_chains
+
+
+def split_batch(worker, body, route, chain):
+    """ split, filter and encode a drain payload
+    :return: the payloads to publish and the CPU time it took
+    """
+    start = process_time()
+    splitter, encoder, plugin_chains = worker
+    encode = encoder.encode
+    payloads = plugin_chains[chain](
+        [encode(route, log) for log in splitter.split(body)])
+    return payloads, process_time() - start
+
+
+def _split_batch(body, route, chain):
+    'split_batch in a pool process'
+    return split_batch(_worker, body, route, chain)
+
+
+class BatchOffloader:
+    """ Split, filter and encode the big drain payloads in a process pool,
+    so that they do not block the IOLoop of the worker.
+
+    The pool is started on first use, after tornado forked its workers:
+    its processes are forked too and inherit the compiled patterns of the
+    application instead of compiling them again.
+
+    When a pool process dies, the broken pool is replaced by a new one
+    and the payload split again, and if that one breaks too the payload
+    is split in the IOLoop.
+    """
+
+    def __init__(self, conf, app):
+        self.app = app
+        self.conf = conf
+        self.min_bytes = conf.offload_min_bytes
+        self.workers = conf.offload_workers
+        self.pool = None
+        self.logger = logging.getLogger("tornado.application")
+
+    @property
+    def worker(self):
+        'the splitter, encoder and plugin chains of the application'
+        app = self.app
+        return (Splitter(app.conf, app.line_filter), app.encoder,
+                app.plugin_chains)
+
+    async def split(self, body, route, chain):
+        """ split a payload in the pool with the plugin chain of the
+        application keyed by chain
+        :return: the payloads and the CPU time it took
+        """
+        for _ in range(2):
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context('fork'),
+                    initializer=_init_worker, initargs=self.worker)
+            try:
+                return await IOLoop.current().run_in_executor(
+                    self.pool, _split_batch, body, route, chain)
+            except BrokenProcessPool as e:
+                self.logger.error('Offload pool broken: %s' % e)
+                # resolved here: the offloader is built before the fork
+                get_metrics(self.conf).incr('offload.broken_pool', count=1)
+                self.close()
+        return split_batch(self.worker, body, route, chain)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
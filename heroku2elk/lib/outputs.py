@@ -0,0 +1,242 @@
+""" Output backends: where the handlers publish their envelopes.
+
+An output publishes a batch of (routing_key, body) items and returns a
+future resolved once they are all published, selected by OUTPUT:
+amqp: the AMQP connection of the process
+null: discards the messages, to benchmark the pipeline alone
+file: appends the messages to a local newline delimited file
+logstash: writes the messages to logstash tcp inputs (json_lines codec)
+
+A HANDLERS entry may name the output of its api as a 4th field, e.g.
+HerokuHandler:heroku:v1:logstash, the others use OUTPUT.
+"""
+import logging
+
+from tornado.concurrent import Future
+from tornado.ioloop import PeriodicCallback
+
+from heroku2elk.lib.amqp import AMQPConnectionSingleton, DeliveryError
+from heroku2elk.lib.logstash import LogstashPool
+from heroku2elk.lib.supervisor import worker_id
+
+
+def resolved(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def gather(futures):
+    """ a future resolved once all the futures are, failed with the first
+    exception raised if any
+    """
+    result = Future()
+    pending = len(futures)
+    errors = []
+
+    def on_done(future):
+        nonlocal pending
+        pending -= 1
+        e = future.exception()
+        if e is not None and not errors:
+            errors.append(e)
+        if pending == 0:
+            if errors:
+                result.set_exception(errors[0])
+            else:
+                result.set_result(None)
+
+    if not futures:
+        result.set_result(None)
+    for future in futures:
+        if future.done():
+            on_done(future)
+        else:
+            future.add_done_callback(on_done)
+    return result
+
+
+class Output:
+    'base class of the output backends'
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def start(self):
+        """ connect, when the output needs to
+        :return: a future resolved once the output is ready
+        """
+        return resolved()
+
+    def publish(self, items, content_type=None):
+        """ publish (routing_key, body) items
+        :return: a future resolved once they are all published
+        """
+        raise NotImplementedError
+
+    def publish_one(self, routing_key, body, content_type=None):
+        return self.publish([(routing_key, body)], content_type)
+
+    def close(self):
+        pass
+
+
+class AMQPOutput(Output):
+    """ Publish on the AMQP connection of the process, each item as a
+    message of the exchange.
+    """
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        # message properties per content type, None for the default ones
+        self.properties = {None: None}
+
+    def start(self):
+        return AMQPConnectionSingleton().get_channel(self.conf)
+
+    def publish(self, items, content_type=None):
+        if len(items) == 1:
+            return self.publish_one(*items[0], content_type)
+        publish = self.publish_one
+        return gather([publish(routing_key, body, content_type)
+                       for routing_key, body in items])
+
+    def publish_one(self, routing_key, body, content_type=None):
+        properties = self.properties.get(content_type)
+        if properties is None and content_type is not None:
+            properties = self.properties[content_type] = \
+                AMQPConnectionSingleton.AMQPConnection.properties(
+                    content_type)
+        return AMQPConnectionSingleton().publish(self.conf, routing_key, body,
+                                                 properties)
+
+    def close(self):
+        AMQPConnectionSingleton().close_channel()
+
+
+class NullOutput(Output):
+    'Count and discard the messages'
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, items, content_type=None):
+        self.messages += len(items)
+        self.bytes += sum(len(body) for _, body in items)
+        return resolved()
+
+
+class FileOutput(Output):
+    """ Append the message bodies to OUTPUT_FILE_PATH, newline terminated,
+    through a write buffer of OUTPUT_FILE_BUFFER_BYTES flushed every
+    OUTPUT_FILE_FLUSH_INTERVAL seconds. The workers write their own file,
+    suffixed with their index.
+    """
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        # known once opened by the worker, the outputs are built before the
+        # fork
+        self.path = None
+        self.file = None
+        self.flusher = None
+        self.logger = logging.getLogger("tornado.application")
+
+    def publish(self, items, content_type=None):
+        try:
+            if self.file is None:
+                self.open()
+            write = self.file.write
+            for _, body in items:
+                if isinstance(body, str):
+                    body = body.encode()
+                write(body)
+                if not body.endswith(b'\n'):
+                    write(b'\n')
+        except OSError as e:
+            self.logger.error("Error while writing to %s: %s"
+                              % (self.path, e))
+            future = Future()
+            future.set_exception(DeliveryError(str(e)))
+            return future
+        return resolved()
+
+    def open(self):
+        self.path = self.conf.output_file_path
+        if worker_id() is not None:
+            self.path += '.%d' % worker_id()
+        self.file = open(self.path, 'ab',
+                         buffering=self.conf.output_file_buffer_bytes)
+        self.flusher = PeriodicCallback(
+            self.file.flush, self.conf.output_file_flush_interval * 1000)
+        self.flusher.start()
+
+    def close(self):
+        if self.file is not None:
+            self.flusher.stop()
+            self.file.close()
+            self.file = None
+
+
+class LogstashOutput(Output):
+    """ Write the message bodies, newline terminated, to the pool of
+    connections to the logstash tcp inputs: the lines of a request are
+    written together, the routing keys are dropped.
+    """
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        # created by the worker, the outputs are built before the fork
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = LogstashPool(self.conf)
+        return self._pool
+
+    def start(self):
+        return self.pool.start()
+
+    def publish(self, items, content_type=None):
+        lines = []
+        for _, body in items:
+            if isinstance(body, str):
+                body = body.encode()
+            lines.append(body)
+            if not body.endswith(b'\n'):
+                lines.append(b'\n')
+        return self.pool.send(b''.join(lines))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+
+
+OUTPUTS = {'amqp': AMQPOutput, 'null': NullOutput, 'file': FileOutput,
+           'logstash': LogstashOutput}
+
+
+def make_output(conf, name=None):
+    'the output backend named name, OUTPUT by default'
+    name = name or conf.output
+    if name not in OUTPUTS:
+        raise ValueError('unknown output: %s, expected one of %s'
+                         % (name, ', '.join(OUTPUTS)))
+    return OUTPUTS[name](conf)
+
+
+def make_outputs(conf):
+    """ the output of OUTPUT, and the output of every api whose handlers
+    name another one
+    :return: (output, {api: output})
+    """
+    outputs = {conf.output: make_output(conf)}
+    api_outputs = {}
+    for api, name in conf.handler_outputs.items():
+        if name not in outputs:
+            outputs[name] = make_output(conf, name)
+        api_outputs[api] = outputs[name]
+    return outputs[conf.output], api_outputs
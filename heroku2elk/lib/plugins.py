@@ -1,9 +1,18 @@
+from functools import lru_cache, partial
 import re
 
 
+# patterns come from the configuration, compile them once
+_compile = lru_cache(maxsize=32)(re.compile)
+
+
+def _replace_token(match):
+    return '{}__TOKEN_REPLACED__{}'.format(match.group(1), match.group(3))
+
+
 def truncate(payload, conf):
     'truncate big logs except stack traces'
-    pattern = re.compile(conf.stack_pattern)
+    pattern = _compile(conf.stack_pattern)
     max_ = conf.truncate_max_msg_length
 
     if max_ > -1 and len(payload) > max_ and not pattern.search(payload):
@@ -15,7 +24,112 @@ def truncate(payload, conf):
 
 def obfuscate_token(payload, conf):
     'replace token by __TOKEN_REPLACED__'
-    pattern = re.compile(conf.token_pattern)
-    return pattern.sub(lambda x: '{}__TOKEN_REPLACED__{}'.format(x.group(1),
-                                                                 x.group(3)),
-                       payload)
+    pattern = _compile(conf.token_pattern)
+    return pattern.sub(_replace_token, payload)
+
+
+def truncate_all(payloads, conf):
+    'batch version of truncate'
+    max_ = conf.truncate_max_msg_length
+    if max_ < 0:
+        return payloads
+    pattern = _compile(conf.stack_pattern)
+    return [payload if len(payload) <= max_ or pattern.search(payload) else
+            '%s __TRUNCATED__ %s' % (payload[:max_//2], payload[-max_//2:])
+            for payload in payloads]
+
+
+def obfuscate_tokens(payloads, conf):
+    'batch version of obfuscate_token'
+    if '\\A' not in conf.token_pattern and '\\Z' not in conf.token_pattern:
+        # most requests hold no token at all: look for one in a single pass
+        # over the whole request (^ and $ match at the payload boundaries)
+        if not _compile(conf.token_pattern, re.M).search('\n'.join(payloads)):
+            return payloads
+    pattern = _compile(conf.token_pattern)
+    return [pattern.sub(_replace_token, payload) for payload in payloads]
+
+
+# plugins applied line by line by LineFilter when conf.filter_stage is
+# 'splitter': the plugin chain of the handlers splitting lines skips them
+truncate.line_filter = obfuscate_token.line_filter = True
+truncate.batch = truncate_all
+obfuscate_token.batch = obfuscate_tokens
+
+
+def batch_plugin(fn):
+    """ Declare fn(payloads, conf) as a batch plugin: it is called once with
+    the list of the payloads of a request and returns the list of those to
+    forward, which may be shorter.
+
+    A plugin fn(payload, conf) is called on each payload, unless it has a
+    batch attribute: its batch version.
+    """
+    fn.batch = fn
+    return fn
+
+
+def _each(plugin, payloads, conf):
+    return [plugin(payload, conf) for payload in payloads]
+
+
+class PluginChain:
+    """ The plugins of an api version, compiled once: calling the chain
+    runs every plugin over the list of payloads of a request.
+    """
+
+    def __init__(self, plugins, conf):
+        self.plugins = list(plugins)
+        self.stages = [partial(getattr(plugin, 'batch', None) or
+                               partial(_each, plugin), conf=conf)
+                       for plugin in self.plugins]
+
+    @classmethod
+    def compile(class_, conf, api, ver, filters_lines=False):
+        """ The chain of the plugins configured for api and ver, without
+        the line filters when lines are filtered before the chain.
+        """
+        plugins = []
+        if api in conf.plugins:
+            if '*' in conf.plugins[api]:
+                plugins.extend(conf.plugins[api]['*'])
+            if ver in conf.plugins[api]:
+                plugins.extend(conf.plugins[api][ver])
+        if '*' in conf.plugins:
+            if '*' in conf.plugins['*']:
+                plugins.extend(conf.plugins['*']['*'])
+        if filters_lines and conf.filter_stage == 'splitter':
+            # already done on the raw line, do not redo it on the envelope
+            plugins = [p for p in plugins
+                       if not getattr(p, 'line_filter', False)]
+        return class_(plugins, conf)
+
+    def __call__(self, payloads):
+        for stage in self.stages:
+            payloads = stage(payloads)
+        return payloads
+
+
+class LineFilter:
+    """ Obfuscate tokens and truncate big logs except stack traces, on a
+    raw log line, with patterns compiled once.
+    """
+
+    def __init__(self, conf):
+        self.patternToken = re.compile(conf.token_pattern)
+        self.patternStackTrace = re.compile(conf.stack_pattern)
+        if conf.truncate_activated:
+            self.truncate_to = conf.truncate_max_msg_length
+        else:
+            self.truncate_to = -1
+
+    def __call__(self, line):
+        # replace token by __TOKEN_REPLACED__
+        line = self.patternToken.sub(_replace_token, line)
+
+        max_ = self.truncate_to
+        # TRUNCATE Big logs except stack traces
+        if -1 < max_ < len(line) and not self.patternStackTrace.search(line):
+            line = '%s __TRUNCATED__ %s' % (line[:max_//2], line[-max_//2:])
+
+        return line
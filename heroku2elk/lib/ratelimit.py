@@ -0,0 +1,132 @@
+""" Rate limits of the heroku drains: a token bucket per app and per
+environment, so that an app flooding its drain does not starve the others.
+"""
+from collections import OrderedDict
+import json
+import random
+import re
+from time import monotonic
+
+from heroku2elk.lib.metrics import get_metrics
+
+
+def metric_name(name):
+    'name as a statsd metric name component'
+    return re.sub(r'[^\w-]', '_', name)
+
+
+class TokenBucket:
+    'rate tokens per second, up to burst'
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def refill(self, now):
+        tokens = self.tokens + (now - self.last) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.last = now
+
+
+class RateLimiter:
+    """ Limit the lines of every app to RATE_LIMIT_APP_RATE per second (or
+    its RATE_LIMIT_OVERRIDES entry) and of every environment to
+    RATE_LIMIT_ENV_RATE, with bursts of RATE_LIMIT_*_BURST lines; a rate
+    of 0 is unlimited. The limits are per worker process.
+
+    Over the limits, the lines are dropped, or with RATE_LIMIT_MODE=sample
+    the RATE_LIMIT_SAMPLE_RATE fraction of them is kept and their envelope
+    gets a sampled_rate field.
+
+    The buckets are kept least recently used first, those unused for
+    RATE_LIMIT_IDLE_SECONDS are evicted: once refilled a bucket is the
+    same as a new one.
+    """
+
+    def __init__(self, conf, clock=monotonic):
+        self.app_limit = (conf.rate_limit_app_rate, conf.rate_limit_app_burst)
+        self.env_limit = (conf.rate_limit_env_rate, conf.rate_limit_env_burst)
+        # (rate, burst) per app name
+        self.overrides = conf.rate_limit_overrides
+        self.sample = conf.rate_limit_mode == 'sample'
+        self.sample_rate = conf.rate_limit_sample_rate
+        self.idle = conf.rate_limit_idle_seconds
+        self.clock = clock
+        self.random = random.Random()
+        # buckets by (env, app), and (env, None) for the environments
+        self.buckets = OrderedDict()
+        self.conf = conf
+
+    def bucket(self, key, limit, now):
+        'the refilled bucket of key, None when unlimited'
+        rate, burst = limit
+        if rate <= 0:
+            return None
+        buckets = self.buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst, now)
+        else:
+            buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    def evict(self, now):
+        'drop the buckets unused for idle seconds'
+        buckets = self.buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket.last < self.idle:
+                return
+            del buckets[key]
+
+    def admit(self, env, app, count):
+        """ take the tokens of count lines of an app
+        :return: the number of lines within the limits
+        """
+        now = self.clock()
+        self.evict(now)
+        buckets = [bucket for bucket in (
+            self.bucket((env, app), self.overrides.get(app, self.app_limit),
+                        now),
+            self.bucket((env, None), self.env_limit, now))
+            if bucket is not None]
+        admitted = count
+        for bucket in buckets:
+            if bucket.tokens < admitted:
+                admitted = max(0, int(bucket.tokens))
+        for bucket in buckets:
+            bucket.tokens -= admitted
+        return admitted
+
+    def limit(self, route, payloads):
+        """ the JSON envelopes of a heroku route within the limits, then
+        the sampled ones
+        """
+        fields = dict(route.fields)
+        app = fields['app']
+        admitted = self.admit(fields['env'], app, len(payloads))
+        if admitted == len(payloads):
+            return payloads
+        over = payloads[admitted:]
+        payloads = payloads[:admitted]
+        # resolved here: the limiter is built before the workers fork
+        statsd = get_metrics(self.conf)
+        app = metric_name(app)
+        if self.sample:
+            rand, rate = self.random.random, self.sample_rate
+            field = ', "sampled_rate": %s}' % json.dumps(rate)
+            sampled = [payload[:-1] + field for payload in over
+                       if rand() < rate]
+            payloads.extend(sampled)
+            statsd.incr('rate_limit.sampled', count=len(sampled))
+            statsd.incr('rate_limit.sampled.%s' % app, count=len(sampled))
+        dropped = len(over) - (len(payloads) - admitted)
+        statsd.incr('rate_limit.dropped', count=dropped)
+        statsd.incr('rate_limit.dropped.%s' % app, count=dropped)
+        statsd.gauge('rate_limit.buckets', len(self.buckets))
+        return payloads
@@ -0,0 +1,75 @@
+""" Regex free parser of the RFC 5424 header of the heroku log lines:
+https://tools.ietf.org/html/rfc5424#section-6
+
+It extracts the fields the grok patterns of docs/logstash.conf match, so
+that Logstash does not have to grok the lines parsed here.
+"""
+
+# envelope fields of the header, named as the grok patterns name them
+FIELDS = ('syslog5424_pri', 'syslog5424_ver', 'timestamp', 'heroku_drain_id',
+          'heroku_source', 'heroku_dyno', 'syslog5424_msgid')
+
+
+def parse_header(line):
+    """ Split a syslog line into its header and its message.
+
+    :return: ([(field, value)], message), fields whose value is nil ('-')
+    are left out, None if the line has no RFC 5424 header
+    """
+    if line[:1] != '<':
+        return None
+    gt = line.find('>', 2, 5)
+    if gt == -1:
+        return None
+    # ver, timestamp, hostname, app-name, procid, msgid and the rest
+    parts = line[gt + 1:].split(' ', 6)
+    if len(parts) < 7 or '' in parts:
+        parts = _split_fields(line[gt + 1:])
+        if parts is None:
+            return None
+    ver, timestamp, host, source, dyno, msgid, rest = parts
+    pri = line[1:gt]
+    if not (pri.isdigit() and ver.isdigit() and pri.isascii() and
+            ver.isascii()):
+        return None
+
+    header = [('syslog5424_pri', pri), ('syslog5424_ver', ver)]
+    if timestamp != '-':
+        header.append(('timestamp', timestamp))
+    if host != '-':
+        header.append(('heroku_drain_id', host))
+    if source != '-':
+        header.append(('heroku_source', source))
+    if dyno != '-':
+        header.append(('heroku_dyno', dyno))
+    if msgid != '-':
+        header.append(('syslog5424_msgid', msgid))
+
+    # the structured data, heroku sends none: like grok, it ends with the
+    # first ']' followed by a space, and a nil one is dropped
+    if rest[:1] == ' ':
+        rest = rest.lstrip(' ')
+    if rest[:1] == '[':
+        end = rest.find('] ')
+        if end != -1:
+            header.append(('syslog5424_sd', rest[:end + 1]))
+            rest = rest[end + 2:].lstrip(' ')
+    elif rest[:2] == '- ':
+        rest = rest[2:].lstrip(' ')
+    return header, rest
+
+
+def _split_fields(text):
+    'slow path of parse_header, for fields separated by runs of spaces'
+    parts = []
+    pos = 0
+    for _ in range(6):
+        end = text.find(' ', pos)
+        if end == pos or end == -1:
+            return None
+        parts.append(text[pos:end])
+        pos = end
+        while text[pos:pos + 1] == ' ':
+            pos += 1
+    parts.append(text[pos:])
+    return parts
@@ -0,0 +1,62 @@
+from collections import OrderedDict, namedtuple
+import json
+
+
+# routing_key: AMQP routing key of the logs posted to the route
+# fields: (name, value) of the static envelope fields
+# prefix: JSON of the static envelope fields, up to the message value
+Route = namedtuple('Route', 'routing_key fields prefix')
+
+
+def amqp_route(uri):
+    'route of the payloads published as is, like the mobile logs'
+    return Route(uri.replace('/', '.')[1:], None, None)
+
+
+def heroku_route(uri, parser_ver_suffix=''):
+    """ route of the heroku drains: /<type>/<parser_ver>/<env>/<app>, the
+    prefix is completed by the envelope encoders, which bump the parser
+    version with a suffix when they extract fields from the lines
+    """
+    path = uri.split('/')[1:]
+    payload = dict()
+    payload['type'] = path[0]
+    payload['parser_ver'] = path[1] + parser_ver_suffix
+    payload['env'] = path[2]
+    payload['app'] = path[3]
+    routing_key = "%(type)s.%(parser_ver)s.%(env)s.%(app)s" % payload
+    fields = tuple(payload.items())
+    payload['message'] = None
+    prefix = json.dumps(payload)[:-len('null}')]
+    return Route(routing_key, fields, prefix)
+
+
+class RouteCache:
+    """ Bounded LRU cache of the routes parsed from the request URIs.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uri, parse):
+        """ Return the route of uri, parse(uri) gives it on a cache miss.
+        """
+        routes = self.routes
+        route = routes.get(uri)
+        if route is not None:
+            self.hits += 1
+            routes.move_to_end(uri)
+            return route
+        self.misses += 1
+        route = routes[uri] = parse(uri)
+        if len(routes) > self.size:
+            routes.popitem(last=False)
+        return route
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
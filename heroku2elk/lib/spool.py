@@ -0,0 +1,303 @@
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import struct
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+
+# timestamp, routing key, content type and body lengths
+RECORD = struct.Struct('>dHHI')
+
+
+class SpoolFull(Exception):
+    'the spool reached its size cap'
+
+
+# the fsyncs of the spools, off the IOLoop and one at a time
+_fsync_executor = ThreadPoolExecutor(1)
+
+
+def fsync_and_close(fd):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """ Append-only local storage of the messages which could not be
+    published, read back in the same order.
+
+    Records are appended to numbered segment files through a write buffer,
+    which the owner flushes every fsync_interval seconds: the fsyncs run in
+    a thread so that the IOLoop does not wait for the disk. A segment is
+    deleted once every record in it is committed, the records are
+    delivered at least once: uncommitted ones are read again after a
+    restart.
+
+    The pending records are counted per routing key, the keys without any
+    can be published directly without overtaking spooled messages.
+    """
+
+    def __init__(self, directory, max_bytes=-1, segment_bytes=2**24,
+                 fsync_interval=1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.logger = logging.getLogger("tornado.application")
+        # segments on disk, oldest first, the last one is written
+        self.segments = deque(sorted(
+            int(name[:-len('.spool')]) for name in os.listdir(directory)
+            if name.endswith('.spool')))
+        # bytes on disk
+        self.size = sum(os.path.getsize(self.path(segment))
+                        for segment in self.segments)
+        # never append to a segment which may end with a torn record
+        self.write_segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(self.write_segment)
+        self.write_offset = 0
+        self._writer = open(self.path(self.write_segment), 'ab')
+        # records written since the last fsync
+        self._unsynced = False
+        # the last fsync submitted to the executor
+        self._syncing = None
+        self.read_segment, self.read_offset = self.segments[0], 0
+        # (segment, offset, routing keys) of the last peek
+        self._peeked = None
+        self._reader = self._reader_segment = None
+        # records appended, and pending ones per routing key
+        self.appended = 0
+        self.pending_keys = Counter(
+            record[1] for record in self.records(self.read_segment, 0))
+
+    def path(self, segment):
+        return os.path.join(self.directory, '%020d.spool' % segment)
+
+    @property
+    def pending(self):
+        'whether records are waiting to be committed'
+        return (self.read_segment, self.read_offset) != \
+            (self.write_segment, self.write_offset)
+
+    def append(self, routing_key, body, content_type=None):
+        routing_key = routing_key.encode()
+        content_type = (content_type or '').encode()
+        if isinstance(body, str):
+            body = body.encode()
+        size = RECORD.size + len(routing_key) + len(content_type) + len(body)
+        if -1 < self.max_bytes < self.size + size:
+            raise SpoolFull('spool full: %d bytes' % self.size)
+        if self.write_offset and \
+                self.write_offset + size > self.segment_bytes:
+            self.rotate()
+        self._writer.write(b''.join((
+            RECORD.pack(time.time(), len(routing_key), len(content_type),
+                        len(body)),
+            routing_key, content_type, body)))
+        self.write_offset += size
+        self.size += size
+        self._unsynced = True
+        self.appended += 1
+        self.pending_keys[routing_key.decode()] += 1
+
+    def rotate(self):
+        self._writer.flush()
+        self.fsync_later()
+        self._writer.close()
+        self.write_segment += 1
+        self.write_offset = 0
+        self.segments.append(self.write_segment)
+        self._writer = open(self.path(self.write_segment), 'ab')
+
+    def sync(self):
+        'flush and fsync, blocking'
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._unsynced = False
+
+    def flush(self):
+        """ flush the records written since the last call, and fsync them in
+        the executor: called every fsync_interval seconds
+        """
+        if not self._unsynced:
+            return
+        self._writer.flush()
+        if self._syncing is None or self._syncing.done():
+            self.fsync_later()
+
+    def fsync_later(self):
+        'fsync the segment written in the executor'
+        # a duplicate stays valid once the segment is rotated
+        fd = os.dup(self._writer.fileno())
+        self._syncing = _fsync_executor.submit(fsync_and_close, fd)
+        self._unsynced = False
+
+    def peek(self, count):
+        """ Return up to count (timestamp, routing_key, content_type, body)
+        records from the read position, commit them once they are
+        published.
+        """
+        records = []
+        # the buffered records are read too
+        self._writer.flush()
+        segment, offset = self.read_segment, self.read_offset
+        while len(records) < count:
+            record = self.read(segment, offset)
+            if record is None:
+                if segment == self.write_segment:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            record, offset = record
+            records.append(record)
+        self._peeked = segment, offset, [record[1] for record in records]
+        return records
+
+    def records(self, segment, offset):
+        'the records from a position to the end of the spool'
+        while True:
+            record = self.read(segment, offset)
+            if record is None:
+                if segment == self.write_segment:
+                    return
+                segment, offset = segment + 1, 0
+                continue
+            record, offset = record
+            yield record
+
+    def read(self, segment, offset):
+        'return the record at offset and the next offset, None at the end'
+        if segment == self.write_segment and offset >= self.write_offset:
+            return None
+        if self._reader_segment != segment:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = open(self.path(segment), 'rb')
+            self._reader_segment = segment
+        reader = self._reader
+        reader.seek(offset)
+        header = reader.read(RECORD.size)
+        if len(header) < RECORD.size:
+            self.check_torn(segment, header)
+            return None
+        timestamp, rk_len, ct_len, body_len = RECORD.unpack(header)
+        data = reader.read(rk_len + ct_len + body_len)
+        if len(data) < rk_len + ct_len + body_len:
+            self.check_torn(segment, data)
+            return None
+        record = (timestamp, data[:rk_len].decode(),
+                  data[rk_len:rk_len + ct_len].decode() or None,
+                  data[rk_len + ct_len:])
+        return record, offset + RECORD.size + len(data)
+
+    def check_torn(self, segment, data):
+        if data:
+            self.logger.warning("Torn record dropped at the end of spool "
+                                "segment {}".format(self.path(segment)))
+
+    def commit(self):
+        'consume the records returned by the last peek'
+        if self._peeked is None:
+            return
+        self.read_segment, self.read_offset, keys = self._peeked
+        self._peeked = None
+        pending_keys = self.pending_keys
+        for key in keys:
+            pending_keys[key] -= 1
+            if not pending_keys[key]:
+                del pending_keys[key]
+        while self.segments[0] != self.read_segment:
+            segment = self.segments.popleft()
+            if self._reader_segment == segment:
+                self._reader.close()
+                self._reader = self._reader_segment = None
+            self.size -= os.path.getsize(self.path(segment))
+            os.remove(self.path(segment))
+
+    def close(self):
+        self.sync()
+        self._writer.close()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = self._reader_segment = None
+
+
+class SpoolReplayer:
+    """ Publish the spooled records at a bounded rate once the connection is
+    open again. Records are published in order on a single channel, and
+    committed once the broker confirmed them.
+
+    The messages of the routing keys with spooled records keep being
+    spooled until they are replayed, each step replays them on top of the
+    rate so that the spool drains whatever their inbound rate.
+    """
+
+    # seconds between two attempts when the replay fails
+    retry_delay = 1
+    # records read per step, a tenth of a second of replay
+    steps_per_second = 10
+
+    def __init__(self, spool, connection, rate):
+        """
+        :param connection: the AMQPConnection to publish to
+        :param rate: maximum records published per second
+        """
+        self.spool = spool
+        self.connection = connection
+        self.rate = rate
+        self.running = False
+        self.logger = logging.getLogger("tornado.application")
+
+    def start(self):
+        if not self.running and self.spool.pending:
+            self.running = True
+            IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        spool, connection = self.spool, self.connection
+        statsd = connection.statsdClient
+        count = max(1, int(self.rate / self.steps_per_second))
+        appended = spool.appended
+        try:
+            while spool.pending and connection.state == connection.OPEN:
+                started = IOLoop.current().time()
+                # and the records spooled since the previous step
+                records = spool.peek(count + spool.appended - appended)
+                appended = spool.appended
+                if not records:
+                    spool.commit()
+                    continue
+                statsd.gauge('spool.replay_lag_ms',
+                             int((time.time() - records[0][0]) * 1000))
+                try:
+                    await self.replay(records)
+                except Exception as e:
+                    self.logger.error("Spool replay failed: {}".format(e))
+                    statsd.incr('spool.replay_failure', count=1)
+                    await gen.sleep(self.retry_delay)
+                    continue
+                spool.commit()
+                statsd.incr('spool.replayed', count=len(records))
+                statsd.gauge('spool.bytes', spool.size)
+                delay = count / self.rate - \
+                    (IOLoop.current().time() - started)
+                if delay > 0:
+                    await gen.sleep(delay)
+        finally:
+            self.running = False
+        if not spool.pending:
+            statsd.gauge('spool.replay_lag_ms', 0)
+
+    async def replay(self, records):
+        connection = self.connection
+        channel = await connection.get_channel()
+        await gen.multi([connection.publish(
+            routing_key, body, connection.properties(content_type),
+            confirm=True, channel=channel)
+            for _, routing_key, content_type, body in records])
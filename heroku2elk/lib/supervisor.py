@@ -0,0 +1,117 @@
+import logging
+from multiprocessing import cpu_count
+import os
+import random
+import signal
+from time import monotonic, sleep
+
+
+# index of the worker process, None in the supervisor or a single process
+_worker_id = None
+
+
+def worker_id():
+    'index of the current worker process, None when not supervised'
+    return _worker_id
+
+
+class Supervisor:
+    """ Fork conf.workers worker processes (one per core when 0) and restart
+    those which crash after a jittered exponential backoff: a random delay
+    up to min(max_delay, min_delay * 2 ** failures). A worker which ran
+    longer than max_delay gets a fresh backoff.
+
+    SIGTERM and SIGINT are forwarded to the workers, the supervisor returns
+    once they all exited.
+    """
+
+    def __init__(self, conf):
+        self.workers = conf.workers if conf.workers > 0 else cpu_count()
+        self.min_delay = conf.worker_restart_min_delay
+        self.max_delay = conf.worker_restart_max_delay
+        self.logger = logging.getLogger("tornado.application")
+        # pid: worker index
+        self.children = {}
+        # worker index: start time, consecutive failures, restart time
+        self.started = {}
+        self.failures = [0] * self.workers
+        self.restarts = {}
+        self.stopping = False
+
+    def start(self):
+        """ Fork the workers
+        :return: the worker index in the workers, None in the supervisor
+        once every worker exited
+        """
+        for index in range(self.workers):
+            if self.fork(index):
+                return index
+        self.logger.info("Supervising {} workers".format(self.workers))
+        handlers = {signum: signal.signal(signum, self.stop)
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            return self.supervise()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def fork(self, index):
+        'fork a worker, return True in the worker'
+        pid = os.fork()
+        if pid == 0:
+            global _worker_id
+            _worker_id = index
+            # the workers must not draw the same random numbers
+            random.seed()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            return True
+        self.children[pid] = index
+        self.started[index] = monotonic()
+        return False
+
+    def supervise(self):
+        while self.children or (self.restarts and not self.stopping):
+            now = monotonic()
+            for index, due in list(self.restarts.items()):
+                if due <= now and not self.stopping:
+                    del self.restarts[index]
+                    if self.fork(index):
+                        return index
+            if not self.children:
+                sleep(min(self.restarts.values()) - now)
+                continue
+            # poll while restarts are waiting for their delay
+            pid, status = os.waitpid(-1, os.WNOHANG if self.restarts else 0)
+            if pid == 0:
+                sleep(min(0.1, max(0, min(self.restarts.values()) - now)))
+            elif pid in self.children:
+                self.on_exit(pid, status)
+
+    def on_exit(self, pid, status):
+        index = self.children.pop(pid)
+        if self.stopping:
+            return
+        if os.WIFSIGNALED(status):
+            reason = 'killed by signal %d' % os.WTERMSIG(status)
+        elif os.WEXITSTATUS(status) != 0:
+            reason = 'exited with status %d' % os.WEXITSTATUS(status)
+        else:
+            self.logger.info("Worker {} (pid {}) exited".format(index, pid))
+            return
+        if monotonic() - self.started[index] > self.max_delay:
+            self.failures[index] = 0
+        delay = random.uniform(0, min(self.max_delay, self.min_delay *
+                                      2 ** self.failures[index]))
+        self.failures[index] += 1
+        self.restarts[index] = monotonic() + delay
+        self.logger.warning("Worker {} (pid {}) {}, restarting in {:.3f}s"
+                            .format(index, pid, reason, delay))
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -1,57 +1,139 @@
-import re
+from heroku2elk.lib.plugins import LineFilter
 
 
 class Splitter:
 
-    def __init__(self, conf):
-        self.patternToken = re.compile(conf.token_pattern)
-        self.patternStackTrace = re.compile(conf.stack_pattern)
-        if conf.truncate_activated:
-            self.truncate_to = conf.truncate_max_msg_length
+    def __init__(self, conf, line_filter=None):
+        if conf.filter_stage != 'splitter':
+            # lines are filtered by the plugin chain
+            self.filter = str
+        elif line_filter is None:
+            self.filter = LineFilter(conf)
         else:
-            self.truncate_to = -1
+            self.filter = line_filter
 
     def split(self, bytes):
-        # '''Split by lines heroku payload and apply filters.'''
-
-        # lines = []
-
         """ Split an heroku syslog encoded payload using the octet counting
         method as described here :
         https://tools.ietf.org/html/rfc6587#section-3.4.1
         """
+        return list(self.iter_split(bytes))
+
+    def iter_split(self, data):
+        """ Lazy version of split: yield the decoded lines one by one.
+        """
+        for frame in FrameParser().split(data):
+            yield self.decode(frame)
+
+    def decode(self, frame):
+        'decode a bytes-like frame into a filtered line'
+        return self.filter(decode_line(frame))
+
+
+def decode_line(frame):
+    'decode a bytes-like frame into a line, without its trailing newline'
+    stop = len(frame)
+    # remove \n at the end of the line if found
+    if stop and frame[stop - 1] in (10, 13):  # \n or \r in unicode
+        stop -= 1
+    return str(frame[:stop], 'utf-8', 'replace')
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameParser:
+    """ Incremental octet counting parser.
+
+    Chunks are fed as they are received and complete frames are returned as
+    soon as their last octet is there: only the incomplete tail is buffered,
+    so memory is bounded by the biggest frame, not by the whole payload.
+    """
+
+    # no sane frame length needs more digits than that
+    max_len_digits = 10
+
+    def __init__(self, max_frame_size=-1):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        'append a chunk and return the list of the completed frames'
+        buf = self._buffer
+        buf += chunk
+        frames, pos, end = [], 0, len(buf)
+        with memoryview(buf) as view:
+            while pos < end:
+                sp = buf.find(b' ', pos)
+                if sp == -1:
+                    self._check_len_digits(buf, pos, end)
+                    break
+                msg_len = self._frame_len(buf, pos, sp)
+                stop = sp + 1 + msg_len
+                if stop > end:
+                    break
+                frames.append(bytes(view[sp + 1:stop]))
+                pos = stop
+        del buf[:pos]
+        return frames
+
+    def split(self, data):
+        """ Yield the frames of a whole payload, without buffering it.
+
+        The payload is walked once with an offset cursor, frames are sliced
+        out of a memoryview so that nothing is copied until they are
+        decoded. The last frame of a batch may be shorter than announced.
+        """
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        # checked inline, the slow path raises the errors
+        max_len_digits = self.max_len_digits
+        max_frame_size = self.max_frame_size
+        while pos < end:
+            # whitespaces between frames are tolerated
+            while data[pos] in b' \t\r\n':
+                pos += 1
+                if pos == end:
+                    return
+            # find the space ending the frame length
+            sp = data.find(b' ', pos)
+            if sp == -1:
+                raise ValueError('no frame length found at offset %d' % pos)
+            if sp - pos > max_len_digits:
+                self._check_len_digits(data, pos, sp)
+            msg_len = int(data[pos:sp])
+            if msg_len < 0 or -1 < max_frame_size < msg_len:
+                self._frame_len(data, pos, sp)
+            start, pos = sp + 1, sp + 1 + msg_len
+            yield view[start:min(pos, end)]
+
+    def close(self):
+        """ Return the buffered tail as a last frame, the last frame of a
+        batch may be shorter than announced.
+        """
+        buf, self._buffer = self._buffer, bytearray()
+        if not buf.strip():
+            return []
+        sp = buf.find(b' ')
+        if sp == -1:
+            raise ValueError('truncated frame length: %r' % bytes(buf))
+        self._frame_len(buf, 0, sp)
+        return [bytes(buf[sp + 1:])]
+
+    def _check_len_digits(self, buf, pos, sp):
+        # leading whitespaces between frames are tolerated
+        if sp - pos > self.max_len_digits and \
+                len(buf[pos:sp].strip()) > self.max_len_digits:
+            raise ValueError('invalid frame length at offset %d' % pos)
 
-        lines = []
-        while len(bytes) > 0:
-            # find first space character
-            i = 0
-            while bytes[i] != 32:  # 32 is white space in unicode
-                i += 1
-            msg_len = int(bytes[0:i].decode('utf-8'))
-            msg = bytes[i + 1:i + msg_len + 1]
-
-            # remove \n at the end of the line if found
-            eol = msg[len(msg)-1]
-            if eol == 10 or eol == 13:  # \n or \r in unicode
-                msg = msg[:-1]
-
-            decoded_msg = msg.decode('utf-8', 'replace')
-            if self.truncate_to > -1:
-                # replace token by __TOKEN_REPLACED__
-                decoded_msg = self.patternToken.sub(lambda x:
-                                                    '{}__TOKEN_REPLACED__{}'
-                                                    .format(x.group(1),
-                                                            x.group(3)),
-                                                    decoded_msg)
-
-                max_ = self.truncate_to
-                # TRUNCATE Big logs except stack traces
-                if not self.patternStackTrace.search(
-                               decoded_msg) and len(decoded_msg) > max_:
-                    decoded_msg = '%s __TRUNCATED__ %s' % (
-                        decoded_msg[:max_//2], decoded_msg[-max_//2:])
-
-            lines.append(decoded_msg)
-
-            bytes = bytes[i + 1 + msg_len:]
-        return lines
+    def _frame_len(self, buf, pos, sp):
+        self._check_len_digits(buf, pos, sp)
+        msg_len = int(buf[pos:sp])
+        if msg_len < 0:
+            raise ValueError('negative frame length: %d' % msg_len)
+        if -1 < self.max_frame_size < msg_len:
+            raise FrameTooLarge('frame of %d bytes exceeds %d bytes'
+                                % (msg_len, self.max_frame_size))
+        return msg_len
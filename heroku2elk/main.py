@@ -1,12 +1,25 @@
 """Main script to start tornado web server.
 """
+import asyncio
+from functools import partial
+import signal
+
 import tornado.ioloop
 import tornado.web
 from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
 
 from heroku2elk.config import MainConfig, configure_logger
-from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from heroku2elk.lib.batch import BatchPublisher
 from heroku2elk.lib.debug import start_debug
+from heroku2elk.lib.envelope import make_encoder
+from heroku2elk.lib.metrics import close_metrics
+from heroku2elk.lib.offload import BatchOffloader
+from heroku2elk.lib.outputs import make_outputs
+from heroku2elk.lib.plugins import LineFilter, PluginChain
+from heroku2elk.lib.ratelimit import RateLimiter
+from heroku2elk.lib.routes import RouteCache
+from heroku2elk.lib.supervisor import Supervisor
 
 
 def make_app(conf, ioloop=None):
@@ -23,15 +36,60 @@ def make_app(conf, ioloop=None):
                 )
     app = tornado.web.Application(handlers)
     app.conf = conf
+    app.plugin_chains = compile_plugin_chains(conf)
+    app.line_filter = LineFilter(conf)
+    app.routes = RouteCache(conf.route_cache_size)
+    app.encoder = make_encoder(conf)
+    app.offloader = None
+    if conf.offload_activated:
+        app.offloader = BatchOffloader(conf, app)
+    app.rate_limiter = None
+    if conf.rate_limit_activated:
+        app.rate_limiter = RateLimiter(conf)
+    app.output, app.api_outputs = make_outputs(conf)
+    app.batcher = None
+    if conf.amqp_batch_activated:
+        app.batcher = BatchPublisher(conf, partial(
+            app.output.publish_one, content_type='application/x-ndjson'))
     app.log = configure_logger()
     return app
 
 
+def compile_plugin_chains(conf):
+    """
+    Compile the plugin chain of every api version, for the handlers
+    filtering their lines or not
+    """
+    return {(api, ver, filters_lines):
+            PluginChain.compile(conf, api, ver, filters_lines)
+            for api, vers in conf.handlers.items() for ver in vers
+            for filters_lines in (False, True)}
+
+
 def close_app(app):
-    AMQPConnectionSingleton().close_channel()
+    if app.offloader is not None:
+        app.offloader.close()
+    for output in set(app.api_outputs.values()) | {app.output}:
+        output.close()
+    close_metrics()
     app.conf.close()
 
 
+def use_event_loop(conf, logger):
+    """
+    Run tornado on uvloop when configured and installed, before the
+    IOLoop of the process is created
+    """
+    if conf.event_loop != 'uvloop':
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("uvloop is not installed, asyncio loop used")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 def run(conf):
 
     app = make_app(conf)
@@ -39,19 +97,31 @@ def run(conf):
 
     if conf.tornado_multiprocessing_activated:
         logger.info("Start H2L in multi-processing mode")
-        server = HTTPServer(app)
-        server.bind(8080)
-        # autodetect number of cores and fork a process for each
-        server.start(0)
+        if not conf.reuse_port:
+            # the workers accept the connections of a shared socket
+            sockets = bind_sockets(8080)
+        if Supervisor(conf).start() is None:
+            # the workers are stopped
+            conf.close()
+            return
+        if conf.reuse_port:
+            sockets = bind_sockets(8080, reuse_port=True)
     else:
         logger.info("Start H2L in single-processing mode")
-        app.listen(8080)
+        sockets = bind_sockets(8080)
+    use_event_loop(conf, logger)
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
 
-    # instantiate an AMQP connection at start to create the queues
-    # (needed when logstash starts)
+    # start the output at once: the AMQP connection creates the queues
+    # (needed when logstash starts), each worker opens its own
     ins = tornado.ioloop.IOLoop.instance()
-    ins.add_future(AMQPConnectionSingleton().get_channel(),
-                   lambda x: logger.info("AMQP is connected"))
+    ins.add_future(app.output.start(),
+                   lambda x: logger.info("Output %s is ready" % conf.output))
+    for output in set(app.api_outputs.values()) - {app.output}:
+        output.start()
+    # stop gracefully on SIGTERM, flushing the spool and the metrics
+    ins.asyncio_loop.add_signal_handler(signal.SIGTERM, ins.stop)
     conf.logger = logger
     start_debug(conf)
     ins.start()
@@ -1,56 +1,55 @@
-import requests
-from sys import argv
-from datetime import datetime
-from loremipsum import get_sentence
+"""Load generator of fake heroku drain requests.
+
+The request bodies are computed before the run, from reproducible
+FakeHerokuLog corpora or from drain bodies captured in files, and posted
+over a pool of keep-alive connections:
+- closed loop: each connection posts its next request once the previous
+  one was answered
+- open loop (--rate): requests are sent at a fixed rate whatever the
+  latency, the latency of a request counts from its scheduled time
+
+A JSON report of the latency percentiles and of the errors is printed at
+the end, and the counts of the last interval on stderr during the run.
+
+    python scripts/fakelog.py [ host | host:port [ mobile/v1/production ] ]
+        [--concurrency N] [--rate R] [--duration S] [--corpus C]
+        [--replay FILE|DIR ...]
+"""
+from argparse import ArgumentParser
+import asyncio
+from datetime import datetime, timezone
+import json
+import os
 import random
+import signal
+import sys
+from time import monotonic
 import uuid
-import threading
-import time
-import pytz
+
+from loremipsum import get_sentence
+from tornado.httputil import HTTPHeaders, parse_response_start_line
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
 
 
-class HerokuRequestGenerator:
-    """
-    Generates and send a fake request (aggregating n fake log lines)
-    """
-    def __init__(self, url):
-        self.url = url
-        self.frameCount = 0
-        self.drainId = uuid.uuid4()
-        self.headers = {
-            'Content-type': 'application/logplex-1',
-            'Logplex-Drain-Token': str(self.drainId),
-            'User-Agent': 'Logplex/v72'
-        }
-
-    def send_random_request(self):
-        """
-        send a fake request using a random number of logs in the payload
-        """
-        msg_count = random.randrange(1, 10)
-        payload = bytes()
-        for n in range(msg_count):
-            payload += FakeHerokuLog().encode()
-
-        self.headers['Logplex-Msg-Count'] = str(msg_count)
-        self.headers['Logplex-Frame-Id'] = str(self.frameCount)
-        self.frameCount += 1
-        try:
-            return requests.post(self.url, data=payload,
-                                 headers=self.headers), payload
-        except requests.exceptions.Timeout:
-            return None, payload
+CORPORA = ('plain', 'stack', 'multibyte')
+DATE = datetime(2017, 6, 21, 17, 2, 55, tzinfo=timezone.utc)
+MULTIBYTE = str.maketrans({'a': '\xe4', 'e': '\xe9', 'o': '中',
+                           'u': 'у'})
+FUNCTIONS = ('dispatch', 'handle', 'render', 'fetch', 'save', 'validate')
 
 
 class FakeHerokuLog:
     """
-    Generates a fake log line
+    Generates a fake log line, now and with a lorem ipsum sentence unless
+    date and text are given
     """
-    def __init__(self):
-        self.date = datetime.now().replace(microsecond=0, tzinfo=pytz.utc)
-        self.text = get_sentence(True)
-        self.app = 'DummyAppName'
-        self.dyno = 'web.1'
+    def __init__(self, date=None, text=None, app='DummyAppName',
+                 dyno='web.1'):
+        self.date = date or datetime.now(timezone.utc).replace(microsecond=0)
+        self.text = get_sentence(True) if text is None else text
+        self.app = app
+        self.dyno = dyno
         self.msg = '<40>1 {} host {} {} - {}\n'.format(self.date.isoformat(),
                                                        self.app, self.dyno,
                                                        self.text)
@@ -62,97 +61,291 @@ class FakeHerokuLog:
         return msg_header + msg
 
 
-class GenWorker:
-    """
-    Infinite message generation worker
-    """
-    def __init__(self, url):
-        self.shouldStop = False
-        self.stats = {'sent': 0, 'timeout': 0}
-        self.url = url
-
-    def get_stats(self):
-        return self.stats
-
-    def run(self):
-        gen = HerokuRequestGenerator(self.url)
-        while self.shouldStop is False:
-            self.stats['sent'] += 1
-            r, msg = gen.send_random_request()
-            if not r:
-                self.stats['timeout'] += 1
-                continue
-            if r.status_code != 200:
-                print('status_code != 200', r, msg)
-
-
-def start_thread(obj):
-    """
-    helper func to create and start a thread
-    :param obj: the target object
-    :return: a tuple with the worker, and the created started thread
-    """
-    sender = threading.Thread(target=obj.run)
-    sender.start()
-    return obj, sender
+def stack_trace(rand):
+    'a python traceback of 5 to 40 frames, as one multi-line message'
+    frames = ['  File "/app/web/%s.py", line %d, in %s\n    %s()' % (
+                  rand.choice(FUNCTIONS), rand.randint(1, 900),
+                  rand.choice(FUNCTIONS), rand.choice(FUNCTIONS))
+              for _ in range(rand.randint(5, 40))]
+    return '\n'.join(['Traceback (most recent call last):'] + frames +
+                     ['ValueError: invalid literal for int()'])
 
 
-def stop_thread(o):
+def fake_logs(count, corpus='plain', seed=0):
+    """ count FakeHerokuLog of a corpus, identical for a seed:
+    plain: lorem ipsum sentences
+    stack: one line in two carries a traceback
+    multibyte: 2 to 4 bytes characters in every sentence
     """
-    helper func to stop a dedicated thread
-    :param o: a tuple containing the worker and the thread
-    :return:
-    """
-    obj, t = o
-    obj.shouldStop = True
-    t.join()
+    # loremipsum draws from the random module
+    random.seed(seed)
+    rand = random.Random(seed)
+    logs = []
+    for _ in range(count):
+        log = FakeHerokuLog(DATE, dyno='web.%d' % rand.randint(1, 9))
+        if corpus == 'stack' and rand.random() < 0.5:
+            log = FakeHerokuLog(DATE, log.text + '\n' + stack_trace(rand),
+                                dyno=log.dyno)
+        elif corpus == 'multibyte':
+            log = FakeHerokuLog(DATE, log.text.translate(MULTIBYTE) +
+                                ' \U0001f600', dyno=log.dyno)
+        logs.append(log)
+    return logs
 
 
-def get_stats(worker):
-    """
-    generate statistics on a given worker and return them
-    :param worker: a worker object
-    :return:
+def drain_bodies(count, lines, corpus='plain', seed=0):
+    'count drain request bodies of lines log lines each'
+    logs = fake_logs(count * lines, corpus, seed)
+    return [b''.join(log.encode() for log in logs[i:i + lines])
+            for i in range(0, len(logs), lines)]
+
+
+def count_frames(body):
+    'the number of octet counted frames of a drain body'
+    count, pos = 0, 0
+    body = body.strip()
+    while pos < len(body):
+        space = body.index(b' ', pos)
+        pos = space + 1 + int(body[pos:space])
+        count += 1
+        while body[pos:pos + 1] in (b'\n', b'\r', b' '):
+            pos += 1
+    return count
+
+
+def read_bodies(paths):
+    'the drain bodies captured in the files, or the files of directories'
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+    bodies = []
+    for name in files:
+        with open(name, 'rb') as f:
+            bodies.append(f.read())
+    return bodies
+
+
+def percentile(values, percent):
+    'nearest-rank percentile of sorted values'
+    rank = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[rank]
+
+
+class Connection:
+    """ A keep-alive HTTP/1.1 connection, opened on first use and again
+    once the server closed it.
     """
-    stats = worker.get_stats()
-    return stats['sent'], stats['timeout']
 
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.stream = None
+
+    async def post(self, request):
+        'send a request, return the status code of the response'
+        if self.stream is None or self.stream.closed():
+            self.stream = await TCPClient().connect(self.host, self.port)
+        self.stream.write(request)
+        head = await self.stream.read_until(b'\r\n\r\n', max_bytes=65536)
+        lines = head.decode('latin1').split('\r\n', 1)
+        code = parse_response_start_line(lines[0]).code
+        headers = HTTPHeaders.parse(lines[1])
+        length = int(headers.get('Content-Length', 0))
+        if length:
+            await self.stream.read_bytes(length)
+        if headers.get('Connection', '').lower() == 'close':
+            self.close()
+        return code
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
 
-def run(url, client_count):
+
+class LoadGenerator:
     """
-    run the fake log generator targeting the given 'url' with 'clientCount'
-    clients
-    :param url: the target url
-    :param client_count: number of client to create (nb of threads)
-    :return:
+    Post the bodies in a loop over concurrency connections, at rate
+    requests per second when given, for duration seconds or until
+    requests were sent
     """
-    workers = [GenWorker(url) for _ in range(client_count)]
-    threads = list(map(start_thread, workers))
 
-    try:
-        last_sent = 0
-        last_timeout = 0
-        while True:
-            time.sleep(1)
-            [total_sent, total_timeout] = [sum(el) for el in zip(
-                                            *map(get_stats, workers))]
-            print('last second stats, sent:', total_sent - last_sent,
-                  'timeout:', total_timeout - last_timeout)
-            last_sent, last_timeout = total_sent, total_timeout
+    def __init__(self, host, port, path, bodies, concurrency=10, rate=None,
+                 duration=10, requests=None, timeout=10, interval=1):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.interval = interval
+        self.pool = asyncio.Queue()
+        for _ in range(concurrency):
+            self.pool.put_nowait(Connection(host, port))
+        self.url = 'http://%s:%d%s' % (host, port, path)
+        # every request but its frame id, and its line count
+        head = ('POST {} HTTP/1.1\r\nHost: {}:{}\r\n'
+                'Content-Type: application/logplex-1\r\n'
+                'Logplex-Drain-Token: d.{}\r\nUser-Agent: Logplex/v72\r\n'
+                'Logplex-Msg-Count: {{}}\r\nContent-Length: {{}}\r\n'
+                .format(path, host, port, uuid.uuid4()))
+        self.bodies = []
+        for body in bodies:
+            lines = count_frames(body)
+            self.bodies.append((head.format(lines, len(body)).encode(),
+                                body, lines))
+        self.frame_id = 0
+        self.sent = self.ok = self.lines = self.bytes = 0
+        self.errors = {}
+        self.latencies = []
+        self.last = dict(sent=0, ok=0, errors=0)
+        self.stopped = asyncio.Event()
 
-    except KeyboardInterrupt:
-        list(map(stop_thread, threads))
+    def next_request(self):
+        head, body, lines = self.bodies[self.frame_id % len(self.bodies)]
+        request = b'%sLogplex-Frame-Id: %d\r\n\r\n%s' % (head, self.frame_id,
+                                                         body)
+        self.frame_id += 1
+        self.sent += 1
+        if self.requests and self.sent >= self.requests:
+            self.stopped.set()
+        return request, lines, len(body)
 
+    async def post(self, scheduled=None):
+        request, lines, size = self.next_request()
+        connection = await self.pool.get()
+        start = monotonic() if scheduled is None else scheduled
+        try:
+            code = await asyncio.wait_for(connection.post(request),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            connection.close()
+            self.error('timeout')
+        except (StreamClosedError, OSError, ValueError) as e:
+            connection.close()
+            # the OSError a StreamClosedError was raised for, if any
+            self.error(type(getattr(e, 'real_error', None) or e).__name__)
+        else:
+            self.latencies.append(monotonic() - start)
+            if 200 <= code < 300:
+                self.ok += 1
+                self.lines += lines
+                self.bytes += size
+            else:
+                self.error('status_%d' % code)
+        finally:
+            self.pool.put_nowait(connection)
 
-if __name__ == '__main__':
-    if argv[1:]:
-        host = argv[1]
-        if ':' not in host:
-            host += '8080'
-    else:
-        host = '127.0.0.1:8080'
-    if argv[2:]:
-        url = argv[2]  # mobile/v1/production
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    async def closed_loop(self):
+        while not self.stopped.is_set():
+            await self.post()
+
+    async def open_loop(self):
+        start = monotonic()
+        pending = set()
+        count = 0
+        while not self.stopped.is_set():
+            due = start + count / self.rate
+            if due > monotonic():
+                await asyncio.sleep(due - monotonic())
+            task = asyncio.ensure_future(self.post(due))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            count += 1
+        if pending:
+            await asyncio.wait(pending)
+
+    async def progress(self):
+        while not self.stopped.is_set():
+            await asyncio.sleep(self.interval)
+            errors = sum(self.errors.values())
+            print(json.dumps(dict(sent=self.sent - self.last['sent'],
+                                  ok=self.ok - self.last['ok'],
+                                  errors=errors - self.last['errors'])),
+                  file=sys.stderr)
+            self.last = dict(sent=self.sent, ok=self.ok, errors=errors)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopped.set)
+        if self.duration:
+            loop.call_later(self.duration, self.stopped.set)
+        if self.interval:
+            asyncio.ensure_future(self.progress())
+        start = monotonic()
+        if self.rate:
+            await self.open_loop()
+        else:
+            await asyncio.gather(*[self.closed_loop()
+                                   for _ in range(self.concurrency)])
+        elapsed = monotonic() - start
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        report = dict(url=self.url, concurrency=self.concurrency,
+                      target_rate=self.rate, seconds=round(elapsed, 3),
+                      sent=self.sent, ok=self.ok, errors=self.errors,
+                      requests_per_sec=round(self.ok / elapsed, 1),
+                      lines_per_sec=round(self.lines / elapsed),
+                      mb_per_sec=round(self.bytes / elapsed / 2 ** 20, 3))
+        if latencies:
+            report['latency_ms'] = {
+                name: round(percentile(latencies, percent) * 1000, 3)
+                for name, percent in (('p50', 50), ('p90', 90),
+                                      ('p99', 99), ('p999', 99.9),
+                                      ('max', 100))}
+        return report
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('host', nargs='?', default='127.0.0.1:8080')
+    parser.add_argument('path', nargs='?',
+                        default='heroku/v1/production/DummyAppName')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='keep-alive connections')
+    parser.add_argument('--rate', type=float,
+                        help='requests per second, open loop')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds, 0 to stop on --requests only')
+    parser.add_argument('--requests', type=int,
+                        help='stop after sending this many requests')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--corpus', choices=CORPORA, default='plain')
+    parser.add_argument('--bodies', type=int, default=100,
+                        help='distinct bodies of the corpus')
+    parser.add_argument('--lines', type=int, default=10,
+                        help='log lines per body of the corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', nargs='+', metavar='PATH',
+                        help='post the drain bodies of these files '
+                             '(or of the files of these directories)')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between progress lines, 0 for none')
+    args = parser.parse_args()
+
+    host, _, port = args.host.partition(':')
+    if args.replay:
+        bodies = read_bodies(args.replay)
     else:
-        url = 'heroku/v1/production/DummyAppName'
-    run('http://%s/%s' % (host, url), 1)
+        bodies = drain_bodies(args.bodies, args.lines, args.corpus,
+                              args.seed)
+    generator = LoadGenerator(host, int(port or 8080),
+                              '/' + args.path.lstrip('/'), bodies,
+                              args.concurrency, args.rate, args.duration,
+                              args.requests, args.timeout, args.interval)
+    print(json.dumps(asyncio.run(generator.run()), sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
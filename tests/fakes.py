@@ -0,0 +1,123 @@
+"""In-process stand-ins for the AMQP broker, driven by the tornado IOLoop.
+"""
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from pika import spec
+from pika.frame import Method
+
+
+class FakeChannel:
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.is_open = True
+        self.published = []
+        # the properties of the published messages
+        self.properties = []
+        self.on_confirmation = None
+        self.close_callbacks = []
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def exchange_declare(self, callback, exchange, exchange_type):
+        self.connection.ioloop.add_callback(callback, None)
+
+    def queue_declare(self, callback, queue, durable, exclusive,
+                      auto_delete):
+        self.connection.ioloop.add_callback(callback, None)
+
+    def confirm_delivery(self, callback):
+        self.on_confirmation = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False):
+        if not self.is_open:
+            raise RuntimeError('channel is closed')
+        self.published.append((routing_key, body))
+        self.properties.append(properties)
+
+    def confirm(self, delivery_tag, multiple=False, ack=True):
+        'send a delivery confirmation from the broker'
+        method = spec.Basic.Ack if ack else spec.Basic.Nack
+        self.on_confirmation(Method(self.channel_number,
+                                    method(delivery_tag=delivery_tag,
+                                           multiple=multiple)))
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        self.is_open = False
+        for callback in self.close_callbacks:
+            self.connection.ioloop.add_callback(callback, self, reply_code,
+                                                reply_text)
+
+
+class FakeConnection:
+    """ Replace pika.TornadoConnection, the connection succeeds unless
+    FakeConnection.refuse is set.
+    """
+
+    refuse = False
+    instances = []
+
+    def __init__(self, parameters, on_open_callback,
+                 on_open_error_callback, on_close_callback, custom_ioloop):
+        self.ioloop = custom_ioloop
+        self.on_close_callback = on_close_callback
+        self.channels = []
+        self.is_open = False
+        FakeConnection.instances.append(self)
+        if self.refuse:
+            self.ioloop.add_callback(on_open_error_callback, self,
+                                     'Connection refused')
+        else:
+            self.is_open = True
+            self.ioloop.add_callback(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        channel = FakeChannel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        self.ioloop.add_callback(on_open_callback, channel)
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        'close the connection, or simulate a broker disconnection'
+        self.is_open = False
+        for channel in self.channels:
+            channel.is_open = False
+        self.ioloop.add_callback(self.on_close_callback, self, reply_code,
+                                 reply_text)
+
+
+def patch_pika():
+    'replace the pika connection used by heroku2elk.lib.amqp'
+    FakeConnection.refuse = False
+    FakeConnection.instances = []
+    return patch('heroku2elk.lib.amqp.pika.TornadoConnection',
+                 FakeConnection)
+
+
+PRE_FORK = """
+from tornado.ioloop import IOLoop
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib import metrics
+main.make_app(MainConfig())
+print(IOLoop.current(instance=False) is None, metrics._registry is None)
+"""
+
+
+def pre_fork_state(**environ):
+    """ make_app in a new interpreter, as the supervisor does before
+    forking the workers
+    :return: (no IOLoop was created, no metrics registry was created)
+    """
+    environ = dict(os.environ, PYTHONPATH=os.getcwd(), **environ)
+    with TemporaryDirectory() as tmp:
+        out = subprocess.check_output([sys.executable, '-c', PRE_FORK],
+                                      cwd=tmp, env=environ, text=True)
+    return tuple(value == 'True' for value in out.split())
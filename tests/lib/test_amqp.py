@@ -0,0 +1,294 @@
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton, BufferFull, \
+    DeliveryError, NackError
+from heroku2elk.lib.compression import decompress
+from tests.fakes import FakeConnection, patch_pika
+
+
+class AMQPConnectionTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.amqp_reconnect_min_delay = 0.01
+        self.conf.amqp_reconnect_max_delay = 0.05
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    def get_channel(self):
+        return AMQPConnectionSingleton().get_channel(self.conf, self.io_loop)
+
+    @gen_test
+    def test_connection_is_reused(self):
+        channels = yield [self.get_channel() for _ in range(10)]
+        channels.append((yield self.get_channel()))
+        self.assertEqual(len(FakeConnection.instances), 1)
+        self.assertEqual(len(set(map(id, channels))), 1)
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        self.assertEqual(conn.state, conn.OPEN)
+
+    @gen_test
+    def test_reconnect_after_connection_lost(self):
+        channel = yield self.get_channel()
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        channel.connection.close(320, 'CONNECTION_FORCED')
+        yield gen.moment
+        self.assertEqual(conn.state, conn.WAITING)
+        new_channel = yield self.get_channel()
+        self.assertIsNot(new_channel, channel)
+        self.assertEqual(len(FakeConnection.instances), 2)
+        self.assertEqual(conn.state, conn.OPEN)
+        self.assertEqual(conn.attempts, 0)
+
+    @gen_test
+    def test_waiters_fail_then_reconnect_with_backoff(self):
+        FakeConnection.refuse = True
+        with self.assertRaises(Exception):
+            yield self.get_channel()
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        self.assertEqual(conn.state, conn.WAITING)
+        while conn.attempts < 3:
+            with self.assertRaises(Exception):
+                yield self.get_channel()
+        FakeConnection.refuse = False
+        yield self.get_channel()
+        self.assertEqual(conn.state, conn.OPEN)
+        self.assertGreaterEqual(len(FakeConnection.instances), 4)
+
+    @gen_test
+    def test_no_reconnect_once_closed(self):
+        yield self.get_channel()
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        AMQPConnectionSingleton().close_channel()
+        yield gen.sleep(0.1)
+        self.assertEqual(conn.state, conn.CLOSED)
+        self.assertEqual(len(FakeConnection.instances), 1)
+
+
+class ChannelPoolTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.amqp_channel_pool_size = 3
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    @gen.coroutine
+    def publish(self, count):
+        channels = []
+        for _ in range(count):
+            channel = yield AMQPConnectionSingleton().get_channel(
+                self.conf, self.io_loop)
+            channel.basic_publish(exchange='logs', routing_key='a.b',
+                                  body='log')
+            channels.append(channel)
+        return channels
+
+    @gen_test
+    def test_least_in_flight_first(self):
+        yield AMQPConnectionSingleton().get_channel(self.conf, self.io_loop)
+        yield gen.moment
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        self.assertEqual(conn.in_flight(), {0: 0, 1: 0, 2: 0})
+        channels = yield self.publish(6)
+        self.assertEqual(conn.in_flight(), {0: 2, 1: 2, 2: 2})
+        self.assertEqual(len(set(map(id, channels))), 3)
+
+        channels[0].confirm(2, multiple=True)
+        self.assertEqual(conn.in_flight()[channels[0].index], 0)
+        channel, = yield self.publish(1)
+        self.assertIs(channel, channels[0])
+
+    @gen_test
+    def test_single_and_multiple_confirms(self):
+        yield AMQPConnectionSingleton().get_channel(self.conf, self.io_loop)
+        yield gen.moment
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        conn._channels = conn._channels[:1]
+        channel, = (yield self.publish(5))[:1]
+        channel.channel.confirm(2)
+        self.assertEqual(list(channel.unconfirmed), [1, 3, 4, 5])
+        channel.channel.confirm(4, multiple=True, ack=False)
+        self.assertEqual(list(channel.unconfirmed), [5])
+
+    @gen_test
+    def test_closed_channel_is_replaced(self):
+        yield AMQPConnectionSingleton().get_channel(self.conf, self.io_loop)
+        yield gen.moment
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        closed = conn._channels[1]
+        closed.close(406, 'PRECONDITION_FAILED')
+        yield gen.moment
+        self.assertEqual(sorted(conn.in_flight()), [0, 2])
+        channels = yield self.publish(4)
+        self.assertNotIn(closed, channels)
+        yield gen.moment
+        self.assertEqual(sorted(conn.in_flight()), [0, 1, 2])
+        self.assertIsNot(conn._channels[1], closed)
+        self.assertEqual(len(FakeConnection.instances), 1)
+
+
+class ConfirmTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.amqp_wait_confirms = True
+        self.conf.amqp_confirm_timeout = 0.2
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    @gen.coroutine
+    def publish(self, count):
+        futures = [AMQPConnectionSingleton().publish(self.conf, 'a.b', 'log')
+                   for _ in range(count)]
+        channel = yield AMQPConnectionSingleton().get_channel(self.conf,
+                                                              self.io_loop)
+        while len(channel.published) < count:
+            yield gen.moment
+        return channel, futures
+
+    @gen_test
+    def test_wait_for_ack(self):
+        channel, futures = yield self.publish(3)
+        channel.confirm(2)
+        yield futures[1]
+        self.assertFalse(futures[0].done() or futures[2].done())
+        channel.confirm(3, multiple=True)
+        yield [futures[0], futures[2]]
+        self.assertEqual(channel.in_flight, 0)
+
+    @gen_test
+    def test_nack(self):
+        channel, futures = yield self.publish(2)
+        channel.confirm(2, multiple=True, ack=False)
+        for future in futures:
+            with self.assertRaises(NackError):
+                yield future
+
+    @gen_test
+    def test_timeout(self):
+        channel, (future,) = yield self.publish(1)
+        with self.assertRaises(DeliveryError):
+            yield future
+
+    @gen_test
+    def test_connection_lost(self):
+        channel, (future,) = yield self.publish(1)
+        channel.connection.close(320, 'CONNECTION_FORCED')
+        with self.assertRaises(DeliveryError):
+            yield future
+
+
+class OutboundBufferTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.amqp_outbound_max_messages = 3
+        self.conf.amqp_outbound_max_bytes = 10
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    def publish(self, body='log'):
+        return AMQPConnectionSingleton().publish(self.conf, 'a.b', body)
+
+    @gen_test
+    def test_message_limit(self):
+        # queued while the connection is being opened
+        futures = [self.publish() for _ in range(3)]
+        buffer = AMQPConnectionSingleton().get_connection(self.conf).buffer
+        self.assertEqual((buffer.messages, buffer.bytes), (3, 9))
+        with self.assertRaises(BufferFull):
+            yield self.publish()
+        yield futures
+        channel = yield AMQPConnectionSingleton().get_channel(self.conf,
+                                                              self.io_loop)
+        self.assertEqual(len(channel.published), 3)
+        channel.confirm(2, multiple=True)
+        self.assertEqual((buffer.messages, buffer.bytes), (1, 3))
+        self.assertEqual(buffer.reset_high_water(), 3)
+        yield self.publish()
+        self.assertEqual(buffer.messages, 2)
+
+    @gen_test
+    def test_byte_limit(self):
+        yield self.publish('x' * 8)
+        with self.assertRaises(BufferFull):
+            yield self.publish('xxx')
+        yield self.publish('xx')
+
+    @gen_test
+    def test_released_on_connection_lost(self):
+        yield [self.publish(), self.publish()]
+        channel = yield AMQPConnectionSingleton().get_channel(self.conf,
+                                                              self.io_loop)
+        buffer = AMQPConnectionSingleton().get_connection(self.conf).buffer
+        self.assertEqual(buffer.messages, 2)
+        channel.connection.close(320, 'CONNECTION_FORCED')
+        yield gen.moment
+        self.assertEqual((buffer.messages, buffer.bytes), (0, 0))
+
+
+class CompressionTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.publish_compression = 'gzip'
+        self.conf.publish_compression_min_bytes = 100
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    @gen_test
+    def test_large_messages_are_compressed(self):
+        singleton = AMQPConnectionSingleton()
+        properties = singleton.AMQPConnection.properties(
+            'application/x-ndjson')
+        yield [singleton.publish(self.conf, 'a.b', '{"n": 1}\n' * 100,
+                                 properties),
+               singleton.publish(self.conf, 'a.b', '{"n": 1}\n')]
+        channel = yield singleton.get_channel(self.conf, self.io_loop)
+        (_, compressed), (_, small) = channel.published
+        large_properties, small_properties = channel.properties
+        self.assertEqual(large_properties.content_encoding, 'gzip')
+        self.assertEqual(large_properties.content_type,
+                         'application/x-ndjson')
+        self.assertEqual(decompress(compressed, 'gzip'),
+                         b'{"n": 1}\n' * 100)
+        self.assertEqual(small, '{"n": 1}\n')
+        self.assertIsNone(small_properties.content_encoding)
@@ -0,0 +1,56 @@
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.batch import BatchPublisher
+
+
+class BatchPublisherTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.amqp_batch_max_lines = 3
+        self.conf.amqp_batch_max_bytes = 100
+        self.conf.amqp_batch_linger_ms = 10
+        self.published = []
+        self.batcher = BatchPublisher(self.conf, self.publish)
+
+    @gen.coroutine
+    def publish(self, routing_key, body):
+        if routing_key == 'broken':
+            raise RuntimeError('AMQP is down')
+        self.published.append((routing_key, body))
+
+    @gen_test
+    def test_linger(self):
+        futures = [self.batcher.add('a', '{"n": %d}' % i) for i in range(2)]
+        futures.append(self.batcher.add('b', '{"n": 2}'))
+        self.assertEqual(self.published, [])
+        yield futures
+        self.assertEqual(sorted(self.published), [
+            ('a', b'{"n": 0}\n{"n": 1}\n'), ('b', b'{"n": 2}\n')])
+
+    @gen_test
+    def test_max_lines(self):
+        futures = [self.batcher.add('a', '{"n": %d}' % i) for i in range(4)]
+        yield futures[:3]
+        self.assertEqual(self.published, [
+            ('a', b'{"n": 0}\n{"n": 1}\n{"n": 2}\n')])
+        self.assertFalse(futures[3].done())
+        yield futures[3]
+        self.assertEqual(self.published[1], ('a', b'{"n": 3}\n'))
+
+    @gen_test
+    def test_max_bytes(self):
+        line = '"%s"' % ('x' * 58)
+        yield [self.batcher.add('a', line) for i in range(3)]
+        self.assertEqual([body.count(b'\n') for _, body in self.published],
+                         [1, 1, 1])
+        self.assertTrue(all(len(body) <= 100 for _, body in self.published))
+
+    @gen_test
+    def test_publish_error(self):
+        future = self.batcher.add('broken', '{}')
+        with self.assertRaises(RuntimeError):
+            yield future
@@ -0,0 +1,66 @@
+import gzip
+import zlib
+import unittest
+
+from heroku2elk.lib.compression import BodyTooLarge, Compressor, \
+    DecompressionError, Decompressor, UnsupportedEncoding, decompress
+
+
+body = b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 " \
+       b"- State changed from starting to up\n" * 100
+
+
+class DecompressorTest(unittest.TestCase):
+
+    def decompress_chunks(self, decompressor, data, size=7):
+        chunks = [decompressor.decompress(data[i:i + size])
+                  for i in range(0, len(data), size)]
+        decompressor.close()
+        return b''.join(chunks)
+
+    def test_gzip_chunks(self):
+        decompressor = Decompressor('gzip', 2**20)
+        self.assertEqual(self.decompress_chunks(decompressor,
+                                                gzip.compress(body)), body)
+        self.assertEqual(decompressor.size, len(body))
+
+    def test_deflate(self):
+        decompressor = Decompressor('deflate', 2**20)
+        self.assertEqual(self.decompress_chunks(decompressor,
+                                                zlib.compress(body)), body)
+
+    def test_zip_bomb(self):
+        bomb = zlib.compress(b'\0' * 2**24, 9)
+        decompressor = Decompressor('deflate', 2**20)
+        with self.assertRaises(BodyTooLarge):
+            decompressor.decompress(bomb)
+        self.assertLessEqual(decompressor.size, 2**20 + 1)
+
+    def test_unbounded(self):
+        body = b'\0' * 2**21
+        decompressor = Decompressor('deflate', -1)
+        self.assertEqual(self.decompress_chunks(decompressor,
+                                                zlib.compress(body)), body)
+
+    def test_invalid(self):
+        with self.assertRaises(UnsupportedEncoding):
+            Decompressor('br', 2**20)
+        with self.assertRaises(DecompressionError):
+            Decompressor('gzip', 2**20).decompress(b'not gzipped')
+        decompressor = Decompressor('gzip', 2**20)
+        decompressor.decompress(gzip.compress(body)[:-10])
+        with self.assertRaises(DecompressionError):
+            decompressor.close()
+
+
+class CompressorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for encoding in ('zlib', 'gzip'):
+            compressed = Compressor(encoding).compress(body)
+            self.assertLess(len(compressed), len(body))
+            self.assertEqual(decompress(compressed, encoding), body)
+        self.assertEqual(Compressor('gzip').compress(body),
+                         Compressor('gzip').compress(body))
+        with self.assertRaises(ValueError):
+            Compressor('lz4')
@@ -0,0 +1,81 @@
+import json
+import unittest
+
+from heroku2elk.lib.envelope import BACKENDS, DictEncoder, FieldsEncoder, \
+    TemplateEncoder, get_quote, json_quote
+from heroku2elk.lib.routes import heroku_route
+
+
+logs = ['<40>1 2017-06-14T13:52:29+00:00 host app web.3 - State changed',
+        'quotes " and \\ backslashes\t{"token":"x"} </script>',
+        'unicode caf\xe9 中文 \U0001f600   and \x00\x1f\x7f controls',
+        '']
+
+
+class EnvelopeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.route = heroku_route('/heroku/v1/integration/toto')
+
+    def reference(self, log):
+        return json.dumps(dict(type='heroku', parser_ver='v1',
+                               env='integration', app='toto', message=log,
+                               http_content_length=len(log)))
+
+    def test_encoders_as_json_dumps(self):
+        encoders = [DictEncoder(), TemplateEncoder()]
+        encoders += [TemplateEncoder(get_quote(name)) for name in BACKENDS]
+        for encoder in encoders:
+            for log in logs:
+                self.assertEqual(encoder.encode(self.route, log),
+                                 self.reference(log))
+
+    def test_header_fields(self):
+        route = heroku_route('/heroku/v1/integration/toto', '-rfc5424')
+        for encoder in [DictEncoder(), TemplateEncoder()]:
+            encoder = FieldsEncoder(encoder)
+            self.assertEqual(encoder.parser_ver_suffix, '-rfc5424')
+            envelope = json.loads(encoder.encode(route, logs[0]))
+            self.assertEqual(envelope, dict(
+                type='heroku', parser_ver='v1-rfc5424', env='integration',
+                app='toto', message='State changed', http_content_length=62,
+                syslog5424_pri='40', syslog5424_ver='1',
+                timestamp='2017-06-14T13:52:29+00:00', heroku_drain_id='host',
+                heroku_source='app', heroku_dyno='web.3'))
+            # lines without header are left as is
+            log = logs[1]
+            self.assertEqual(encoder.encode(route, log), json.dumps(dict(
+                route.fields, message=log, http_content_length=len(log))))
+
+    def test_json_fields(self):
+        log = '<40>1 2017-06-14T13:52:29+00:00 host app web.3 -  {"msg": ' \
+              '"caf\xe9", "pid": 12, "level": null, "userId": false, ' \
+              '"requestId": {"id": [1]}} '
+        for encoder in [DictEncoder(), TemplateEncoder()]:
+            encoder = FieldsEncoder(encoder, header=False, json_keys=[
+                'msg', 'level', 'pid', 'userId', 'requestId', 'driverId'])
+            self.assertEqual(encoder.parser_ver_suffix, '-json')
+            envelope = json.loads(encoder.encode(self.route, log))
+            self.assertEqual(envelope['message'], log)
+            self.assertEqual({key: value for key, value in envelope.items()
+                              if key.startswith('app_')},
+                             dict(app_msg='caf\xe9', app_pid='12',
+                                  app_requestId='{"id": [1]}'))
+            self.assertNotIn('syslog5424_pri', envelope)
+            # messages which are not JSON objects are not parsed
+            for line in logs + ['{"msg": "truncated', '["msg"]']:
+                self.assertEqual(encoder.encode(self.route, line),
+                                 self.reference(line))
+
+    def test_deeply_nested_json(self):
+        message = '{"stack": ' + '[' * 100000 + ']' * 100000 + '}'
+        encoder = FieldsEncoder(TemplateEncoder(), header=False,
+                                json_keys=['stack'])
+        self.assertEqual(encoder.encode(self.route, message),
+                         self.reference(message))
+
+    def test_fallback_to_json(self):
+        self.assertIs(get_quote('missing'), json_quote)
+        BACKENDS['broken'] = lambda: str
+        self.addCleanup(BACKENDS.pop, 'broken')
+        self.assertIs(get_quote('broken'), json_quote)
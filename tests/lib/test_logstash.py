@@ -0,0 +1,188 @@
+import json
+from unittest.mock import patch
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test, \
+    bind_unused_port
+
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import BufferFull, DeliveryError
+from heroku2elk.lib.logstash import LogstashConnection, LogstashPool, \
+    parse_endpoints
+from heroku2elk.lib.outputs import LogstashOutput
+from tests.fakes import pre_fork_state
+
+
+payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+           b"- State changed from starting to up\n"
+           b"119 <40>1 2017-06-14T13:53:26+00:00 host app web.3 "
+           b"- Starting process "
+           b"with command `bundle exec rackup config.ru -p 24405`")
+
+
+class FakeLogstash(TCPServer):
+    'a logstash tcp input, keeping the lines it reads'
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.streams = []
+
+    async def handle_stream(self, stream, address):
+        self.streams.append(stream)
+        try:
+            while True:
+                self.lines.append(await stream.read_until(b'\n'))
+        except StreamClosedError:
+            pass
+
+    def drop_connections(self):
+        for stream in self.streams:
+            stream.close()
+
+
+class LogstashTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.logstash_reconnect_min_delay = 0.01
+        self.conf.logstash_reconnect_max_delay = 0.01
+        self.server = FakeLogstash()
+        sock, self.port = bind_unused_port()
+        self.server.add_sockets([sock])
+        self.conf.logstash_hosts = '127.0.0.1:%d' % self.port
+        # closed before the IOLoop
+        self.closing = [self.server]
+
+    def tearDown(self):
+        for obj in self.closing:
+            if obj is self.server:
+                self.server.drop_connections()
+                self.server.stop()
+            else:
+                obj.close()
+        super().tearDown()
+
+    def connection(self):
+        connection = LogstashConnection('127.0.0.1', self.port, self.conf)
+        self.closing.append(connection)
+        return connection
+
+    @gen.coroutine
+    def wait_lines(self, count):
+        while len(self.server.lines) < count:
+            yield gen.sleep(0.001)
+
+    def test_parse_endpoints(self):
+        self.assertEqual(parse_endpoints('ls1:5000, 10.0.0.2:5001'),
+                         [('ls1', 5000), ('10.0.0.2', 5001)])
+
+    @gen_test
+    def test_coalesced_writes(self):
+        connection = self.connection()
+        futures = [connection.send(b'{"n": %d}\n' % i) for i in range(10)]
+        yield futures
+        yield self.wait_lines(10)
+        self.assertEqual(self.server.lines,
+                         [b'{"n": %d}\n' % i for i in range(10)])
+        futures = [connection.send(b'{"n": %d}\n' % i) for i in range(10)]
+        self.assertTrue(connection.writing)
+        yield futures
+        self.assertFalse(connection.chunks)
+
+    @gen_test
+    def test_buffer_full(self):
+        self.conf.logstash_max_buffer_bytes = 15
+        connection = self.connection()
+        first = connection.send(b'{"n": 1}\n')
+        with self.assertRaises(BufferFull):
+            yield connection.send(b'{"n": 2}\n')
+        yield first
+
+    @gen_test
+    def test_reconnect(self):
+        connection = self.connection()
+        yield connection.send(b'{"n": 1}\n')
+        yield self.wait_lines(1)
+        self.server.drop_connections()
+        while connection.state == connection.OPEN:
+            yield gen.sleep(0.001)
+        # the backoff elapses, and the connection is opened again
+        while connection.state != connection.OPEN:
+            yield gen.sleep(0.001)
+        yield connection.send(b'{"n": 2}\n')
+        yield self.wait_lines(2)
+        self.assertEqual(connection.attempts, 0)
+
+    @gen_test
+    def test_unreachable(self):
+        self.server.stop()
+        self.closing.remove(self.server)
+        connection = self.connection()
+        with self.assertRaises(DeliveryError):
+            yield connection.send(b'{"n": 1}\n')
+        self.assertEqual(connection.state, connection.WAITING)
+        # the pool skips the connections waiting to reconnect
+        pool = LogstashPool(self.conf)
+        pool.connections = [connection]
+        with self.assertRaises(DeliveryError):
+            yield pool.send(b'{"n": 2}\n')
+
+    @gen_test
+    def test_output(self):
+        self.conf.logstash_pool_size = 2
+        output = LogstashOutput(self.conf)
+        self.closing.append(output)
+        yield output.start()
+        yield [output.publish([('a.b', '{"n": 1}'), ('a.b', '{"n": 2}')]),
+               output.publish_one('a.b', b'{"n": 3}\n{"n": 4}\n')]
+        yield self.wait_lines(4)
+        self.assertEqual(sorted(self.server.lines),
+                         [b'{"n": %d}\n' % i for i in range(1, 5)])
+
+
+class LogstashHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.server = FakeLogstash()
+        sock, port = bind_unused_port()
+        self.server.add_sockets([sock])
+        conf = MainConfig()
+        conf.environments = ['integration']
+        conf.output = 'null'
+        conf.handler_outputs = {'heroku': 'logstash'}
+        conf.logstash_hosts = '127.0.0.1:%d' % port
+        self.app = main.make_app(conf)
+        return self.app
+
+    def tearDown(self):
+        main.close_app(self.app)
+        self.server.stop()
+        super().tearDown()
+
+    def test_api_output(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=payload)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.app.output.messages, 0)
+        while len(self.server.lines) < 2:
+            self.io_loop.run_sync(lambda: gen.sleep(0.001))
+        envelopes = [json.loads(line) for line in self.server.lines]
+        self.assertEqual([e['app'] for e in envelopes], ['toto', 'toto'])
+
+    def test_handlers_conf(self):
+        conf = MainConfig()
+        self.assertEqual(conf.handler_outputs, {})
+        environ = {'HANDLERS': 'HerokuHandler:heroku:v1:logstash,'
+                               'GenericOutputHandler:mobile:v1'}
+        with patch.dict('os.environ', environ):
+            conf = MainConfig()
+        self.assertEqual(conf.handler_outputs, {'heroku': 'logstash'})
+        self.assertEqual(list(conf.handlers), ['heroku', 'mobile'])
+
+    def test_no_loop_before_fork(self):
+        self.assertEqual(pre_fork_state(OUTPUT='logstash'), (True, True))
@@ -0,0 +1,108 @@
+from datetime import timedelta
+import socket
+import unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.metrics import MetricsRegistry, close_metrics, \
+    get_metrics
+
+
+class FakeStatsd:
+    'a local UDP socket standing for the statsd server'
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.settimeout(1)
+        self.port = self.socket.getsockname()[1]
+
+    def packets(self):
+        packets = []
+        self.socket.setblocking(False)
+        try:
+            while True:
+                packets.append(self.socket.recv(65536))
+        except BlockingIOError:
+            return packets
+        finally:
+            self.socket.settimeout(1)
+
+    def close(self):
+        self.socket.close()
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsd()
+        self.addCleanup(self.statsd.close)
+        self.metrics = MetricsRegistry('127.0.0.1', self.statsd.port,
+                                       'h2l', packet_size=100)
+        self.addCleanup(self.metrics.close)
+
+    def test_aggregation(self):
+        for _ in range(1000):
+            self.metrics.incr('input.heroku', count=1)
+        self.metrics.incr('amqp.output_delivered', count=3)
+        self.metrics.gauge('amqp.connected', 0)
+        self.metrics.gauge('amqp.connected', 1)
+        self.metrics.gauge('spool.bytes', -2)
+        self.metrics.gauge('amqp.outbound.messages', 5, delta=True)
+        self.metrics.gauge('amqp.outbound.messages', -2, delta=True)
+        self.metrics.timing('request', 1.5)
+        self.metrics.timing('request', timedelta(milliseconds=2))
+        self.metrics.flush()
+        lines = b'\n'.join(self.statsd.packets()).decode().split('\n')
+        self.assertEqual(lines, [
+            'h2l.input.heroku:1000|c',
+            'h2l.amqp.output_delivered:3|c',
+            'h2l.amqp.connected:1|g',
+            'h2l.spool.bytes:0|g',
+            'h2l.spool.bytes:-2|g',
+            'h2l.amqp.outbound.messages:+3|g',
+            'h2l.request:1.500|ms',
+            'h2l.request:2.000|ms'])
+        # reset once flushed
+        self.metrics.flush()
+        self.assertEqual(self.statsd.packets(), [])
+
+    def test_packet_size(self):
+        for i in range(20):
+            self.metrics.incr('counter_%02d' % i)
+        self.metrics.flush()
+        packets = self.statsd.packets()
+        self.assertEqual(len(packets), 4)
+        self.assertTrue(all(len(packet) <= 100 for packet in packets))
+        lines = b'\n'.join(packets).split(b'\n')
+        self.assertEqual(lines, [b'h2l.counter_%02d:1|c' % i
+                                 for i in range(20)])
+
+
+class PeriodicFlushTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.statsd = FakeStatsd()
+        self.addCleanup(self.statsd.close)
+        self.conf = MainConfig()
+        self.conf.metrics_host = '127.0.0.1'
+        self.conf.metrics_port = self.statsd.port
+        self.conf.metrics_flush_interval = 10
+        # created on first use, possibly by another test
+        close_metrics()
+
+    def tearDown(self):
+        close_metrics()
+        super().tearDown()
+
+    @gen_test
+    def test_shared_and_flushed_periodically(self):
+        metrics = get_metrics(self.conf)
+        self.assertIs(get_metrics(self.conf), metrics)
+        metrics.incr('heartbeat')
+        yield gen.sleep(0.05)
+        self.assertEqual(self.statsd.packets(),
+                         [b'heroku2logstash.heartbeat:1|c'])
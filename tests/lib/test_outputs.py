@@ -0,0 +1,145 @@
+import gzip
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from tornado.concurrent import Future
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.metrics import get_metrics
+from heroku2elk.lib.outputs import AMQPOutput, FileOutput, NullOutput, \
+    gather, make_output
+from tests.fakes import patch_pika
+
+
+payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+           b"- State changed from starting to up\n"
+           b"119 <40>1 2017-06-14T13:53:26+00:00 host app web.3 "
+           b"- Starting process "
+           b"with command `bundle exec rackup config.ru -p 24405`")
+
+
+class OutputsTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.conf.output_file_path = os.path.join(tmp.name, 'out.ndjson')
+
+    def test_make_output(self):
+        for name, class_ in (('amqp', AMQPOutput), ('null', NullOutput),
+                             ('file', FileOutput)):
+            self.conf.output = name
+            self.assertIsInstance(make_output(self.conf), class_)
+        self.conf.output = 'kafka'
+        with self.assertRaises(ValueError):
+            make_output(self.conf)
+
+    @gen_test
+    def test_gather(self):
+        futures = [Future() for _ in range(3)]
+        result = gather(futures)
+        futures[1].set_exception(RuntimeError('nack'))
+        futures[0].set_result(None)
+        self.assertFalse(result.done())
+        futures[2].set_exception(ValueError('late'))
+        with self.assertRaises(RuntimeError):
+            yield result
+        yield gather([])
+
+    @gen_test
+    def test_null(self):
+        output = NullOutput(self.conf)
+        yield output.publish([('a.b', 'log 1'), ('a.c', b'log 2')])
+        yield output.publish_one('a.b', 'log 3')
+        self.assertEqual((output.messages, output.bytes), (3, 15))
+
+    @gen_test
+    def test_file(self):
+        output = FileOutput(self.conf)
+        yield output.publish([('a.b', '{"n": 1}'), ('a.c', b'{"n": 2}')])
+        yield output.publish_one('a.b', b'{"n": 3}\n{"n": 4}\n',
+                                 'application/x-ndjson')
+        output.close()
+        with open(self.conf.output_file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'{"n": 1}\n{"n": 2}\n'
+                                       b'{"n": 3}\n{"n": 4}\n')
+
+    @gen_test
+    def test_file_per_worker(self):
+        # built before the fork, opened by the worker
+        output = FileOutput(self.conf)
+        with patch('heroku2elk.lib.outputs.worker_id', return_value=2):
+            yield output.publish_one('a.b', '{"n": 1}')
+        output.close()
+        with open(self.conf.output_file_path + '.2', 'rb') as f:
+            self.assertEqual(f.read(), b'{"n": 1}\n')
+        self.assertFalse(os.path.exists(self.conf.output_file_path))
+
+    @gen_test
+    def test_amqp(self):
+        with patch_pika():
+            output = AMQPOutput(self.conf)
+            self.addCleanup(output.close)
+            channel = yield output.start()
+            yield output.publish([('a.b', 'log 1'), ('a.c', 'log 2')])
+            yield output.publish_one('a.b', 'log 3', 'application/x-ndjson')
+        self.assertEqual(channel.published, [('a.b', 'log 1'),
+                                             ('a.c', 'log 2'),
+                                             ('a.b', 'log 3')])
+
+
+class FileOutputHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        conf = MainConfig()
+        conf.environments = ['integration']
+        conf.output = 'file'
+        conf.output_file_path = os.path.join(tmp.name, 'out.ndjson')
+        self.app = main.make_app(conf)
+        return self.app
+
+    def tearDown(self):
+        main.close_app(self.app)
+        super().tearDown()
+
+    def test_heroku_to_file(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=payload)
+        self.assertEqual(response.code, 200)
+        self.app.output.close()
+        with open(self.app.conf.output_file_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('State changed from starting to up', lines[0])
+
+    def test_gzip_body(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=gzip.compress(payload),
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.code, 200)
+        self.app.output.close()
+        with open(self.app.conf.output_file_path) as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+    def test_failed_publish_counted_per_message(self):
+        failed = Future()
+        failed.set_exception(RuntimeError('disk full'))
+        statsd = get_metrics(self.app.conf)
+        with patch.object(self.app.output, 'publish', return_value=failed), \
+                patch.object(statsd, 'incr') as incr:
+            response = self.fetch('/heroku/v1/integration/toto',
+                                  method='POST', body=payload)
+        self.assertEqual(response.code, 500)
+        incr.assert_any_call('amqp.output_exception', count=2)
+
+    def test_unsupported_encoding(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=payload, headers={'Content-Encoding': 'br'})
+        self.assertEqual(response.code, 415)
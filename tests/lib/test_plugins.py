@@ -0,0 +1,90 @@
+import unittest
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib import plugins
+from heroku2elk.lib.syslog import Splitter
+
+
+line = ("<40>1 2017-06-21T17:02:55+00:00 host ponzi web.1 - Lorem ipsum dolor"
+        " sit amet, consecteteur adipiscing elit.{\"token\":\"sdfs\"}")
+
+
+class LineFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = MainConfig()
+        self.conf.truncate_max_msg_length = 100
+
+    def test_sameAsPlugins(self):
+        expected = plugins.truncate(plugins.obfuscate_token(line, self.conf),
+                                    self.conf)
+        self.assertEqual(plugins.LineFilter(self.conf)(line), expected)
+        self.assertIn('__TRUNCATED__', expected)
+
+    def test_obfuscateWithoutTruncation(self):
+        self.conf.truncate_activated = False
+        self.assertEqual(plugins.LineFilter(self.conf)(line),
+                         line.replace('sdfs', '__TOKEN_REPLACED__'))
+
+    def test_keepStackTraces(self):
+        stack = line + ' stack'
+        self.assertEqual(plugins.LineFilter(self.conf)(stack),
+                         stack.replace('sdfs', '__TOKEN_REPLACED__'))
+
+    def test_pluginFilterStage(self):
+        self.conf.filter_stage = 'plugins'
+        frame = line.encode()
+        logs = Splitter(self.conf).split(b'%d %s' % (len(frame), frame))
+        self.assertEqual(logs, [line])
+
+
+class PluginChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = MainConfig()
+        self.conf.truncate_max_msg_length = 100
+        self.conf.plugins = {'*': {'*': [plugins.obfuscate_token,
+                                         plugins.truncate]}}
+
+    def test_batchVersionsSameAsPlugins(self):
+        payloads = [line, line + ' stack', 'short', 'no token here' * 10,
+                    '']
+        for payload in payloads:
+            expected = plugins.truncate(
+                plugins.obfuscate_token(payload, self.conf), self.conf)
+            chain = plugins.PluginChain.compile(self.conf, 'heroku', 'v1')
+            self.assertEqual(chain([payload]), [expected])
+        chain = plugins.PluginChain.compile(self.conf, 'heroku', 'v1')
+        self.assertEqual(chain(payloads), [plugins.truncate(
+            plugins.obfuscate_token(payload, self.conf), self.conf)
+            for payload in payloads])
+
+    def test_anchoredTokenPattern(self):
+        self.conf.token_pattern = '^(token=)(.*?)( )'
+        chain = plugins.PluginChain.compile(self.conf, 'heroku', 'v1')
+        self.assertEqual(chain(['a', 'token=x y']),
+                         ['a', 'token=__TOKEN_REPLACED__ y'])
+
+    def test_compile(self):
+        def upper(payload, conf):
+            return payload.upper()
+
+        @plugins.batch_plugin
+        def drop_debug(payloads, conf):
+            return [p for p in payloads if 'DEBUG' not in p]
+
+        self.conf.plugins = {'heroku': {'v1': [upper], '*': [drop_debug]},
+                             '*': {'*': [plugins.truncate]}}
+        chain = plugins.PluginChain.compile(self.conf, 'heroku', 'v1')
+        self.assertEqual(chain.plugins, [drop_debug, upper, plugins.truncate])
+        self.assertEqual(chain(['DEBUG x', 'info y']), ['INFO Y'])
+        # line filters are done before the chain
+        chain = plugins.PluginChain.compile(self.conf, 'heroku', 'v2', True)
+        self.assertEqual(chain.plugins, [drop_debug])
+        chain = plugins.PluginChain.compile(self.conf, 'mobile', 'v1')
+        self.assertEqual(chain(['x' * 200]), [plugins.truncate('x' * 200,
+                                                               self.conf)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import json
+from unittest.mock import patch
+
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase
+
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.ratelimit import RateLimiter
+from heroku2elk.lib.routes import heroku_route
+from tests.fakes import FakeConnection, patch_pika, pre_fork_state
+
+
+class RateLimiterTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf = MainConfig()
+        self.conf.rate_limit_app_rate = 10
+        self.conf.rate_limit_app_burst = 20
+        self.now = 0
+        self.route = heroku_route('/heroku/v1/production/toto')
+        self.payloads = ['{"n": %d}' % i for i in range(30)]
+
+    def limiter(self):
+        return RateLimiter(self.conf, clock=lambda: self.now)
+
+    def test_app_bucket(self):
+        limiter = self.limiter()
+        self.assertEqual(limiter.limit(self.route, self.payloads),
+                         self.payloads[:20])
+        self.assertEqual(limiter.limit(self.route, self.payloads), [])
+        # the other apps have their own bucket
+        self.assertEqual(limiter.admit('production', 'titi', 5), 5)
+        self.now = 1.5
+        self.assertEqual(limiter.admit('production', 'toto', 30), 15)
+        self.now = 100
+        self.assertEqual(limiter.admit('production', 'toto', 30), 20)
+
+    def test_env_bucket_and_overrides(self):
+        self.conf.rate_limit_app_rate = 0
+        self.conf.rate_limit_env_rate = self.conf.rate_limit_env_burst = 25
+        self.conf.rate_limit_overrides = {'titi': (5, 5)}
+        limiter = self.limiter()
+        self.assertEqual(limiter.admit('production', 'titi', 10), 5)
+        self.assertEqual(limiter.admit('production', 'toto', 30), 20)
+        self.assertEqual(limiter.admit('integration', 'toto', 30), 25)
+
+    def test_idle_eviction(self):
+        self.conf.rate_limit_idle_seconds = 10
+        limiter = self.limiter()
+        limiter.admit('production', 'toto', 30)
+        self.now = 5
+        limiter.admit('production', 'titi', 1)
+        self.now = 12
+        limiter.admit('production', 'tata', 1)
+        self.assertEqual(list(limiter.buckets),
+                         [('production', 'titi'), ('production', 'tata')])
+
+    def test_sample(self):
+        self.conf.rate_limit_mode = 'sample'
+        self.conf.rate_limit_sample_rate = 0.5
+        limiter = self.limiter()
+        limiter.random.seed(0)
+        payloads = limiter.limit(self.route, self.payloads * 10)
+        self.assertEqual(payloads[:20], self.payloads[:20])
+        sampled = [json.loads(payload) for payload in payloads[20:]]
+        self.assertTrue(120 < len(sampled) < 200)
+        self.assertEqual({envelope['sampled_rate'] for envelope in sampled},
+                         {0.5})
+
+    def test_overrides_conf(self):
+        environ = {'RATE_LIMIT_OVERRIDES': 'toto:100:500, titi:50'}
+        with patch.dict('os.environ', environ):
+            conf = MainConfig()
+        self.assertEqual(conf.rate_limit_overrides,
+                         {'toto': (100, 500), 'titi': (50, 50)})
+        for rate in ('0', '2'):
+            with patch.dict('os.environ', {'RATE_LIMIT_SAMPLE_RATE': rate}):
+                with self.assertRaises(ValueError):
+                    MainConfig()
+
+    def test_metric_names(self):
+        limiter = self.limiter()
+        route = heroku_route('/heroku/v1/production/my.app:1|c')
+        with patch('heroku2elk.lib.ratelimit.get_metrics') as get_metrics:
+            limiter.limit(route, self.payloads)
+        stats = [call[1][0] for call in get_metrics().mock_calls]
+        self.assertIn('rate_limit.dropped.my_app_1_c', stats)
+
+
+class RateLimitHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        conf = MainConfig()
+        conf.environments = ['integration']
+        conf.rate_limit_activated = True
+        conf.rate_limit_app_burst = 1
+        self.app = main.make_app(conf)
+        return self.app
+
+    def setUp(self):
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+        super().setUp()
+
+    def tearDown(self):
+        main.close_app(self.app)
+        super().tearDown()
+
+    def test_over_limit_lines_are_dropped(self):
+        payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+                   b"- State changed from starting to up\n") * 3
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=payload)
+        self.assertEqual(response.code, 200)
+        published = [body for connection in FakeConnection.instances
+                     for channel in connection.channels
+                     for _, body in channel.published]
+        self.assertEqual(len(published), 1)
+
+    def test_no_loop_before_fork(self):
+        self.assertEqual(pre_fork_state(RATE_LIMIT_ACTIVATION='true'),
+                         (True, True))
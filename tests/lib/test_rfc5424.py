@@ -0,0 +1,42 @@
+import unittest
+
+from heroku2elk.lib.rfc5424 import parse_header
+
+
+class ParseHeaderTest(unittest.TestCase):
+
+    def test_heroku_line(self):
+        header, message = parse_header(
+            '<40>1 2017-06-21T17:02:55+00:00 host app web.1 - State changed')
+        self.assertEqual(header, [
+            ('syslog5424_pri', '40'), ('syslog5424_ver', '1'),
+            ('timestamp', '2017-06-21T17:02:55+00:00'),
+            ('heroku_drain_id', 'host'), ('heroku_source', 'app'),
+            ('heroku_dyno', 'web.1')])
+        self.assertEqual(message, 'State changed')
+
+    def test_structured_data(self):
+        header, message = parse_header(
+            '<13>1 - h app - ID7 [a x="]"][b] [c] msg')
+        self.assertEqual(header, [
+            ('syslog5424_pri', '13'), ('syslog5424_ver', '1'),
+            ('heroku_drain_id', 'h'), ('heroku_source', 'app'),
+            ('syslog5424_msgid', 'ID7'), ('syslog5424_sd', '[a x="]"][b]')])
+        self.assertEqual(message, '[c] msg')
+        # a nil structured data is dropped, as grok does
+        self.assertEqual(parse_header('<1>1 - - - - -  -  msg')[1], 'msg')
+        self.assertEqual(parse_header('<1>1 - - - - - [x]')[1], '[x]')
+
+    def test_runs_of_spaces(self):
+        header, message = parse_header('<1>1  t   h a p m    multi\nline ')
+        self.assertEqual([value for _, value in header],
+                         ['1', '1', 't', 'h', 'a', 'p', 'm'])
+        self.assertEqual(message, 'multi\nline ')
+        self.assertEqual(parse_header('<1>1 t h a p m ')[1], '')
+
+    def test_no_header(self):
+        for line in ['', 'State changed', '<40>1 t h a p m',
+                     '<x>1 t h a p m x', '<40>v1 t h a p m x',
+                     '<40> 1 t h a p m x',
+                     '<40000>1 t h a p m x', '<²>1 t h a p m x']:
+            self.assertIsNone(parse_header(line), line)
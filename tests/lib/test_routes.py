@@ -0,0 +1,44 @@
+import json
+import unittest
+
+from heroku2elk.lib.routes import RouteCache, amqp_route, heroku_route
+
+
+class RoutesTest(unittest.TestCase):
+
+    def test_heroku_route(self):
+        route = heroku_route('/heroku/v1/integration/toto')
+        self.assertEqual(route.routing_key, 'heroku.v1.integration.toto')
+        self.assertEqual(route.prefix, json.dumps(dict(
+            type='heroku', parser_ver='v1', env='integration', app='toto',
+            message=None))[:-len('null}')])
+
+    def test_parser_ver_suffix(self):
+        route = heroku_route('/heroku/v1/integration/toto', '-rfc5424')
+        self.assertEqual(route.routing_key,
+                         'heroku.v1-rfc5424.integration.toto')
+        self.assertIn(('parser_ver', 'v1-rfc5424'), route.fields)
+
+    def test_amqp_route(self):
+        route = amqp_route('/mobile/v1/integration/app')
+        self.assertEqual(route.routing_key, 'mobile.v1.integration.app')
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        parsed = []
+
+        def parse(uri):
+            parsed.append(uri)
+            return amqp_route(uri)
+
+        cache = RouteCache(size=2)
+        for uri in ['/a/v1/x', '/b/v1/x', '/a/v1/x', '/c/v1/x', '/a/v1/x',
+                    '/b/v1/x']:
+            cache.get(uri, parse)
+        # /b was the least recently used when /c came in
+        self.assertEqual(parsed, ['/a/v1/x', '/b/v1/x', '/c/v1/x',
+                                  '/b/v1/x'])
+        self.assertEqual(list(cache.routes), ['/a/v1/x', '/b/v1/x'])
+        self.assertEqual(cache.hit_ratio, 2 / 6)
@@ -0,0 +1,242 @@
+import os
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton, BufferFull
+from heroku2elk.lib.spool import Spool, SpoolFull
+from tests.fakes import FakeConnection, patch_pika
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def spool(self, **kwargs):
+        spool = Spool(self.dir, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def test_append_peek_commit(self):
+        spool = self.spool()
+        self.assertFalse(spool.pending)
+        spool.append('a.b', 'log 1')
+        spool.append('a.c', b'log 2', 'application/x-ndjson')
+        self.assertTrue(spool.pending)
+        records = [record[1:] for record in spool.peek(10)]
+        self.assertEqual(records, [('a.b', None, b'log 1'),
+                                   ('a.c', 'application/x-ndjson', b'log 2')])
+        # not consumed until committed
+        self.assertEqual(len(spool.peek(1)), 1)
+        spool.commit()
+        self.assertEqual([r[3] for r in spool.peek(10)], [b'log 2'])
+        spool.commit()
+        self.assertFalse(spool.pending)
+
+    def test_segments_deleted_once_replayed(self):
+        spool = self.spool(segment_bytes=100)
+        for i in range(10):
+            spool.append('a.b', 'log %d' % i)
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+        self.assertEqual([r[3] for r in spool.peek(8)],
+                         [b'log %d' % i for i in range(8)])
+        spool.commit()
+        self.assertLessEqual(len(os.listdir(self.dir)), 2)
+        self.assertEqual(spool.size, sum(
+            os.path.getsize(os.path.join(self.dir, name))
+            for name in os.listdir(self.dir)))
+
+    def test_uncommitted_records_survive_a_restart(self):
+        spool = Spool(self.dir)
+        spool.append('a.b', 'log 1')
+        spool.append('a.b', 'log 2')
+        spool.peek(1)
+        spool.commit()
+        spool.close()
+        spool = self.spool()
+        self.assertEqual([r[3] for r in spool.peek(10)],
+                         [b'log 1', b'log 2'])
+        spool.append('a.b', 'log 3')
+        self.assertEqual([r[3] for r in spool.peek(10)],
+                         [b'log 1', b'log 2', b'log 3'])
+
+    def test_torn_record_is_dropped(self):
+        spool = Spool(self.dir)
+        spool.append('a.b', 'log 1')
+        spool.append('a.b', 'log 2')
+        spool.close()
+        with open(spool.path(0), 'r+b') as segment:
+            segment.truncate(os.path.getsize(spool.path(0)) - 2)
+        spool = self.spool()
+        spool.append('a.b', 'log 3')
+        self.assertEqual([r[3] for r in spool.peek(10)],
+                         [b'log 1', b'log 3'])
+
+    def test_pending_keys(self):
+        spool = Spool(self.dir)
+        spool.append('a.b', 'log 1')
+        spool.append('a.c', 'log 2')
+        spool.append('a.b', 'log 3')
+        self.assertEqual(spool.pending_keys, {'a.b': 2, 'a.c': 1})
+        spool.peek(2)
+        spool.commit()
+        self.assertEqual(spool.pending_keys, {'a.b': 1})
+        spool.close()
+        # replayed again after a restart, so counted again
+        self.assertEqual(self.spool().pending_keys, {'a.b': 2, 'a.c': 1})
+
+    def test_periodic_flush(self):
+        spool = self.spool()
+        spool.append('a.b', 'log 1')
+        path = spool.path(spool.write_segment)
+        self.assertEqual(os.path.getsize(path), 0)
+        spool.flush()
+        spool._syncing.result()
+        self.assertEqual(os.path.getsize(path), spool.write_offset)
+        with patch.dict('os.environ', {'SPOOL_FSYNC_INTERVAL': '0'}):
+            with self.assertRaises(ValueError):
+                MainConfig()
+
+    def test_size_cap(self):
+        spool = self.spool(max_bytes=60)
+        spool.append('a.b', 'x' * 30)
+        with self.assertRaises(SpoolFull):
+            spool.append('a.b', 'x' * 30)
+
+
+class SpoolReplayTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.conf = MainConfig()
+        self.conf.environments = ['integration']
+        self.conf.spool_activated = True
+        self.conf.spool_dir = tmp.name
+        self.conf.amqp_reconnect_min_delay = 0.01
+        self.conf.amqp_reconnect_max_delay = 0.01
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+
+    def tearDown(self):
+        AMQPConnectionSingleton().close_channel()
+        super().tearDown()
+
+    def publish(self, routing_key, body):
+        return AMQPConnectionSingleton().publish(self.conf, routing_key,
+                                                 body)
+
+    @gen.coroutine
+    def published(self, count):
+        'wait for count messages on the broker and confirm them'
+        while True:
+            channels = [channel for connection in FakeConnection.instances
+                        for channel in connection.channels if channel.is_open]
+            if channels and len(channels[0].published) >= count:
+                channel = channels[0]
+                channel.confirm(len(channel.published), multiple=True)
+                return channel.published
+            yield gen.sleep(0.001)
+
+    @gen_test
+    def test_spooled_while_down_and_replayed_in_order(self):
+        FakeConnection.refuse = True
+        for i in range(5):
+            yield self.publish('a.b' if i % 2 else 'a.c', 'log %d' % i)
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        self.assertTrue(conn.spool.pending)
+
+        FakeConnection.refuse = False
+        published = yield self.published(5)
+        self.assertEqual(published, [
+            ('a.c', b'log 0'), ('a.b', b'log 1'), ('a.c', b'log 2'),
+            ('a.b', b'log 3'), ('a.c', b'log 4')])
+        while conn.spool.pending:
+            yield gen.moment
+        self.assertEqual(conn.buffer.messages, 0)
+
+    @gen.coroutine
+    def confirm_all(self):
+        'confirm the published messages until the test stops'
+        while self.confirming:
+            for connection in FakeConnection.instances:
+                for channel in connection.channels:
+                    if channel.is_open and channel.published:
+                        channel.confirm(len(channel.published),
+                                        multiple=True)
+            yield gen.sleep(0.001)
+
+    @gen.coroutine
+    def reopen(self):
+        'accept the connection again, and wait for it to open'
+        FakeConnection.refuse = False
+        conn = AMQPConnectionSingleton().get_connection(self.conf)
+        while conn.state != conn.OPEN:
+            yield gen.sleep(0.001)
+        return conn
+
+    def published_bodies(self, routing_key):
+        # the spooled bodies are replayed as bytes
+        return [body if isinstance(body, bytes) else body.encode()
+                for connection in FakeConnection.instances
+                for channel in connection.channels
+                for key, body in channel.published if key == routing_key]
+
+    @gen_test
+    def test_keys_without_backlog_bypass_the_spool(self):
+        # one record replayed every tenth of a second
+        self.conf.spool_replay_rate = 10
+        FakeConnection.refuse = True
+        for i in range(3):
+            yield self.publish('a.b', 'log %d' % i)
+        conn = yield self.reopen()
+        self.confirming = True
+        self.io_loop.spawn_callback(self.confirm_all)
+        self.addCleanup(setattr, self, 'confirming', False)
+        yield self.publish('a.c', 'other app')
+        # spooled behind the backlog of its key
+        yield self.publish('a.b', 'live')
+        self.assertEqual(self.published_bodies('a.c'), [b'other app'])
+        self.assertIn('a.b', conn.spool.pending_keys)
+        while conn.spool.pending:
+            yield gen.sleep(0.01)
+        self.assertEqual(self.published_bodies('a.b'),
+                         [b'log 0', b'log 1', b'log 2', b'live'])
+
+    @gen_test(timeout=10)
+    def test_backlog_drains_above_the_replay_rate(self):
+        self.conf.spool_replay_rate = 10
+        FakeConnection.refuse = True
+        for i in range(5):
+            yield self.publish('a.b', 'log %d' % i)
+        conn = yield self.reopen()
+        self.confirming = True
+        self.io_loop.spawn_callback(self.confirm_all)
+        self.addCleanup(setattr, self, 'confirming', False)
+        # 150 messages per second, 15 times the replay rate
+        for i in range(5, 95):
+            yield self.publish('a.b', 'log %d' % i)
+            if i % 3 == 0:
+                yield gen.sleep(0.02)
+        started = self.io_loop.time()
+        while conn.spool.pending:
+            yield gen.sleep(0.01)
+        self.assertLess(self.io_loop.time() - started, 2)
+        self.assertEqual(self.published_bodies('a.b'),
+                         [b'log %d' % i for i in range(95)])
+
+    @gen_test
+    def test_full_spool(self):
+        self.conf.spool_max_bytes = 20
+        FakeConnection.refuse = True
+        with self.assertRaises(BufferFull):
+            yield self.publish('a.b', 'x' * 20)
@@ -0,0 +1,48 @@
+import os
+import unittest
+
+from heroku2elk.config import MainConfig
+from heroku2elk.lib import supervisor
+from heroku2elk.lib.supervisor import Supervisor
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = MainConfig()
+        self.conf.workers = 2
+        self.conf.worker_restart_min_delay = 0.01
+        self.conf.worker_restart_max_delay = 0.05
+
+    def run_workers(self, work):
+        """ start a supervisor whose workers run work(supervisor, index) and
+        exit with the status it returns
+        :return: the indexes of the started workers
+        """
+        read_fd, write_fd = os.pipe()
+        sup = Supervisor(self.conf)
+        index = sup.start()
+        if index is not None:
+            # in a worker: never return into the test runner
+            status = 1
+            try:
+                os.write(write_fd, b'%d' % index)
+                status = work(sup, index)
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as pipe:
+            started = pipe.read()
+        self.assertIsNone(supervisor.worker_id())
+        return sorted(started.decode())
+
+    def test_restart_crashed_workers(self):
+        def work(sup, index):
+            assert supervisor.worker_id() == index
+            # crash twice then exit normally
+            return 1 if sup.failures[index] < 2 else 0
+
+        self.assertEqual(self.run_workers(work), list('000111'))
+
+    def test_workers_exiting_normally(self):
+        self.assertEqual(self.run_workers(lambda sup, index: 0), list('01'))
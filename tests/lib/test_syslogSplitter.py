@@ -2,7 +2,8 @@ import unittest
 from unittest.mock import Mock
 
 from heroku2elk.config import MainConfig
-from heroku2elk.lib.syslog import Splitter
+from heroku2elk.lib.syslog import Splitter, FrameParser, FrameTooLarge, \
+    decode_line
 
 
 svc_start = b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 - State " \
@@ -175,6 +176,87 @@ class SyslogSplitterTest(unittest.TestCase):
             " rem ipsum dolor sit amet, consecteteur adipiscing."
         ])
 
+    def test_iterSplitIsLazy(self):
+        lines = Splitter(MainConfig()).iter_split(svc_start)
+        self.assertEqual(next(lines), svc_start_lines[0])
+        self.assertEqual(list(lines), svc_start_lines[1:])
+
+    def test_splitBigBatch(self):
+        frame = b"%d %s\n" % (len(svc_start_lines[0]) + 1,
+                              svc_start_lines[0].encode())
+        logs = Splitter(MainConfig()).split(frame * 10000)
+        self.assertEqual(logs, svc_start_lines[:1] * 10000)
+
+    def test_splitMultibyte(self):
+        line = "<40>1 2017-06-14T13:52:29+00:00 host app web.3 - \u00e9t\u00e9"
+        encoded = line.encode()
+        stream = b"%d %s" % (len(encoded), encoded) * 2
+        self.assertEqual(Splitter(MainConfig()).split(stream), [line] * 2)
+
+    def test_splitMissingLength(self):
+        with self.assertRaises(ValueError):
+            Splitter(MainConfig()).split(b"12")
+        with self.assertRaises(ValueError):
+            Splitter(MainConfig()).split(b"<40>1 2017-06-14T13:52:29+00:00")
+
+
+class FrameParserTest(unittest.TestCase):
+
+    def parse(self, parser, stream, chunk_size):
+        frames = []
+        for i in range(0, len(stream), chunk_size):
+            frames.extend(parser.feed(stream[i:i + chunk_size]))
+        return frames + parser.close()
+
+    def test_anyChunkSize(self):
+        splitter = Splitter(MainConfig())
+        for chunk_size in (1, 2, 3, 10, 83, 84, len(svc_start)):
+            frames = self.parse(FrameParser(), svc_start, chunk_size)
+            self.assertEqual(list(map(splitter.decode, frames)),
+                             svc_start_lines)
+
+    def test_frameIsReturnedAsSoonAsComplete(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed(svc_start[:85]), [])
+        self.assertEqual(parser.feed(svc_start[85:86]), [svc_start[3:86]])
+        self.assertEqual(parser.feed(svc_start[86:]), [])
+
+    def test_frameTooLarge(self):
+        parser = FrameParser(max_frame_size=100)
+        self.assertEqual(len(parser.feed(svc_start[:86])), 1)
+        with self.assertRaises(FrameTooLarge):
+            parser.feed(svc_start[86:])
+
+    def test_invalidFrameLength(self):
+        with self.assertRaises(ValueError):
+            FrameParser().feed(b"<40>1 2017-06-14T13:52:29+00:00")
+        with self.assertRaises(ValueError):
+            FrameParser().feed(b"123456789012345678")
+        with self.assertRaises(ValueError):
+            parser = FrameParser()
+            parser.feed(b"12")
+            parser.close()
+
+    def test_splitWholePayload(self):
+        frames = FrameParser().split(b"\n" + svc_start)
+        self.assertEqual([bytes(frame) for frame in frames],
+                         [svc_start[3:86], svc_start[90:]])
+        # whitespaces after the last frame are ignored
+        frames = FrameParser().split(svc_start[:86] + b" \n")
+        self.assertEqual([bytes(frame) for frame in frames],
+                         [svc_start[3:86]])
+
+    def test_splitCountsOctets(self):
+        line = '<40>1 2017-06-14T13:52:29+00:00 host app web.3 - é中 €'
+        frame = line.encode()
+        payload = b"%d %s" % (len(frame), frame) * 3
+        frames = FrameParser().split(payload)
+        self.assertEqual([decode_line(frame) for frame in frames], [line] * 3)
+
+    def test_splitTinyFrames(self):
+        frames = FrameParser().split(b"1 x" * 10000)
+        self.assertEqual([bytes(frame) for frame in frames], [b'x'] * 10000)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,23 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+import unittest
+
+from benchmarks import suite
+
+
+class SuiteTest(unittest.TestCase):
+
+    def test_save_and_compare(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'baseline.json')
+            suite.main(['--layer', 'micro', '--layer', 'handler',
+                        '--corpus', 'plain', '--requests', '2',
+                        '--lines', '2', '--repeat', '1', '--output', path])
+            with open(path) as results:
+                results = [json.loads(line) for line in results]
+            self.assertEqual({result['output'] for result in results},
+                             {'amqp'})
+            self.assertIn('handler', {result['layer'] for result in results})
+            # the same results do not regress
+            suite.main(['--compare', path, path])
@@ -0,0 +1,76 @@
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from tests.fakes import patch_pika
+
+
+payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+           b"- State changed from starting to up\n"
+           b"119 <40>1 2017-06-14T13:53:26+00:00 host app web.3 "
+           b"- Starting process "
+           b"with command `bundle exec rackup config.ru -p 24405`")
+
+
+class TestH2LConfirms(AsyncHTTPTestCase):
+
+    def get_app(self):
+        conf = MainConfig()
+        conf.environments = ['integration']
+        conf.amqp_wait_confirms = True
+        self.app = main.make_app(conf)
+        return self.app
+
+    def setUp(self):
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+        super().setUp()
+
+    def tearDown(self):
+        main.close_app(self.app)
+        super().tearDown()
+
+    @gen.coroutine
+    def post(self, ack):
+        response = self.http_client.fetch(
+            self.get_url('/heroku/v1/integration/toto'), method='POST',
+            body=payload, raise_error=False)
+        channel = yield AMQPConnectionSingleton().get_channel(
+            self.app.conf, self.io_loop)
+        while len(channel.published) < 2:
+            yield gen.moment
+        self.assertFalse(response.done())
+        channel.confirm(2, multiple=True, ack=ack)
+        response = yield response
+        return response
+
+    @gen_test
+    def test_reply_once_confirmed(self):
+        response = yield self.post(ack=True)
+        self.assertEqual(response.code, 200)
+
+    @gen_test
+    def test_nack_asks_for_retry(self):
+        response = yield self.post(ack=False)
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+
+    @gen_test
+    def test_full_buffer_asks_for_retry(self):
+        self.app.conf.amqp_outbound_max_messages = 1
+        response = self.http_client.fetch(
+            self.get_url('/heroku/v1/integration/toto'), method='POST',
+            body=payload, raise_error=False)
+        channel = yield AMQPConnectionSingleton().get_channel(
+            self.app.conf, self.io_loop)
+        while not channel.published:
+            yield gen.moment
+        # the second line did not fit in the buffer
+        channel.confirm(1)
+        response = yield response
+        self.assertEqual(len(channel.published), 1)
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
@@ -1,11 +1,21 @@
+import os
+from unittest.mock import patch
+
 from tornado.testing import AsyncHTTPTestCase, gen_test
 from tornado.concurrent import Future
 from heroku2elk import main
 from heroku2elk.config import MainConfig
 from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from heroku2elk.lib.offload import BatchOffloader
+from tests.fakes import FakeConnection, patch_pika
 import json
 
 
+def exit_worker(body, route, chain):
+    'break the offload pool'
+    os._exit(1)
+
+
 class TestH2LApp(AsyncHTTPTestCase):
 
     def get_app(self):
@@ -33,6 +43,43 @@ class TestH2LApp(AsyncHTTPTestCase):
         self.assertEqual(response.code, 500)
         self.assertEqual(len(response.body), 0)
 
+    def test_H2L_offload(self):
+        payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+                   b"- State changed from starting to up\n"
+                   b"62 <40>1 2017-06-14T13:53:26+00:00 host app web.3 "
+                   b"- {\"token\":\"x\"}")
+        self.conf.offload_min_bytes = len(payload)
+        self.app.offloader = BatchOffloader(self.conf, self.app)
+        with patch_pika():
+            response = self.fetch('/heroku/v1/integration/toto',
+                                  method='POST', body=payload)
+            channel, = FakeConnection.instances[0].channels
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            [json.loads(body)['message'] for _, body in channel.published],
+            ['<40>1 2017-06-14T13:52:29+00:00 host app web.3 - State changed '
+             'from starting to up',
+             '<40>1 2017-06-14T13:53:26+00:00 host app web.3 - '
+             '{"token":"__TOKEN_REPLACED__"}'])
+        self.assertIsNotNone(self.app.offloader.pool)
+
+    def test_H2L_offload_broken_pool(self):
+        payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+                   b"- State changed from starting to up\n")
+        self.conf.offload_min_bytes = len(payload)
+        self.app.offloader = BatchOffloader(self.conf, self.app)
+        with patch_pika(), \
+                patch('heroku2elk.lib.offload._split_batch', exit_worker), \
+                patch('heroku2elk.lib.offload.get_metrics') as get_metrics:
+            response = self.fetch('/heroku/v1/integration/toto',
+                                  method='POST', body=payload)
+            channel, = FakeConnection.instances[0].channels
+        self.assertEqual(response.code, 200)
+        # retried in a new pool, then split in the IOLoop
+        self.assertEqual(len(channel.published), 1)
+        self.assertEqual(get_metrics().incr.call_count, 2)
+        self.assertIsNone(self.app.offloader.pool)
+
     @gen_test
     def test_H2L_heroku_push_to_amqp_success(self):
         conn = AMQPConnectionSingleton.AMQPConnection(self.conf)
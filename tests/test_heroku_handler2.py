@@ -7,6 +7,7 @@ from heroku2elk import main
 from heroku2elk.lib import handlers, plugins
 from heroku2elk.config import MainConfig
 from heroku2elk.lib.amqp import AMQPConnectionSingleton
+from tests.fakes import FakeConnection, patch_pika
 
 
 class TestH2LHerokuHandlerV2(AsyncHTTPTestCase):
@@ -49,6 +50,18 @@ class TestH2LHerokuHandlerV2(AsyncHTTPTestCase):
                               body=payload)
         self.assertEqual(response.code, 200)
 
+    def test_H2L_split_multibyte(self):
+        line = '<40>1 2017-06-14T13:52:29+00:00 host app web.3 - é中 €'
+        frame = line.encode() + b'\n'
+        with patch_pika():
+            response = self.fetch('/heroku/v2/integration/toto',
+                                  method='POST',
+                                  body=b"%d %s" % (len(frame), frame) * 2)
+            channel, = FakeConnection.instances[0].channels
+        self.assertEqual(response.code, 200)
+        self.assertEqual([json.loads(body)['message']
+                          for _, body in channel.published], [line] * 2)
+
     def test_H2L_split_error(self):
         payload = (b"50 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
                    b"- State changed from starting to up\n"
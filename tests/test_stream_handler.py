@@ -0,0 +1,157 @@
+import gzip
+import json
+
+from tornado import gen
+from tornado.testing import AsyncHTTPTestCase
+
+from heroku2elk import main
+from heroku2elk.config import MainConfig
+from heroku2elk.lib import handlers, plugins
+from heroku2elk.lib.batch import BatchPublisher
+from heroku2elk.lib.envelope import make_encoder
+from tests.fakes import FakeConnection, patch_pika
+
+
+payload = (b"83 <40>1 2017-06-14T13:52:29+00:00 host app web.3 "
+           b"- State changed from starting to up\n"
+           b"119 <40>1 2017-06-14T13:53:26+00:00 host app web.3 "
+           b"- Starting process "
+           b"with command `bundle exec rackup config.ru -p 24405`")
+
+
+class TestH2LStreamHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        conf = MainConfig()
+        conf.environments = ['integration']
+        conf.handlers = dict(heroku=dict(
+            v1=[handlers.HerokuStreamHandler],
+            v2=[handlers.HerokuStreamHandler2]))
+        conf.max_frame_size = 200
+        self.app = main.make_app(conf)
+        return self.app
+
+    def setUp(self):
+        pika_patch = patch_pika()
+        pika_patch.start()
+        self.addCleanup(pika_patch.stop)
+        super().setUp()
+
+    def tearDown(self):
+        main.close_app(self.app)
+        super().tearDown()
+
+    def post_chunks(self, path, chunk_size):
+
+        @gen.coroutine
+        def body_producer(write):
+            for i in range(0, len(payload), chunk_size):
+                yield write(payload[i:i + chunk_size])
+
+        return self.fetch(path, method='POST', body_producer=body_producer)
+
+    @property
+    def published(self):
+        'messages received by the fake broker'
+        return [message for connection in FakeConnection.instances
+                for channel in connection.channels
+                for message in channel.published]
+
+    def messages(self):
+        return [json.loads(body)['message'] for _, body in self.published]
+
+    def test_frames_split_across_chunks(self):
+        response = self.post_chunks('/heroku/v1/integration/toto', 7)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.messages(), [
+            "<40>1 2017-06-14T13:52:29+00:00 host app web.3 - State changed "
+            "from starting to up",
+            "<40>1 2017-06-14T13:53:26+00:00 host app web.3 - Starting "
+            "process with command `bundle exec rackup config.ru -p 24405`"])
+        self.assertEqual(self.published[0][0],
+                         'heroku.v1.integration.toto')
+
+    def test_lines_filtered_once(self):
+        line = b'<40>1 2017-06-14T13:52:29+00:00 host app web.3 - ' \
+               b'{"token":"secret"}' + b' Lorem ipsum' * 100
+        self.app.conf.plugins = {'*': {'*': [plugins.truncate]}}
+        self.app.plugin_chains = main.compile_plugin_chains(self.app.conf)
+        self.app.conf.max_frame_size = -1
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=b"%d %s" % (len(line), line))
+        self.assertEqual(response.code, 200)
+        message, = self.messages()
+        self.assertEqual(len(message), 1000 + len(' __TRUNCATED__ '))
+        self.assertIn('"token":"__TOKEN_REPLACED__"', message)
+
+    def test_multiline_frames(self):
+        response = self.post_chunks('/heroku/v2/integration/toto', 50)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(self.messages()), 2)
+        self.assertEqual(self.published[1][0],
+                         'heroku.v2.integration.toto')
+
+    def test_parsed_header(self):
+        self.app.conf.rfc5424_activated = True
+        self.app.encoder = make_encoder(self.app.conf)
+        response = self.post_chunks('/heroku/v2/integration/toto', 50)
+        self.assertEqual(response.code, 200)
+        routing_key, body = self.published[0]
+        self.assertEqual(routing_key, 'heroku.v2-rfc5424.integration.toto')
+        envelope = json.loads(body)
+        self.assertEqual(envelope['message'],
+                         'State changed from starting to up')
+        self.assertEqual(envelope['heroku_dyno'], 'web.3')
+        self.assertEqual(envelope['parser_ver'], 'v2-rfc5424')
+
+    def test_batched_frames(self):
+        self.app.conf.amqp_batch_max_lines = 2
+        self.app.batcher = BatchPublisher(self.app.conf,
+                                          self.app.output.publish_one)
+        response = self.post_chunks('/heroku/v1/integration/toto', 30)
+        self.assertEqual(response.code, 200)
+        (routing_key, body), = self.published
+        self.assertEqual(routing_key, 'heroku.v1.integration.toto')
+        self.assertEqual([json.loads(line)['app']
+                          for line in body.splitlines()], ['toto', 'toto'])
+
+    def test_split_error(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=b"50" + payload[2:])
+        self.assertEqual(response.code, 500)
+        self.assertEqual(len(response.body), 0)
+
+    def test_frame_too_large(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=b"1000 " + b"x" * 1000)
+        self.assertEqual(response.code, 413)
+        self.assertEqual(self.published, [])
+
+    def test_gzip_body(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=gzip.compress(payload),
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(self.messages()), 2)
+
+    def test_compressed_body_too_large(self):
+        self.app.conf.decompress_max_bytes = 100
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=gzip.compress(payload),
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.code, 413)
+
+    def test_truncated_gzip_body(self):
+        response = self.fetch('/heroku/v1/integration/toto', method='POST',
+                              body=gzip.compress(payload)[:-10],
+                              headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.code, 400)
+
+    def test_forward_error(self):
+        def encode(route, log):
+            raise RuntimeError('encoder failure')
+
+        self.app.encoder.encode = encode
+        response = self.post_chunks('/heroku/v1/integration/toto', 7)
+        self.assertEqual(response.code, 500)
+        self.assertEqual(self.published, [])